@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+Measure the time per key of Bloomfilter.add and membership tests, one key
+at a time and through the batch methods add_many and contains_many. The
+original implementation (probes from the hex digest, 2 ** (i % 8) per bit)
+is timed as well, and the arrays of both are checked to be byte-identical.
+
+Usage:
+
+    contrib/bench_bloomfilter.py
+    contrib/bench_bloomfilter.py --keys 100 --rounds 2000
+"""
+
+import argparse
+import hashlib
+import time
+
+from isso.utils import Bloomfilter
+
+
+class Original(object):
+    """Bloomfilter.add and __contains__ before probes were derived from the
+    digest bytes (a single slice)."""
+
+    def __init__(self):
+        self.array, self.k, self.m = bytearray(256), 11, 2048
+
+    def get_probes(self, key):
+        h = int(hashlib.sha256(key.encode()).hexdigest(), 16)
+        for _ in range(self.k):
+            yield h & self.m - 1
+            h >>= self.k
+
+    def add(self, key):
+        for i in self.get_probes(key):
+            self.array[i // 8] |= 2 ** (i % 8)
+
+    def __contains__(self, key):
+        return all(self.array[i // 8] & (2 ** (i % 8)) for i in self.get_probes(key))
+
+
+def timeit(func, rounds, keys):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        func()
+    return (time.perf_counter() - start) / rounds / keys * 1e6
+
+
+def main():
+    args = parse_args()
+    keys = ['10.0.%i.%i' % divmod(i, 256) for i in range(args.keys)]
+    probes = ['11.0.%i.%i' % divmod(i, 256) for i in range(args.keys)]
+
+    original, bf = Original(), Bloomfilter()
+    for key in keys:
+        original.add(key)
+    bf.add_many(keys)
+    assert original.array == bf.array, 'arrays differ'
+
+    def add(cls):
+        bf = cls()
+        for key in keys:
+            bf.add(key)
+
+    rows = [
+        ('original', 'add', timeit(lambda: add(Original), args.rounds, args.keys)),
+        ('original', 'contains', timeit(lambda: [key in original for key in keys + probes],
+                                        args.rounds, 2 * args.keys)),
+        ('current', 'add', timeit(lambda: add(Bloomfilter), args.rounds, args.keys)),
+        ('current', 'contains', timeit(lambda: [key in bf for key in keys + probes],
+                                       args.rounds, 2 * args.keys)),
+        ('current', 'add_many', timeit(lambda: Bloomfilter().add_many(keys), args.rounds, args.keys)),
+        ('current', 'contains_many', timeit(lambda: bf.contains_many(keys + probes),
+                                            args.rounds, 2 * args.keys)),
+    ]
+
+    print('{0} keys, {1} rounds, arrays identical'.format(args.keys, args.rounds))
+    for name, op, us in rows:
+        print('  {0:<10} {1:<14} {2:>6.2f} us per key'.format(name, op, us))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark Bloomfilter probes',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--keys', type=int, default=140, help='Number of keys (at most 142 fit the first slice)')
+    parser.add_argument('--rounds', type=int, default=500, help='Number of rounds to average')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+Show the query plans and timings of Isso's most frequent comment lookups
+before and after the secondary indexes of schema version 4 are created.
+
+The script fills a fresh database with random comments (one million by
+default), drops the indexes to mimic a version 3 database and runs every
+query once without and once with them.
+
+Usage:
+
+    contrib/bench_indexes.py /tmp/bench.db
+    contrib/bench_indexes.py /tmp/bench.db --comments 100000 --threads 1000
+
+The database file is reused if it already exists.
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import time
+
+from isso import config
+from isso.db import SQLite3
+from isso.db.comments import Comments
+
+QUERIES = [
+    ('fetch', [
+        'SELECT comments.* FROM comments INNER JOIN threads ON',
+        '    threads.uri=? AND comments.tid=+threads.id AND (? | comments.mode) = ?',
+        '    AND comments.created>? AND comments.parent IS NULL ORDER BY id'],
+     lambda args: ('/thread/%i' % random.randrange(args.threads), 5, 5, 0)),
+    ('reply_count', [
+        'SELECT comments.parent,count(*)',
+        'FROM comments INNER JOIN threads ON',
+        '   threads.uri=? AND comments.tid=+threads.id AND',
+        '   (? | comments.mode = ?) AND',
+        '   comments.created > ?',
+        'GROUP BY comments.parent'],
+     lambda args: ('/thread/%i' % random.randrange(args.threads), 5, 5, 0)),
+    ('guard ratelimit', [
+        'SELECT id FROM comments WHERE remote_addr = ? AND created > ?'],
+     lambda args: ('10.0.%i.0' % random.randrange(256), time.time() - 60)),
+    ('guard direct-reply', [
+        'SELECT id FROM comments WHERE',
+        '    tid = +(SELECT id FROM threads WHERE uri = ?)',
+        'AND remote_addr = ?',
+        'AND parent IS NULL'],
+     lambda args: ('/thread/%i' % random.randrange(args.threads),
+                   '10.0.%i.0' % random.randrange(256))),
+    ('previously approved', [
+        'SELECT CASE WHEN EXISTS(',
+        '    select * from comments where email=? and mode=1 and ',
+        '    created > strftime("%s", DATETIME("now", "-6 month"))',
+        ') THEN 1 ELSE 0 END'],
+     lambda args: ('user%i@example.org' % random.randrange(args.comments), )),
+    ('delete references', [
+        'SELECT * FROM comments WHERE parent=?'],
+     lambda args: (random.randrange(args.comments), )),
+    ('remove stale', [
+        'SELECT id FROM comments WHERE mode=4 AND id NOT IN (',
+        '    SELECT parent FROM comments WHERE parent IS NOT NULL)'],
+     lambda args: ()),
+]
+
+
+def populate(con, args):
+    now = time.time()
+    con.executemany('INSERT INTO threads (uri, title) VALUES (?, ?)', (
+        ('/thread/%i' % i, 'Thread %i' % i) for i in range(args.threads)))
+
+    def rows():
+        for id in range(1, args.comments + 1):
+            parent = random.randrange(1, id) if id > 1 and random.random() < 0.3 else None
+            yield (random.randrange(1, args.threads + 1), id, parent,
+                   now - random.random() * 365 * 24 * 3600,
+                   random.choice((1, 1, 1, 2, 4)),
+                   '10.0.%i.0' % random.randrange(256),
+                   'Lorem ipsum dolor sit amet.', 'Author %i' % id,
+                   'user%i@example.org' % random.randrange(args.comments // 2 or 1),
+                   bytes(256))
+
+    con.executemany(
+        'INSERT INTO comments (tid, id, parent, created, mode, remote_addr,'
+        '    text, author, email, voters) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        rows())
+
+
+def run(con, args):
+    random.seed(args.seed)
+    for name, sql, params in QUERIES:
+        sql = ' '.join(sql)
+        values = [params(args) for _ in range(args.repeat)]
+        plan = [row[-1] for row in con.execute('EXPLAIN QUERY PLAN ' + sql, values[0])]
+
+        start = time.perf_counter()
+        for value in values:
+            con.execute(sql, value).fetchall()
+        elapsed = (time.perf_counter() - start) / len(values)
+
+        print('  {0:<20} {1:>10.3f} ms  {2}'.format(name, elapsed * 1000, '; '.join(plan)))
+
+
+def main():
+    args = parse_args()
+    exists = os.path.exists(args.db_path)
+
+    # create the current schema, including triggers
+    SQLite3(args.db_path, config.new({"general": {"dbpath": args.db_path, "max-age": "1h"}}))
+
+    con = sqlite3.connect(args.db_path, isolation_level=None)
+    for (name, ) in con.execute("SELECT name FROM sqlite_master WHERE type='index' AND tbl_name='comments'").fetchall():
+        con.execute('DROP INDEX ' + name)
+
+    if not exists or con.execute('SELECT COUNT(*) FROM comments').fetchone()[0] == 0:
+        print('populate {0} with {1} comments in {2} threads'.format(args.db_path, args.comments, args.threads))
+        start = time.perf_counter()
+        con.execute('BEGIN')
+        populate(con, args)
+        con.execute('COMMIT')
+        print('  done in {0:.1f} s'.format(time.perf_counter() - start))
+
+    print('without indexes (version 3)')
+    run(con, args)
+
+    start = time.perf_counter()
+    for sql in Comments.indexes:
+        con.execute(sql)
+    print('indexes created in {0:.1f} s'.format(time.perf_counter() - start))
+
+    print('with indexes (version 4)')
+    run(con, args)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark Isso queries with and without secondary indexes',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('db_path', help='File path of the SQLite database to create or reuse')
+    parser.add_argument('--comments', type=int, default=1000000, help='Number of comments to generate')
+    parser.add_argument('--threads', type=int, default=10000, help='Number of threads to spread the comments across')
+    parser.add_argument('--repeat', type=int, default=20, help='Number of runs per query')
+    parser.add_argument('--seed', type=int, default=42, help='Random seed of the query parameters')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+Measure comment submission latency while new threads are being created
+against a slow origin.
+
+The script starts a stand-in origin which answers every request after a
+delay, creates a few threads and then submits comments to those existing
+threads concurrently with comments to threads that don't exist yet. The
+latter make Isso fetch the thread title from the slow origin, which used to
+happen with a process-wide lock held and thus stalled every submission.
+
+Usage:
+
+    contrib/bench_new.py
+    contrib/bench_new.py --delay 2 --cold 4 --hot 64 --workers 16
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+from werkzeug.test import Client
+from werkzeug.wrappers import Response
+
+from isso import Isso, config, core, dist
+
+PAGE = b'<html><head><title>Slow</title></head><body><div id="isso-thread"></div></body></html>'
+
+
+class Origin(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(delay):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            time.sleep(delay)
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html")
+            self.send_header("Content-Length", str(len(PAGE)))
+            self.end_headers()
+            self.wfile.write(PAGE)
+
+        def log_message(self, *args):
+            pass
+
+    server = Origin(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def post(app, uri, data):
+    client = Client(app, Response)
+    start = time.perf_counter()
+    rv = client.post("/new?uri=" + uri, data=json.dumps(data), content_type="application/json")
+    assert rv.status_code in (201, 202), (uri, rv.status_code, rv.data)
+    return time.perf_counter() - start
+
+
+def main():
+    args = parse_args()
+    origin = serve(args.delay)
+
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+
+    conf = config.load(os.path.join(dist.location, dist.project_name, "defaults.ini"))
+    conf.set("general", "dbpath", path)
+    conf.set("general", "host", "http://127.0.0.1:%i/" % origin.server_port)
+    conf.set("guard", "enabled", "off")
+
+    class App(Isso, core.ThreadedMixin):
+        pass
+
+    app = App(conf)
+
+    try:
+        for i in range(args.threads):
+            post(app, "/hot/%i" % i, {"text": "Warm up", "title": "Hot %i" % i})
+
+        with ThreadPoolExecutor(args.workers) as pool:
+            start = time.perf_counter()
+            cold = [pool.submit(post, app, "/cold/%i" % i, {"text": "Lorem ipsum"})
+                    for i in range(args.cold)]
+            time.sleep(0.05)  # let the cold requests reach the origin first
+            hot = [pool.submit(post, app, "/hot/%i" % (i % args.threads), {"text": "Lorem ipsum"})
+                   for i in range(args.hot)]
+
+            hot = sorted(f.result() for f in hot)
+            cold = sorted(f.result() for f in cold)
+            elapsed = time.perf_counter() - start
+    finally:
+        origin.shutdown()
+        os.unlink(path)
+
+    print("origin delay {0:.1f} s, {1} workers".format(args.delay, args.workers))
+    for name, latencies in (("new thread", cold), ("existing thread", hot)):
+        print("  {0:<16} {1:>4} requests  median {2:>8.3f} s  max {3:>8.3f} s".format(
+            name, len(latencies), latencies[len(latencies) // 2], latencies[-1]))
+    print("  total {0:.2f} s, {1:.1f} requests/s".format(elapsed, (args.cold + args.hot) / elapsed))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark concurrent comment submissions with a slow origin',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--delay', type=float, default=1.0, help='Response time of the origin in seconds (must stay below the 3 s timeout)')
+    parser.add_argument('--cold', type=int, default=4, help='Number of comments to threads that need to be created')
+    parser.add_argument('--hot', type=int, default=64, help='Number of comments to existing threads')
+    parser.add_argument('--threads', type=int, default=8, help='Number of existing threads')
+    parser.add_argument('--workers', type=int, default=16, help='Number of concurrent clients')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+Measure how long Isso's purge of stale pending comments takes on a large
+database, with the remove_stale_threads trigger of schema version 4 (which
+scanned all threads and comments for every deleted comment) and with the
+current one.
+
+The script fills a database with random comments (20000 by default), a
+share of which are pending and older than the purge cutoff, and purges a
+fresh copy of it per trigger.
+
+Usage:
+
+    contrib/bench_purge.py
+    contrib/bench_purge.py --comments 100000 --threads 1000 --pending 0.05
+"""
+
+import argparse
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+
+from isso import config
+from isso.db import SQLite3
+
+CUTOFF = 7 * 24 * 3600
+
+TRIGGERS = [
+    ('version 4', [
+        'CREATE TRIGGER remove_stale_threads',
+        'AFTER DELETE ON comments',
+        'BEGIN',
+        '    DELETE FROM threads WHERE id NOT IN (SELECT tid FROM comments);',
+        'END']),
+    ('current', None),
+]
+
+
+def populate(con, args):
+    now = time.time()
+    con.executemany('INSERT INTO threads (uri, title) VALUES (?, ?)', (
+        ('/thread/%i' % i, 'Thread %i' % i) for i in range(args.threads)))
+
+    def rows():
+        top = []
+        for id in range(1, args.comments + 1):
+            if random.random() < args.pending:
+                mode, created = 2, now - CUTOFF - random.random() * CUTOFF
+            else:
+                mode, created = random.choice((1, 1, 1, 4)), now - random.random() * 365 * 24 * 3600
+            # replies refer to top-level comments, as in Isso
+            parent = random.choice(top) if top and random.random() < 0.3 else None
+            if parent is None:
+                top.append(id)
+            yield (random.randrange(1, args.threads + 1), id, parent, created, mode,
+                   '10.0.%i.0' % random.randrange(256), 'Lorem ipsum dolor sit amet.',
+                   'Author %i' % id, bytes(256))
+
+    con.executemany(
+        'INSERT INTO comments (tid, id, parent, created, mode, remote_addr,'
+        '    text, author, voters) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        rows())
+
+
+def main():
+    args = parse_args()
+    random.seed(args.seed)
+
+    tmp = tempfile.mkdtemp()
+    template = os.path.join(tmp, 'template.db')
+    conf = config.new({"general": {"dbpath": template, "max-age": "1h"}})
+
+    try:
+        SQLite3(template, conf).dispose()
+
+        print('populate {0} comments in {1} threads, {2:.0%} stale pending'.format(
+            args.comments, args.threads, args.pending))
+        con = sqlite3.connect(template, isolation_level=None)
+        con.execute('PRAGMA journal_mode = delete')
+        con.execute('BEGIN')
+        populate(con, args)
+        con.execute('COMMIT')
+        con.close()
+
+        for name, trigger in TRIGGERS:
+            path = os.path.join(tmp, 'bench.db')
+            shutil.copy(template, path)
+
+            if trigger is not None:
+                con = sqlite3.connect(path, isolation_level=None)
+                con.execute('DROP TRIGGER remove_stale_threads')
+                con.execute(' '.join(trigger))
+                con.close()
+
+            db = SQLite3(path, conf)
+            before = db.execute('SELECT COUNT(*) FROM comments').fetchone()[0]
+
+            start = time.perf_counter()
+            db.comments.purge(CUTOFF)
+            elapsed = time.perf_counter() - start
+
+            after = db.execute('SELECT COUNT(*) FROM comments').fetchone()[0]
+            db.dispose()
+
+            print('  {0:<12} {1:>8} comments removed in {2:>8.2f} s'.format(
+                name, before - after, elapsed))
+    finally:
+        shutil.rmtree(tmp)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark purging stale pending comments',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--comments', type=int, default=20000, help='Number of comments to generate')
+    parser.add_argument('--threads', type=int, default=200, help='Number of threads to spread the comments across')
+    parser.add_argument('--pending', type=float, default=0.01, help='Share of pending comments older than the cutoff')
+    parser.add_argument('--seed', type=int, default=42, help='Random seed')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
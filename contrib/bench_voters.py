@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+Compare two structures to deduplicate the voters of a comment, both stored
+as a blob per comment:
+
+  - bloomfilter: Isso's scalable Bloomfilter, a chain of slices of doubling
+    size, starting with the original 256 byte array.
+  - hashset: a set of 32 bit fingerprints of the voters (the first bytes of
+    their SHA-256), stored as an array and loaded into a set per vote.
+
+For each number of voters the script reports the size of the blob, the time
+of a single vote (load the blob, look up and add the voter, store the blob)
+and the false-positive rate, i.e. the share of new voters rejected.
+
+Usage:
+
+    contrib/bench_voters.py
+    contrib/bench_voters.py --voters 100 1000 10000 100000 --probes 20000
+"""
+
+import argparse
+import array
+import hashlib
+import time
+
+from isso.utils import Bloomfilter
+
+
+def address(i, prefix=10):
+    return '%i.%i.%i.%i' % (prefix, i >> 16 & 255, i >> 8 & 255, i & 255)
+
+
+class Filter(object):
+
+    name = 'bloomfilter'
+
+    def __init__(self, keys):
+        bf = Bloomfilter(iterable=keys)
+        self.blob, self.count = bytes(bf.array), len(bf)
+
+    def vote(self, key):
+        bf = Bloomfilter(bytearray(self.blob), self.count)
+        if key in bf:
+            return False
+        bf.add(key)
+        self.blob, self.count = bytes(bf.array), self.count + 1
+        return True
+
+
+class HashSet(object):
+
+    name = 'hashset'
+
+    def __init__(self, keys):
+        self.blob = array.array('I', map(self.fingerprint, keys)).tobytes()
+
+    @staticmethod
+    def fingerprint(key):
+        return int.from_bytes(hashlib.sha256(key.encode()).digest()[:4], 'little')
+
+    def vote(self, key):
+        voters = array.array('I')
+        voters.frombytes(self.blob)
+        fp = self.fingerprint(key)
+        if fp in set(voters):
+            return False
+        voters.append(fp)
+        self.blob = voters.tobytes()
+        return True
+
+
+def main():
+    args = parse_args()
+
+    print('{0:<12} {1:>8} {2:>10} {3:>12} {4:>10}'.format(
+        'structure', 'voters', 'bytes', 'us per vote', 'fp rate'))
+
+    for n in args.voters:
+        for cls in (Filter, HashSet):
+            voters = cls(address(i) for i in range(n))
+
+            start = time.perf_counter()
+            for i in range(args.probes):
+                voters.vote(address(i, prefix=11))
+            elapsed = time.perf_counter() - start
+
+            voters = cls(address(i) for i in range(n))
+            rejected = sum(not voters.vote(address(i, prefix=12)) for i in range(args.probes))
+            print('{0:<12} {1:>8} {2:>10} {3:>12.1f} {4:>10.5f}'.format(
+                cls.name, n, len(voters.blob), elapsed / args.probes * 1e6,
+                rejected / args.probes))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark voter deduplication structures',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--voters', type=int, nargs='+', default=[100, 1000, 10000, 50000],
+                        help='Numbers of voters per comment')
+    parser.add_argument('--probes', type=int, default=2000, help='Number of votes to time and to test for false positives')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+Measure the throughput of concurrent votes on a few hot comments and count
+the voters lost to races between reading and writing the voters blob.
+
+Every vote comes from a distinct address and is accepted. All votes are
+replayed afterwards, each of them should be rejected as a duplicate. Lost
+voters show up as duplicates accepted by the replay, lost updates of the
+counters as votes lost.
+
+Usage:
+
+    contrib/bench_votes.py
+    contrib/bench_votes.py --comments 8 --votes 100 --workers 32
+    contrib/bench_votes.py --backend mysql -c /path/to/isso.cfg
+    contrib/bench_votes.py --buffer
+
+With --buffer the votes go through Isso's in-memory vote buffer ([votes]
+buffer = true), which is flushed before the votes are counted.
+
+The MySQL backend reads the [mysql] section of the given configuration (or
+the MYSQL_* environment variables) and creates its tables in that database.
+Each worker gets its own connection.
+"""
+
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from isso import config, db, dist
+from isso.core import VoteBuffer
+
+
+def connect(args, conf):
+    if args.backend == 'mysql':
+        from isso import mysql
+        local = threading.local()
+
+        def get():
+            if not hasattr(local, 'db'):
+                local.db = mysql.MySQL(conf)
+            return local.db
+        return get
+
+    rv = db.SQLite3(conf.get('general', 'dbpath'), conf)
+    return lambda: rv
+
+
+def main():
+    args = parse_args()
+
+    conf = config.load(os.path.join(dist.location, dist.project_name, 'defaults.ini'), args.conf)
+    path = None
+    if args.backend == 'sqlite':
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        conf.set('general', 'dbpath', path)
+
+    get = connect(args, conf)
+    uri = '/bench/votes/%i' % time.time()
+
+    try:
+        get().threads.new(uri, 'Votes')
+        ids = [get().comments.add(uri, {'text': '...', 'mode': 1, 'remote_addr': '127.0.0.1'})['id']
+               for _ in range(args.comments)]
+
+        buffer = VoteBuffer(get(), conf.getint('votes', 'flush-interval') / 1000.0,
+                            conf.getint('votes', 'flush-size')) if args.buffer else None
+
+        def vote(n):
+            id = ids[n % len(ids)]
+            return (buffer or get().comments).vote(n % 3 != 0, id, '10.%i.%i.%i' % (n >> 16 & 255, n >> 8 & 255, n & 255))
+
+        def total():
+            return sum(c['likes'] + c['dislikes'] for c in map(get().comments.get, ids))
+
+        votes = args.comments * args.votes
+        with ThreadPoolExecutor(args.workers) as pool:
+            start = time.perf_counter()
+            list(pool.map(vote, range(votes)))
+            elapsed = time.perf_counter() - start
+
+            if buffer is not None:
+                buffer.flush()
+            stored = total()
+            list(pool.map(vote, range(votes)))
+            if buffer is not None:
+                buffer.flush()
+            duplicates = total() - stored
+    finally:
+        if path is not None:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(path + suffix):
+                    os.unlink(path + suffix)
+
+    print('{0}{1}: {2} votes on {3} comments, {4} workers'.format(
+        args.backend, ' (buffered)' if args.buffer else '', votes, args.comments, args.workers))
+    print('  {0:.2f} s, {1:.0f} votes/s, {2} votes lost, {3} duplicates accepted'.format(
+        elapsed, votes / elapsed, votes - stored, duplicates))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark concurrent votes',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--backend', choices=('sqlite', 'mysql'), default='sqlite', help='Database backend')
+    parser.add_argument('-c', dest='conf', default=None, help='Configuration file, e.g. for the [mysql] section')
+    parser.add_argument('--comments', type=int, default=4, help='Number of hot comments')
+    parser.add_argument('--votes', type=int, default=140, help='Number of votes per comment')
+    parser.add_argument('--workers', type=int, default=16, help='Number of concurrent voters')
+    parser.add_argument('--buffer', action='store_true', help='Buffer votes in memory, see [votes] buffer')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
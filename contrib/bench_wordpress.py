@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+Measure the WordPress importer on a generated WXR dump with deep reply
+chains.
+
+The dump contains a few posts with many comments each. Comments form reply
+chains of the given depth and comment ids are shuffled, so replies often
+precede their parent in id order, which is what made the old importer scan
+the list of pending comments once per comment.
+
+Usage:
+
+    contrib/bench_wordpress.py
+    contrib/bench_wordpress.py --posts 2 --comments 20000 --depth 100
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from xml.sax.saxutils import escape
+
+from isso import config
+from isso.db import SQLite3
+from isso.migrate import WordPress
+
+HEADER = u"""<?xml version="1.0" encoding="UTF-8"?>
+<rss version="2.0" xmlns:wp="http://wordpress.org/export/1.2/">
+<channel>
+"""
+
+COMMENT = u"""<wp:comment>
+<wp:comment_id>{id}</wp:comment_id>
+<wp:comment_author>Author {id}</wp:comment_author>
+<wp:comment_author_email>user{id}@example.org</wp:comment_author_email>
+<wp:comment_author_url></wp:comment_author_url>
+<wp:comment_author_IP>10.0.{ip}.1</wp:comment_author_IP>
+<wp:comment_date_gmt>2014-04-29 15:21:35</wp:comment_date_gmt>
+<wp:comment_content>{text}</wp:comment_content>
+<wp:comment_approved>1</wp:comment_approved>
+<wp:comment_parent>{parent}</wp:comment_parent>
+</wp:comment>
+"""
+
+
+def generate(fh, args):
+    fh.write(HEADER)
+    for post in range(args.posts):
+        fh.write(u"<item>\n<title>Post {0}</title>\n<link>http://example.org/{0}/</link>\n".format(post))
+
+        ids = list(range(1, args.comments + 1))
+        random.shuffle(ids)
+
+        for i, id in enumerate(ids):
+            # every chain starts with a top-level comment
+            parent = ids[i - 1] if i % args.depth else 0
+            fh.write(COMMENT.format(id=id, ip=id % 256, parent=parent,
+                                    text=escape(u"Lorem ipsum dolor sit amet %i" % id)))
+
+        fh.write(u"</item>\n")
+    fh.write(u"</channel>\n</rss>\n")
+
+
+def main():
+    args = parse_args()
+    random.seed(args.seed)
+
+    fd, xml = tempfile.mkstemp(suffix=".xml")
+    with os.fdopen(fd, "w") as fh:
+        generate(fh, args)
+
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+
+    try:
+        db = SQLite3(path, config.new({"general": {"dbpath": path, "max-age": "1h"}}))
+
+        start = time.perf_counter()
+        WordPress(db, xml).migrate()
+        elapsed = time.perf_counter() - start
+
+        count, replies = db.execute("SELECT COUNT(*), COUNT(parent) FROM comments").fetchone()
+    finally:
+        os.unlink(xml)
+        os.unlink(path)
+
+    print("{0} posts, {1} comments each, reply chains of depth {2}".format(
+        args.posts, args.comments, args.depth))
+    print("  imported {0} comments ({1} replies) in {2:.2f} s, {3:.0f} comments/s".format(
+        count, replies, elapsed, count / elapsed))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the WordPress importer with deep reply chains',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--posts', type=int, default=2, help='Number of posts')
+    parser.add_argument('--comments', type=int, default=10000, help='Number of comments per post')
+    parser.add_argument('--depth', type=int, default=100, help='Length of each reply chain')
+    parser.add_argument('--seed', type=int, default=42, help='Random seed of the comment ids')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
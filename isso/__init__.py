@@ -67,9 +67,9 @@ local = Local()
 local_manager = LocalManager([local])
 
 from isso import config, db, mysql, migrate, wsgi, ext, views
-from isso.core import ThreadedMixin, ProcessMixin, uWSGIMixin
+from isso.core import ThreadedMixin, ProcessMixin, uWSGIMixin, VoteBuffer, threaded
 from isso.wsgi import origin, urlsplit
-from isso.utils import http, JSONRequest, html, hash
+from isso.utils import http, JSONRequest, html, hash, remote_addr
 from isso.views import comments
 
 from isso.ext.notifications import Stdout, SMTP
@@ -82,27 +82,61 @@ logging.basicConfig(
 logger = logging.getLogger("isso")
 
 
+def connect(conf):
+    """Return the database backend configured in :param:`conf`, either MySQL
+    if a MySQL host is set or SQLite3."""
+
+    if conf.has_option("mysql", "host") and conf.get("mysql", "host") or os.getenv("MYSQL_HOST") is not None:
+        logger.info("Using mysql database connector")
+        rv = mysql.MySQL(conf)
+        logger.info("MySQL version: %s" % rv.version)
+    else:
+        logger.info("Using sqlite database connector")
+        rv = db.SQLite3(conf.get('general', 'dbpath'), conf)
+
+    return rv
+
+
 class Isso(object):
 
     def __init__(self, conf):
 
         self.conf = conf
 
-        if self.conf.has_option("mysql", "host") or os.getenv("MYSQL_HOST") is not None:
-            logger.info("Using mysql database connector")
-            self.db = mysql.MySQL(conf)
-            logger.info("MySQL version: %s" % self.db.version)
-        else:
-            logger.info("Using sqlite database connector")
-            self.db = db.SQLite3(conf.get('general', 'dbpath'), conf)
+        self.db = connect(conf)
 
         self.signer = URLSafeTimedSerializer(
             self.db.preferences.get("session-key"))
         self.markup = html.Markup(conf.section('markup'))
+
+        # store rendered HTML of comments saved without it (e.g. imported) or
+        # of all comments if the [markup] configuration has changed. Reads
+        # render comments without HTML themselves until the job has finished.
+        if self.db.preferences.get("markup") != self.markup.fingerprint:
+            self.db.comments.unrender()
+            self.db.preferences.set("markup", self.markup.fingerprint)
+        if self.db.comments.unrendered():
+            self.rerender()
+
         self.hasher = hash.new(conf.section("hash"))
 
+        # hash commenters of comments saved without hash (e.g. imported) or of
+        # all comments if the [hash] configuration has changed. Reads hash
+        # missing commenters themselves until the job has finished.
+        if self.db.preferences.get("hash") != self.hasher.fingerprint:
+            self.db.comments.unhash()
+            self.db.preferences.set("hash", self.hasher.fingerprint)
+        if self.db.comments.unhashed():
+            self.rehash()
+
         super(Isso, self).__init__(conf)
 
+        self.votes = None
+        if conf.getboolean("votes", "buffer"):
+            self.votes = VoteBuffer(
+                self.db, conf.getint("votes", "flush-interval") / 1000.0,
+                conf.getint("votes", "flush-size"))
+
         subscribers = []
         smtp_backend = False
         for backend in conf.getlist("general", "notify"):
@@ -125,6 +159,16 @@ class Isso(object):
     def render(self, text):
         return self.markup.render(text)
 
+    @threaded
+    def rerender(self):
+        rv = self.db.comments.render(self.render)
+        logger.info("rendered HTML of %i comments", rv)
+
+    @threaded
+    def rehash(self):
+        rv = self.db.comments.rehash(self.hasher.uhash)
+        logger.info("hashed commenters of %i comments", rv)
+
     def sign(self, obj):
         return self.signer.dumps(obj)
 
@@ -205,6 +249,19 @@ def make_app(conf=None, threading=True, multiprocessing=False, uwsgi=False):
         '/demo': join(dirname(__file__), 'demo/')
     }))
 
+    if isso.conf.getboolean("throttle", "enabled"):
+        trusted = list(isso.conf.getiter("server", "trusted-proxies"))
+        endpoints = {}
+        for name, (method, path) in comments.API.VIEWS:
+            if "<" not in path and isso.conf.has_option("throttle", name):
+                rate, burst = map(float, isso.conf.getlist("throttle", name))
+                if rate > 0:
+                    endpoints[method, path] = name, rate, max(burst, 1)
+
+        wrapper.append(partial(wsgi.TokenBucketMiddleware, endpoints=endpoints,
+                               key=lambda environ: remote_addr(wsgi.Request(environ), trusted),
+                               size=isso.conf.getint("throttle", "max-buckets")))
+
     wrapper.append(partial(wsgi.CORSMiddleware,
                            origin=origin(isso.conf.getiter("general", "host")),
                            allowed=("Origin", "Referer", "Content-Type"),
@@ -240,6 +297,10 @@ def main():
     # run Isso as stand-alone server
     subparser.add_parser("run", help="run server")
 
+    subparser.add_parser("recount", help="recompute comment counters of all threads")
+
+    subparser.add_parser("rehash", help="recompute commenter hashes of all comments")
+
     args = parser.parse_args()
     conf = config.load(
         join(dist.location, dist.project_name, "defaults.ini"), args.conf)
@@ -258,6 +319,19 @@ def main():
 
         sys.exit(0)
 
+    if args.command == "recount":
+        connect(conf).threads.recount()
+        sys.exit(0)
+
+    if args.command == "rehash":
+        hasher = hash.new(conf.section("hash"))
+        database = connect(conf)
+        database.comments.unhash()
+        database.preferences.set("hash", hasher.fingerprint)
+        logger.info("hashed commenters of %i comments",
+                    database.comments.rehash(hasher.uhash))
+        sys.exit(0)
+
     if conf.get("general", "log-file"):
         handler = logging.FileHandler(conf.get("general", "log-file"))
 
@@ -2,8 +2,12 @@
 
 from __future__ import print_function
 
+import os
+import zlib
 import time
+import atexit
 import logging
+import binascii
 import threading
 import multiprocessing
 
@@ -34,20 +38,197 @@ class Cache:
         self.cache = cache
 
     def get(self, cache, key):
-        return self.cache.get(key)
+        return self.cache.get((cache, key))
 
     def set(self, cache, key, value):
-        return self.cache.set(key, value)
+        return self.cache.set((cache, key), value)
 
     def delete(self, cache, key):
-        return self.cache.delete(key)
+        return self.cache.delete((cache, key))
+
+
+class ResponseCache(object):
+    """Cache serialized responses per thread. Responses are stored under a
+    random generation of their thread which is replaced on :meth:`invalidate`,
+    thus all responses of a thread expire at once.
+
+    Hits and misses are counted per process.
+    """
+
+    def __init__(self, cache, name="fetch"):
+        self.cache = cache
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, uri, key):
+        """Return the generation of thread :param:`uri` and the response
+        cached for :param:`key` or None. Pass the generation to :meth:`set`,
+        so that a response computed while the thread is invalidated expires
+        with the old generation."""
+
+        rv = None
+        gen = self.cache.get(self.name, b"gen:" + uri.encode("utf-8"))
+        if gen is None:
+            gen = binascii.hexlify(os.urandom(8))
+            self.cache.set(self.name, b"gen:" + uri.encode("utf-8"), gen)
+        else:
+            rv = self.cache.get(self.name, gen + b":" + key)
+
+        if rv is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+
+        return gen, rv
+
+    def set(self, gen, key, value):
+        self.cache.set(self.name, gen + b":" + key, value)
+
+    def invalidate(self, uri):
+        self.cache.delete(self.name, b"gen:" + uri.encode("utf-8"))
+
+
+class StripedLock(object):
+    """A fixed number of locks shared by all keys, ``locks[key]`` returns
+    the lock of :param:`key`. Unlike :func:`hash`, the stripe of a key is the
+    same in every process.
+    """
+
+    def __init__(self, factory=threading.Lock, stripes=64):
+        self.locks = [factory() for _ in range(stripes)]
+
+    def __getitem__(self, key):
+        return self.locks[zlib.crc32(key.encode("utf-8")) % len(self.locks)]
+
+
+class VoteBuffer(object):
+    """Aggregate the votes on comments in memory and write them to the
+    database in batches, so a burst of votes on a hot comment costs one
+    update instead of one read-modify-write cycle per vote.
+
+    A comment is read once and its voters are deduplicated against its
+    in-memory :class:`Bloomfilter`. :meth:`vote` returns the buffered totals
+    right away. Pending votes are written by a background thread every
+    :param:`interval` seconds, as soon as :param:`size` votes are pending
+    and at exit. :param:`flushed` is called with the thread id of each
+    comment written, e.g. to expire cached responses.
+
+    Each process buffers its own votes, with several processes a voter may
+    vote once per process until the votes have been written.
+    """
+
+    def __init__(self, db, interval=0.5, size=100, flushed=None):
+        self.db = db
+        self.interval = interval
+        self.size = size
+        self.flushed = flushed
+
+        self.lock = threading.Lock()
+        self.flushing = threading.Lock()
+        self.event = threading.Event()
+        self.pending = {}
+        self.count = 0
+        self.generation = 0
+        self.pid = None
+
+        atexit.register(self.flush)
+
+    def _start(self):
+        # lazily and once per process, forked workers don't inherit threads
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            thread.start_new_thread(self._run, ())
+
+    def _run(self):
+        while True:
+            self.event.wait(self.interval)
+            self.event.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("unable to write buffered votes")
+
+    def _load(self, id):
+        # wait for votes being written, their comments are read afresh
+        with self.flushing:
+            rv = self.db.comments.votes(id)
+            generation = self.generation
+        if rv is None:
+            return None, generation
+
+        tid, likes, dislikes, bf = rv
+        return {'tid': tid, 'likes': likes, 'dislikes': dislikes, 'voters': bf,
+                'delta': [0, 0]}, generation
+
+    def vote(self, upvote, id, remote_addr):
+        """Like :meth:`isso.db.comments.Comments.vote`, but buffered."""
+
+        loaded = None
+        while True:
+            self.lock.acquire()
+            self._start()
+            entry = self.pending.get(id)
+            if entry is None and loaded is not None and loaded[1] == self.generation:
+                entry = self.pending[id] = loaded[0]
+            if entry is not None:
+                break
+            self.lock.release()
+
+            # (re-)read the comment if it has been written meanwhile
+            loaded = self._load(id)
+            if loaded[0] is None:
+                return None
+
+        try:
+            delta = entry['delta']
+            likes, dislikes = entry['likes'] + delta[0], entry['dislikes'] + delta[1]
+
+            if remote_addr in entry['voters']:
+                return {'likes': likes, 'dislikes': dislikes}
+
+            entry['voters'].add(remote_addr)
+            delta[0 if upvote else 1] += 1
+            self.count += 1
+            if self.count >= self.size:
+                self.event.set()
+        finally:
+            self.lock.release()
+
+        if upvote:
+            return {'likes': likes + 1, 'dislikes': dislikes}
+        return {'likes': likes, 'dislikes': dislikes + 1}
+
+    def flush(self):
+        """Write the pending votes, returns the number of votes written."""
+
+        with self.flushing:
+            with self.lock:
+                pending, self.pending, self.count = self.pending, {}, 0
+                self.generation += 1
+
+            count, threads = 0, set()
+            for id, entry in pending.items():
+                likes, dislikes = entry['delta']
+                if likes or dislikes:
+                    self.db.comments.add_votes(id, likes, dislikes, entry['voters'])
+                    count += likes + dislikes
+                    threads.add(entry['tid'])
+
+        if self.flushed is not None:
+            for tid in threads:
+                self.flushed(tid)
+
+        return count
 
 
 class Mixin(object):
 
     def __init__(self, conf):
         self.lock = threading.Lock()
+        self.locks = StripedLock()
         self.cache = Cache(NullCache())
+        self.responses = ResponseCache(Cache(NullCache()))
 
     def notify(self, subject, body, retries=5):
         pass
@@ -74,6 +255,8 @@ class ThreadedMixin(Mixin):
             self.purge(conf.getint("moderation", "purge-after"))
 
         self.cache = Cache(SimpleCache(threshold=1024, default_timeout=3600))
+        self.responses = ResponseCache(
+            Cache(SimpleCache(threshold=1024, default_timeout=3600)))
 
     @threaded
     def purge(self, delta):
@@ -89,6 +272,10 @@ class ProcessMixin(ThreadedMixin):
 
         super(ProcessMixin, self).__init__(conf)
         self.lock = multiprocessing.Lock()
+        self.locks = StripedLock(multiprocessing.Lock)
+
+        # cached responses can't be invalidated in the other processes
+        self.responses = ResponseCache(Cache(NullCache()))
 
 
 class uWSGICache(object):
@@ -97,6 +284,7 @@ class uWSGICache(object):
     .. code-block:: ini
 
         cache2 = name=hash,items=1024,blocksize=32
+        cache2 = name=fetch,items=1024,blocksize=65536
 
     """
 
@@ -106,7 +294,7 @@ class uWSGICache(object):
 
     @classmethod
     def set(self, cache, key, value):
-        uwsgi.cache_set(key, value, 3600, cache)
+        uwsgi.cache_update(key, value, 3600, cache)
 
     @classmethod
     def delete(self, cache, key):
@@ -120,7 +308,9 @@ class uWSGIMixin(Mixin):
         super(uWSGIMixin, self).__init__(conf)
 
         self.lock = multiprocessing.Lock()
+        self.locks = StripedLock(multiprocessing.Lock)
         self.cache = uWSGICache
+        self.responses = ResponseCache(uWSGICache)
 
         timedelta = conf.getint("moderation", "purge-after")
 
@@ -1,11 +1,26 @@
 # -*- encoding: utf-8 -*-
 
+import os
+import re
 import sqlite3
 import logging
 import operator
 import os.path
+import threading
+import weakref
 
 from collections import defaultdict
+from contextlib import contextmanager
+
+try:
+    from backports.configparser import NoOptionError, NoSectionError
+except ImportError:
+    from configparser import NoOptionError, NoSectionError
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 logger = logging.getLogger("isso")
 
@@ -15,6 +30,84 @@ from isso.db.comments import Comments
 from isso.db.threads import Threads
 from isso.db.spam import Guard
 from isso.db.preferences import Preferences
+from isso.db.writer import Writer
+
+
+class Cursor(object):
+    """A fully fetched result of a single statement, detached from the
+    connection it was executed on. Mimics the parts of :class:`sqlite3.Cursor`
+    used throughout Isso.
+    """
+
+    def __init__(self, cursor):
+        self.rows = cursor.fetchall() if cursor.description else []
+        self.rowcount = cursor.rowcount
+        self.lastrowid = cursor.lastrowid
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self):
+        return self.rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+
+class Pool(object):
+    """A pool of long-lived SQLite connections.
+
+    Connections are checked out for a single statement or transaction and
+    returned afterwards. At most :param:`size` idle connections are kept
+    open, surplus connections are closed as soon as they are returned.
+    Connections inherited from a parent process (e.g. uWSGI's pre-forking
+    master) are never reused.
+
+    Each new connection is set up with :param:`pragmas`, a list of
+    `(name, value)` pairs.
+    """
+
+    def __init__(self, path, size=5, pragmas=()):
+        self.path = path
+        self.size = size
+        self.pragmas = pragmas
+        self.pid = os.getpid()
+        self.idle = queue.LifoQueue()
+
+    def connect(self):
+        con = sqlite3.connect(
+            self.path, isolation_level=None, check_same_thread=False)
+        for name, value in self.pragmas:
+            con.execute("PRAGMA %s = %s" % (name, value)).fetchall()
+        return con
+
+    @contextmanager
+    def connection(self):
+
+        if self.pid != os.getpid():
+            self.pid, self.idle = os.getpid(), queue.LifoQueue()
+
+        try:
+            con = self.idle.get_nowait()
+        except queue.Empty:
+            con = self.connect()
+
+        try:
+            yield con
+        finally:
+            if con.in_transaction:
+                con.rollback()
+            if self.idle.qsize() < self.size:
+                self.idle.put(con)
+            else:
+                con.close()
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
 
 
 class SQLite3:
@@ -22,15 +115,51 @@ class SQLite3:
 
     Runs migration if `user_version` is older than `MAX_VERSION` and register
     a trigger for automated orphan removal.
+
+    Statements are executed on pooled connections in autocommit mode, use
+    :meth:`transaction` to group several statements. Write operations (see
+    :meth:`write`) are optionally committed in groups by a :class:`Writer`.
     """
 
-    MAX_VERSION = 3
+    MAX_VERSION = 6
+
+    # PRAGMAs applied to every connection, configured in the [sqlite]
+    # section, with their defaults if the option is missing. The busy
+    # timeout comes first, changing the journal mode requires a lock.
+    pragmas = [
+        ("busy_timeout", "busy-timeout", "getint", 5000),
+        ("journal_mode", "journal-mode", "get", "wal"),
+        ("synchronous", "synchronous", "get", "normal"),
+        ("cache_size", "cache-size", "getint", 16000),
+        ("mmap_size", "mmap-size", "getint", 67108864),
+        ("temp_store", "temp-store", "get", "memory")]
 
     def __init__(self, path, conf):
 
         self.path = os.path.expanduser(path)
         self.conf = conf
 
+        pragmas = []
+        for (name, key, getter, default) in SQLite3.pragmas:
+            value = self.option(key, getter, default)
+            if name == "cache_size":
+                value = -value  # in KiB rather than pages
+            if not re.match(r"^-?\w+$", str(value)):
+                raise ValueError("invalid value for [sqlite] %s: %r" % (key, value))
+            pragmas.append((name, value))
+
+        self.pool = Pool(self.path, self.option("pool-size", "getint", 5), pragmas)
+        self.local = threading.local()
+
+        self.writer = None
+        if self.option("write-queue", "getboolean", False):
+            self.writer = Writer(
+                self, self.option("write-batch-size", "getint", 64),
+                self.option("write-latency", "getint", 2) / 1000.0)
+
+        # close pooled connections when garbage-collected or on exit
+        weakref.finalize(self, self.pool.close)
+
         rv = self.execute([
             "SELECT name FROM sqlite_master"
             "   WHERE type='table' AND name IN ('threads', 'comments', 'preferences')"]
@@ -42,24 +171,138 @@ class SQLite3:
         self.guard = Guard(self)
 
         if rv is None:
+            for sql in Comments.indexes:
+                self.execute(sql)
             self.execute("PRAGMA user_version = %i" % SQLite3.MAX_VERSION)
         else:
             self.migrate(to=SQLite3.MAX_VERSION)
 
+        # add comment counters to threads created before they were introduced
+        columns = [row[1] for row in self.execute("PRAGMA table_info(threads)")]
+        recount = "published" not in columns
+        for column in Threads.counters:
+            if column.split()[0] not in columns:
+                self.execute("ALTER TABLE threads ADD COLUMN " + column)
+
         self.execute([
             'CREATE TRIGGER IF NOT EXISTS remove_stale_threads',
             'AFTER DELETE ON comments',
             'BEGIN',
-            '    DELETE FROM threads WHERE id NOT IN (SELECT tid FROM comments);',
+            '    DELETE FROM threads WHERE id = OLD.tid AND NOT EXISTS (',
+            '        SELECT 1 FROM comments WHERE tid = OLD.tid);',
             'END'])
 
+        self.execute([
+            'CREATE TRIGGER IF NOT EXISTS thread_counters_insert',
+            'AFTER INSERT ON comments',
+            'BEGIN',
+            '    UPDATE threads SET',
+            '        published = published + (NEW.mode = 1),',
+            '        pending = pending + (NEW.mode = 2),',
+            '        last_activity = MAX(IFNULL(last_activity, 0), NEW.created)',
+            '    WHERE id = NEW.tid;',
+            'END'])
+
+        self.execute([
+            'CREATE TRIGGER IF NOT EXISTS thread_counters_update',
+            'AFTER UPDATE OF mode, modified ON comments',
+            'BEGIN',
+            '    UPDATE threads SET',
+            '        published = published - (OLD.mode = 1) + (NEW.mode = 1),',
+            '        pending = pending - (OLD.mode = 2) + (NEW.mode = 2),',
+            '        last_activity = MAX(IFNULL(last_activity, 0), IFNULL(NEW.modified, 0))',
+            '    WHERE id = NEW.tid;',
+            'END'])
+
+        self.execute([
+            'CREATE TRIGGER IF NOT EXISTS thread_counters_delete',
+            'AFTER DELETE ON comments',
+            'BEGIN',
+            '    UPDATE threads SET',
+            '        published = published - (OLD.mode = 1),',
+            '        pending = pending - (OLD.mode = 2)',
+            '    WHERE id = OLD.tid;',
+            'END'])
+
+        for (event, row) in (('INSERT', 'NEW'), ('UPDATE', 'NEW'), ('DELETE', 'OLD')):
+            self.execute([
+                'CREATE TRIGGER IF NOT EXISTS thread_version_' + event.lower(),
+                'AFTER ' + event + ' ON comments',
+                'BEGIN',
+                '    UPDATE threads SET',
+                '        version = version + 1,',
+                "        changed = (julianday('now') - 2440587.5) * 86400.0",
+                '    WHERE id = ' + row + '.tid;',
+                'END'])
+
+        if recount:
+            logger.info("compute comment counters for all threads")
+            self.threads.recount()
+
+        logger.info("sqlite %s, %s", sqlite3.sqlite_version, ", ".join(
+            "%s=%s" % (name, self.execute("PRAGMA " + name).fetchone()[0])
+            for (name, key, getter, default) in SQLite3.pragmas))
+
+    def option(self, key, getter, default):
+        """Return the [sqlite] option :param:`key` read with the
+        configuration's :param:`getter` method, or :param:`default` if the
+        option is missing."""
+
+        try:
+            return getattr(self.conf, getter)("sqlite", key)
+        except (NoSectionError, NoOptionError):
+            return default
+
     def execute(self, sql, args=()):
 
         if isinstance(sql, (list, tuple)):
             sql = ' '.join(sql)
 
-        with sqlite3.connect(self.path) as con:
-            return con.execute(sql, args)
+        con = getattr(self.local, "con", None)
+        if con is not None:
+            return Cursor(con.execute(sql, args))
+
+        with self.pool.connection() as con:
+            return Cursor(con.execute(sql, args))
+
+    @contextmanager
+    def transaction(self):
+        """Run all statements issued by the current thread within a single
+        transaction on one connection. Nested calls join the outer
+        transaction.
+        """
+
+        if getattr(self.local, "con", None) is not None:
+            yield self.local.con
+            return
+
+        with self.pool.connection() as con:
+            con.execute("BEGIN IMMEDIATE")
+            self.local.con = con
+            try:
+                yield con
+            except BaseException:
+                if con.in_transaction:
+                    con.execute("ROLLBACK")
+                raise
+            else:
+                con.execute("COMMIT")
+            finally:
+                self.local.con = None
+
+    def write(self, func, *args, **kwargs):
+        """Run the write operation :param:`func` with the given arguments
+        and return its result. Unless the current thread is in a transaction
+        already, the operation is run by :attr:`writer` if enabled.
+        """
+
+        if self.writer is None or getattr(self.local, "con", None) is not None:
+            return func(*args, **kwargs)
+
+        return self.writer.submit(func, *args, **kwargs).result()
+
+    def dispose(self):
+        self.pool.close()
 
     @property
     def version(self):
@@ -79,21 +322,23 @@ class SQLite3:
             from isso.utils import Bloomfilter
             bf = buffer(Bloomfilter(iterable=["127.0.0.0"]).array)
 
-            with sqlite3.connect(self.path) as con:
+            with self.transaction() as con:
+                changes = con.total_changes
                 con.execute('UPDATE comments SET voters=?', (bf, ))
                 con.execute('PRAGMA user_version = 1')
-                logger.info("%i rows changed", con.total_changes)
+                logger.info("%i rows changed", con.total_changes - changes)
 
         # move [general] session-key to database
         if self.version == 1:
 
-            with sqlite3.connect(self.path) as con:
+            with self.transaction() as con:
+                changes = con.total_changes
                 if self.conf.has_option("general", "session-key"):
                     con.execute('UPDATE preferences SET value=? WHERE key=?', (
                         self.conf.get("general", "session-key"), "session-key"))
 
                 con.execute('PRAGMA user_version = 2')
-                logger.info("%i rows changed", con.total_changes)
+                logger.info("%i rows changed", con.total_changes - changes)
 
         # limit max. nesting level to 1
         if self.version == 2:
@@ -101,7 +346,8 @@ class SQLite3:
             def first(rv):
                 return list(map(operator.itemgetter(0), rv))
 
-            with sqlite3.connect(self.path) as con:
+            with self.transaction() as con:
+                changes = con.total_changes
                 top = first(con.execute(
                     "SELECT id FROM comments WHERE parent IS NULL").fetchall())
                 flattened = defaultdict(set)
@@ -122,4 +368,31 @@ class SQLite3:
                             "UPDATE comments SET parent=? WHERE id=?", (id, n))
 
                 con.execute('PRAGMA user_version = 3')
-                logger.info("%i rows changed", con.total_changes)
+                logger.info("%i rows changed", con.total_changes - changes)
+
+        # add secondary indexes, every lookup except by id was a table scan
+        if self.version == 3:
+
+            with self.transaction() as con:
+                for sql in Comments.indexes:
+                    con.execute(sql)
+
+                con.execute('PRAGMA user_version = 4')
+                logger.info("%i indexes created", len(Comments.indexes))
+
+        # only check the thread of the deleted comment for remaining comments
+        # instead of all threads, the trigger is re-created in __init__
+        if self.version == 4:
+
+            with self.transaction() as con:
+                con.execute('DROP TRIGGER IF EXISTS remove_stale_threads')
+                con.execute('PRAGMA user_version = 5')
+
+        # add the index on mode for purge and the removal of stale comments
+        if self.version == 5:
+
+            with self.transaction() as con:
+                for sql in Comments.indexes:
+                    con.execute(sql)
+
+                con.execute('PRAGMA user_version = 6')
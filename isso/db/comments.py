@@ -1,9 +1,14 @@
 # -*- encoding: utf-8 -*-
 
 import time
+import logging
+import sqlite3
 
 from isso.utils import Bloomfilter
 from isso.compat import buffer
+from isso.db.writer import write
+
+logger = logging.getLogger("isso")
 
 
 class Comments:
@@ -23,7 +28,36 @@ class Comments:
               'mode',  # status of the comment 1 = valid, 2 = pending,
                        # 4 = soft-deleted (cannot hard delete because of replies)
               'remote_addr', 'text', 'author', 'email', 'website',
-              'likes', 'dislikes', 'voters', 'notification']
+              'likes', 'dislikes', 'voters', 'notification',
+              'html',  # rendered text, see :meth:`render`
+              'hash']  # commenter identicon hash, see :meth:`rehash`
+
+    # columns read per use case, the voters blob is only read by :meth:`votes`.
+    # The public projection (threads, feeds) returns the remote address only
+    # of comments without hash, to hash them on the fly, and the email for
+    # those and gravatar images.
+    projections = {
+        'full': [f for f in fields if f != 'voters'],
+        'public': ['tid', 'id', 'parent', 'created', 'modified', 'mode',
+                   'text', 'author', 'website', 'likes', 'dislikes',
+                   'notification', 'html', 'hash', 'email', 'remote_addr'],
+        'admin': ['tid', 'id', 'parent', 'created', 'modified', 'mode',
+                  'remote_addr', 'text', 'author', 'email', 'website',
+                  'likes', 'dislikes', 'html'],
+        'notification': ['tid', 'id', 'parent', 'mode', 'email', 'notification']}
+
+    # secondary indexes for the access paths of :meth:`fetch`,
+    # :meth:`is_previously_approved_author`, :meth:`_remove_stale`,
+    # :meth:`purge` and the spam guard, created by
+    # :meth:`isso.db.SQLite3.migrate`. The tid column has no type affinity,
+    # lookups must compare it to `+threads.id` (which drops the INTEGER
+    # affinity of threads.id) to be able to use the index.
+    indexes = [
+        'CREATE INDEX IF NOT EXISTS comments_tid ON comments(tid, parent, created)',
+        'CREATE INDEX IF NOT EXISTS comments_parent ON comments(parent) WHERE parent IS NOT NULL',
+        'CREATE INDEX IF NOT EXISTS comments_remote_addr ON comments(remote_addr, created)',
+        'CREATE INDEX IF NOT EXISTS comments_email ON comments(email, mode, created)',
+        'CREATE INDEX IF NOT EXISTS comments_mode ON comments(mode, created)']
 
     def __init__(self, db):
 
@@ -34,44 +68,85 @@ class Comments:
             '    created FLOAT NOT NULL, modified FLOAT, mode INTEGER, remote_addr VARCHAR,',
             '    text VARCHAR, author VARCHAR, email VARCHAR, website VARCHAR,',
             '    likes INTEGER DEFAULT 0, dislikes INTEGER DEFAULT 0, voters BLOB NOT NULL,',
-            '    notification INTEGER DEFAULT 0);'])
+            '    notification INTEGER DEFAULT 0, html VARCHAR, hash VARCHAR);'])
         try:
             self.db.execute(['ALTER TABLE comments ADD COLUMN notification INTEGER DEFAULT 0;'])
         except Exception:
             pass
+        try:
+            self.db.execute(['ALTER TABLE comments ADD COLUMN html VARCHAR;'])
+        except Exception:
+            pass
+        try:
+            self.db.execute(['ALTER TABLE comments ADD COLUMN hash VARCHAR;'])
+        except Exception:
+            pass
 
+    @write
     def add(self, uri, c):
         """
         Add new comment to DB and return a mapping of :attribute:`fields` and
         database values.
         """
 
-        if c.get("parent") is not None:
-            ref = self.get(c["parent"])
-            if ref.get("parent") is not None:
-                c["parent"] = ref["parent"]
+        with self.db.transaction():
 
-        self.db.execute([
-            'INSERT INTO comments (',
-            '    tid, parent,'
-            '    created, modified, mode, remote_addr,',
-            '    text, author, email, website, voters, notification)',
-            'SELECT',
-            '    threads.id, ?,',
-            '    ?, ?, ?, ?,',
-            '    ?, ?, ?, ?, ?, ?',
-            'FROM threads WHERE threads.uri = ?;'], (
-            c.get('parent'),
-            c.get('created') or time.time(), None, c["mode"], c['remote_addr'],
-            c['text'], c.get('author'), c.get('email'), c.get('website'), buffer(
-                Bloomfilter(iterable=[c['remote_addr']]).array), c.get('notification'),
-            uri)
-        )
-
-        return dict(zip(Comments.fields, self.db.execute(
-            'SELECT *, MAX(c.id) FROM comments AS c INNER JOIN threads ON threads.uri = ?',
-            (uri, )).fetchone()))
+            if c.get("parent") is not None:
+                ref = self.get(c["parent"])
+                if ref.get("parent") is not None:
+                    c["parent"] = ref["parent"]
+
+            rv = self.db.execute([
+                'INSERT INTO comments (',
+                '    tid, parent,'
+                '    created, modified, mode, remote_addr,',
+                '    text, author, email, website, voters, notification, html, hash)',
+                'SELECT',
+                '    threads.id, ?,',
+                '    ?, ?, ?, ?,',
+                '    ?, ?, ?, ?, ?, ?, ?, ?',
+                'FROM threads WHERE threads.uri = ?;'], (
+                c.get('parent'),
+                c.get('created') or time.time(), None, c["mode"], c['remote_addr'],
+                c['text'], c.get('author'), c.get('email'), c.get('website'), buffer(
+                    Bloomfilter(iterable=[c['remote_addr']]).array), c.get('notification'),
+                c.get('html'), c.get('hash'), uri)
+            )
+
+            if rv.rowcount == 0:
+                return None
+
+            return self.get(rv.lastrowid)
+
+    def add_many(self, rows):
+        """
+        Add comments from :param:`rows`, pairs of an uri and a comment, in a
+        single transaction and return the number of added comments.
 
+        Unlike :meth:`add`, comments are inserted as-is: the comment id is
+        taken from the mapping (if any) and parents are neither looked up nor
+        flattened, that is up to the caller (see :mod:`isso.migrate`).
+        """
+
+        with self.db.transaction() as con:
+            return con.executemany(' '.join([
+                'INSERT INTO comments (',
+                '    tid, id, parent,'
+                '    created, modified, mode, remote_addr,',
+                '    text, author, email, website, voters, notification, html, hash)',
+                'SELECT',
+                '    threads.id, ?, ?,',
+                '    ?, ?, ?, ?,',
+                '    ?, ?, ?, ?, ?, ?, ?, ?',
+                'FROM threads WHERE threads.uri = ?;']), ((
+                    c.get('id'), c.get('parent'),
+                    c.get('created') or time.time(), c.get('modified'), c["mode"], c['remote_addr'],
+                    c['text'], c.get('author'), c.get('email'), c.get('website'), buffer(
+                        Bloomfilter(iterable=[c['remote_addr']]).array), c.get('notification'),
+                    c.get('html'), c.get('hash'), uri) for uri, c in rows)
+            ).rowcount
+
+    @write
     def activate(self, id):
         """
         Activate comment id if pending.
@@ -100,6 +175,7 @@ class Comments:
         else:
             return False
 
+    @write
     def unsubscribe(self, email, id):
         """
         Turn off email notifications for replies to this comment.
@@ -109,6 +185,7 @@ class Comments:
             '    notification=0',
             'WHERE email=? AND (id=? OR parent=?);'], (email, id, id))
 
+    @write
     def update(self, id, data):
         """
         Update comment :param:`id` with values from :param:`data` and return
@@ -122,15 +199,110 @@ class Comments:
 
         return self.get(id)
 
-    def get(self, id):
+    def render(self, render, force=False):
+        """
+        Store the HTML returned by :param:`render` for the text of comments
+        without HTML or, if :param:`force` is set, of all comments. Returns
+        the number of rendered comments.
+        """
+        return self._derive('html', 'text', render, force)
+
+    def unrender(self):
+        """
+        Forget the HTML of all comments, see :meth:`render`.
         """
-        Search for comment :param:`id` and return a mapping of :attr:`fields`
-        and values.
+        self.db.execute('UPDATE comments SET html=NULL')
+
+    def unrendered(self):
         """
+        Return the number of comments without HTML.
+        """
+        return self.db.execute(
+            'SELECT COUNT(*) FROM comments WHERE html IS NULL').fetchone()[0]
+
+    def rehash(self, hash):
+        """
+        Store the commenter hash, :param:`hash` of the email address or else
+        the remote address, of comments without. Returns the number of hashed
+        comments.
+        """
+        cache = {}
+
+        def memoized(key):
+            if key not in cache:
+                cache[key] = hash(key)
+            return cache[key]
+
+        return self._derive(
+            'hash', "COALESCE(NULLIF(email, ''), remote_addr)", memoized)
+
+    def unhash(self):
+        """
+        Forget the commenter hash of all comments, see :meth:`rehash`.
+        """
+        self.db.execute('UPDATE comments SET hash=NULL')
+
+    def unhashed(self):
+        """
+        Return the number of comments without commenter hash.
+        """
+        return self.db.execute(
+            'SELECT COUNT(*) FROM comments WHERE hash IS NULL').fetchone()[0]
+
+    def _derive(self, column, source, func, force=False):
+        """
+        Set :param:`column` to :param:`func` of the :param:`source` expression
+        in batches, for rows where it is NULL or for all rows if :param:`force`
+        is set. Returns the number of updated rows.
+
+        Rows are only updated if their source is unchanged, an edit between
+        reading and updating a batch has stored the derived value itself.
+        """
+        sql = ['SELECT id, ' + source + ' FROM comments WHERE id > ?']
+        update = ['UPDATE comments SET ' + column + '=?',
+                  'WHERE id=? AND ' + source + ' IS ?']
+        if not force:
+            sql.append('AND ' + column + ' IS NULL')
+            update.append('AND ' + column + ' IS NULL')
+        sql.append('ORDER BY id LIMIT 1000')
+
+        last, count = 0, 0
+        while True:
+            rv = self.db.execute(sql, (last, )).fetchall()
+            if not rv:
+                return count
+
+            with self.db.transaction() as con:
+                count += con.executemany(
+                    ' '.join(update),
+                    [(func(value), id, value) for (id, value) in rv]).rowcount
+
+            last = rv[-1][0]
+
+    @classmethod
+    def select(cls, projection, table='comments'):
+        """
+        Return the fields of :param:`projection` (see :attr:`projections`)
+        and the corresponding SELECT list for the comments :param:`table`.
+        """
+        fields = cls.projections[projection]
+        columns = [table + '.' + f for f in fields]
+        if projection == 'public':
+            columns = ['CASE WHEN {0}.hash IS NULL THEN {1} END AS {2}'.format(table, c, f)
+                       if f == 'remote_addr' else c
+                       for f, c in zip(fields, columns)]
+        return fields, ', '.join(columns)
+
+    def get(self, id, projection='full'):
+        """
+        Search for comment :param:`id` and return a mapping of the fields of
+        :param:`projection` and values.
+        """
+        fields, columns = self.select(projection)
         rv = self.db.execute(
-            'SELECT * FROM comments WHERE id=?', (id, )).fetchone()
+            'SELECT ' + columns + ' FROM comments WHERE id=?', (id, )).fetchone()
         if rv:
-            return dict(zip(Comments.fields, rv))
+            return dict(zip(fields, rv))
 
         return None
 
@@ -148,12 +320,8 @@ class Comments:
         """
         Return comments for admin with :param:`mode`.
         """
-        fields_comments = ['tid', 'id', 'parent', 'created', 'modified',
-                           'mode', 'remote_addr', 'text', 'author',
-                           'email', 'website', 'likes', 'dislikes']
+        fields_comments, sql_comments_fields = self.select('admin')
         fields_threads = ['uri', 'title']
-        sql_comments_fields = ', '.join(['comments.' + f
-                                         for f in fields_comments])
         sql_threads_fields = ', '.join(['threads.' + f
                                         for f in fields_threads])
         sql = ['SELECT ' + sql_comments_fields + ', ' + sql_threads_fields + ' '
@@ -192,12 +360,14 @@ class Comments:
             yield dict(zip(fields_comments + fields_threads, item))
 
     def fetch(self, uri, mode=5, after=0, parent='any',
-              order_by='id', asc=1, limit=None):
+              order_by='id', asc=1, limit=None, projection='public'):
         """
-        Return comments for :param:`uri` with :param:`mode`.
+        Return comments for :param:`uri` with :param:`mode`, mappings of the
+        fields of :param:`projection` and values.
         """
-        sql = ['SELECT comments.* FROM comments INNER JOIN threads ON',
-               '    threads.uri=? AND comments.tid=threads.id AND (? | comments.mode) = ?',
+        fields, columns = self.select(projection)
+        sql = ['SELECT ' + columns + ' FROM comments WHERE',
+               '    comments.tid=+(SELECT id FROM threads WHERE uri=?) AND (? | comments.mode) = ?',
                '    AND comments.created>?']
 
         sql_args = [uri, mode, mode, after]
@@ -213,7 +383,7 @@ class Comments:
         if order_by not in ['id', 'created', 'modified', 'likes', 'dislikes']:
             order_by = 'id'
         sql.append('ORDER BY ')
-        sql.append(order_by)
+        sql.append('comments.' + order_by)
         if not asc:
             sql.append(' DESC')
 
@@ -223,23 +393,95 @@ class Comments:
 
         rv = self.db.execute(sql, sql_args).fetchall()
         for item in rv:
-            yield dict(zip(Comments.fields, item))
+            yield dict(zip(fields, item))
+
+    def fetch_tree(self, uri, limit=None, nested_limit=None, after=0,
+                   order_by='id', asc=1, mode=5, projection='public'):
+        """
+        Return top-level comments for :param:`uri` and their replies as a
+        tuple of a list and a mapping of parent ids to lists of replies, see
+        :meth:`fetch` for :param:`projection`.
+
+        At most :param:`limit` top-level comments and :param:`nested_limit`
+        replies per top-level comment are returned, both are fetched in one
+        query each instead of one query per top-level comment.
+        """
+
+        # custom sanitization
+        if order_by not in ['id', 'created', 'modified', 'likes', 'dislikes']:
+            order_by = 'id'
+        order = 'comments.' + order_by + ('' if asc else ' DESC')
+
+        fields, columns = self.select(projection)
+        sql = ['FROM comments WHERE',
+               '    comments.tid=+(SELECT id FROM threads WHERE uri=?) AND (? | comments.mode) = ?',
+               '    AND comments.created>? AND comments.parent IS NULL',
+               'ORDER BY ' + order]
+        sql_args = [uri, mode, mode, after]
+
+        if limit is not None:
+            sql.append('LIMIT ?')
+            sql_args.append(limit)
+
+        roots = [dict(zip(fields, item)) for item in self.db.execute(
+            ['SELECT ' + columns] + sql, sql_args).fetchall()]
+        replies = {}
+
+        if not roots or nested_limit is not None and nested_limit <= 0:
+            return roots, replies
+
+        # window functions are available since SQLite 3.25
+        if sqlite3.sqlite_version_info < (3, 25, 0):
+            for root in roots:
+                replies[root['id']] = list(self.fetch(
+                    uri, mode, after, root['id'], order_by, asc, nested_limit, projection))
+            return roots, replies
+
+        sql = ['SELECT * FROM (',
+               '    SELECT ' + columns + ', ROW_NUMBER() OVER (',
+               '        PARTITION BY comments.parent ORDER BY ' + order + ') AS n',
+               '    FROM comments INNER JOIN (SELECT comments.id ' + ' '.join(sql),
+               '    ) AS roots ON comments.parent=roots.id',
+               '    WHERE comments.tid=+(SELECT id FROM threads WHERE uri=?) AND (? | comments.mode) = ?',
+               '        AND comments.created>?',
+               ')']
+        sql_args = sql_args + [uri, mode, mode, after]
+
+        if nested_limit is not None:
+            sql.append('WHERE n <= ?')
+            sql_args.append(nested_limit)
+
+        sql.append('ORDER BY parent, n')
+
+        for item in self.db.execute(sql, sql_args).fetchall():
+            item = dict(zip(fields, item[:-1]))
+            replies.setdefault(item['parent'], []).append(item)
+
+        return roots, replies
 
     def _remove_stale(self):
+        """
+        Remove soft-deleted comments without replies, and soft-deleted
+        top-level comments whose replies are all removed along with them.
+        Comments are nested one level deep at most (see :meth:`add`), hence
+        a single pass suffices. Returns the number of removed comments.
+
+        Called after every removal of comments, which may have removed their
+        thread as well (see the remove_stale_threads trigger), hence the
+        cached threads are dropped.
+        """
 
-        sql = ('DELETE FROM',
-               '    comments',
-               'WHERE',
-               '    mode=4 AND id NOT IN (',
-               '        SELECT',
-               '            parent',
-               '        FROM',
-               '            comments',
-               '        WHERE parent IS NOT NULL)')
+        rv = self.db.execute([
+            'DELETE FROM comments WHERE mode = 4 AND NOT EXISTS (',
+            '    SELECT 1 FROM comments AS reply WHERE reply.parent = comments.id',
+            '    AND (reply.mode != 4 OR EXISTS (',
+            '        SELECT 1 FROM comments AS r WHERE r.parent = reply.id)))']
+        ).rowcount
 
-        while self.db.execute(sql).rowcount:
-            continue
+        self.db.threads.discard()
+        return rv
 
+    @write
     def delete(self, id):
         """
         Delete a comment. There are two distinctions: a comment is referenced
@@ -252,7 +494,7 @@ class Comments:
         effects."""
 
         refs = self.db.execute(
-            'SELECT * FROM comments WHERE parent=?', (id, )).fetchone()
+            'SELECT 1 FROM comments WHERE parent=?', (id, )).fetchone()
 
         if refs is None:
             self.db.execute('DELETE FROM comments WHERE id=?', (id, ))
@@ -268,45 +510,89 @@ class Comments:
         self._remove_stale()
         return self.get(id)
 
-    def vote(self, upvote, id, remote_addr):
-        """+1 a given comment. Returns the new like count (may not change because
-        the creater can't vote on his/her own comment and multiple votes from the
-        same ip address are ignored as well)."""
-
+    def votes(self, id):
+        """
+        Return the thread id, likes, dislikes and the voters
+        :class:`Bloomfilter` of comment :param:`id`, or None.
+        """
         rv = self.db.execute(
-            'SELECT likes, dislikes, voters FROM comments WHERE id=?', (id, )) \
+            'SELECT tid, likes, dislikes, voters FROM comments WHERE id=?', (id, )) \
             .fetchone()
 
         if rv is None:
             return None
 
-        likes, dislikes, voters = rv
-        if likes + dislikes >= 142:
-            return {'likes': likes, 'dislikes': dislikes}
+        tid, likes, dislikes, voters = rv
+        return tid, likes, dislikes, Bloomfilter(bytearray(voters), likes + dislikes)
 
-        bf = Bloomfilter(bytearray(voters), likes + dislikes)
-        if remote_addr in bf:
-            return {'likes': likes, 'dislikes': dislikes}
+    @write
+    def vote(self, upvote, id, remote_addr):
+        """+1 a given comment. Returns the new like count (may not change because
+        the creater can't vote on his/her own comment and multiple votes from the
+        same ip address are ignored as well).
 
-        bf.add(remote_addr)
-        self.db.execute([
-            'UPDATE comments SET',
-            '    likes = likes + 1,' if upvote else 'dislikes = dislikes + 1,',
-            '    voters = ?'
-            'WHERE id=?;'], (buffer(bf.array), id))
+        The vote is a compare-and-swap: the update only applies if the vote
+        counts are still the ones the voters blob has been read with, else
+        the vote is retried with the updated blob. Every retry implies another
+        successful vote, so this terminates."""
+
+        while True:
+            rv = self.votes(id)
+            if rv is None:
+                return None
+
+            tid, likes, dislikes, bf = rv
+            if remote_addr in bf:
+                return {'likes': likes, 'dislikes': dislikes}
+
+            bf.add(remote_addr)
+            rv = self.db.execute([
+                'UPDATE comments SET',
+                '    likes = likes + 1,' if upvote else 'dislikes = dislikes + 1,',
+                '    voters = ?',
+                'WHERE id=? AND likes=? AND dislikes=?;'],
+                (buffer(bf.array), id, likes, dislikes))
+
+            if rv.rowcount:
+                break
 
         if upvote:
             return {'likes': likes + 1, 'dislikes': dislikes}
         return {'likes': likes, 'dislikes': dislikes + 1}
 
+    @write
+    def add_votes(self, id, likes, dislikes, voters):
+        """
+        Add :param:`likes`, :param:`dislikes` and the :param:`voters`
+        Bloomfilter (merged with the stored one) to comment :param:`id`, see
+        :class:`isso.core.VoteBuffer`. Returns the new vote counts.
+        """
+
+        while True:
+            rv = self.votes(id)
+            if rv is None:
+                return None
+
+            tid, l, d, bf = rv
+            bf.update(voters)
+
+            rv = self.db.execute([
+                'UPDATE comments SET',
+                '    likes = likes + ?, dislikes = dislikes + ?, voters = ?',
+                'WHERE id=? AND likes=? AND dislikes=?;'],
+                (likes, dislikes, buffer(bf.array), id, l, d))
+
+            if rv.rowcount:
+                return {'likes': l + likes, 'dislikes': d + dislikes}
+
     def reply_count(self, url, mode=5, after=0):
         """
         Return comment count for main thread and all reply threads for one url.
         """
 
         sql = ['SELECT comments.parent,count(*)',
-               'FROM comments INNER JOIN threads ON',
-               '   threads.uri=? AND comments.tid=threads.id AND',
+               'FROM comments WHERE',
+               '   comments.tid=+(SELECT id FROM threads WHERE uri=?) AND',
                '   (? | comments.mode = ?) AND',
                '   comments.created > ?',
                'GROUP BY comments.parent']
@@ -318,19 +604,43 @@ class Comments:
         Return comment count for one ore more urls..
         """
 
-        threads = dict(self.db.execute([
-            'SELECT threads.uri, COUNT(comments.id) FROM comments',
-            'LEFT OUTER JOIN threads ON threads.id = tid AND comments.mode = 1',
-            'GROUP BY threads.uri'
-        ]).fetchall())
+        threads = {}
+
+        # SQLite limits the number of host parameters per statement
+        for i in range(0, len(urls), 500):
+            chunk = urls[i:i + 500]
+            threads.update(self.db.execute([
+                'SELECT uri, published FROM threads',
+                'WHERE uri IN (' + ', '.join('?' * len(chunk)) + ')'
+            ], chunk).fetchall())
 
         return [threads.get(url, 0) for url in urls]
 
-    def purge(self, delta):
+    def purge(self, delta, chunk=1000):
         """
-        Remove comments older than :param:`delta`.
+        Remove pending comments older than :param:`delta` and soft-deleted
+        comments no longer referenced. Pending comments are removed at most
+        :param:`chunk` at a time, each chunk in its own (short) transaction
+        so other requests are not locked out for the whole purge.
+
+        Returns a mapping with the number of removed `pending` and `stale`
+        comments as well as the `time` spent in seconds.
         """
-        self.db.execute([
-            'DELETE FROM comments WHERE mode = 2 AND ? - created > ?;'
-        ], (time.time(), delta))
-        self._remove_stale()
+        start = time.time()
+        cutoff, pending = start - delta, 0
+
+        while True:
+            rv = self.db.write(lambda: self.db.execute([
+                'DELETE FROM comments WHERE id IN (',
+                '    SELECT id FROM comments WHERE mode = 2 AND created < ?',
+                '    LIMIT ?)'], (cutoff, chunk)).rowcount)
+            pending += rv
+            if rv < chunk:
+                break
+
+        stale = self.db.write(self._remove_stale)
+
+        rv = {'pending': pending, 'stale': stale, 'time': time.time() - start}
+        logger.info("purged %(pending)i pending and %(stale)i stale comments "
+                    "in %(time).3f s", rv)
+        return rv
@@ -33,4 +33,4 @@ class Preferences:
 
     def set(self, key, value):
         self.db.execute(
-            'INSERT INTO preferences (key, value) VALUES (?, ?)', (key, value))
+            'INSERT OR REPLACE INTO preferences (key, value) VALUES (?, ?)', (key, value))
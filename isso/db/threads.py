@@ -1,5 +1,11 @@
 # -*- encoding: utf-8 -*-
 
+import threading
+
+from collections import OrderedDict
+
+from isso.db.writer import write
+
 
 def Thread(id, uri, title):
     return {
@@ -10,25 +16,128 @@ def Thread(id, uri, title):
 
 
 class Threads(object):
+    """Threads and their comment counters. The counters `published` (mode 1)
+    and `pending` (mode 2) as well as the timestamp of the latest comment or
+    edit are maintained by triggers on the comments table, see
+    :class:`isso.db.SQLite3`. So are `version`, incremented on every change
+    to the thread's comments, and the time of that change.
+
+    Id and title of the most recently used threads are cached per process,
+    see :meth:`lookup`.
+    """
+
+    counters = ['published INTEGER DEFAULT 0', 'pending INTEGER DEFAULT 0',
+                'last_activity FLOAT', 'version INTEGER DEFAULT 0',
+                'changed FLOAT']
+
+    # number of threads cached by :meth:`lookup`
+    cache_size = 1024
 
     def __init__(self, db):
 
         self.db = db
         self.db.execute([
             'CREATE TABLE IF NOT EXISTS threads (',
-            '    id INTEGER PRIMARY KEY, uri VARCHAR(256) UNIQUE, title VARCHAR(256))'])
+            '    id INTEGER PRIMARY KEY, uri VARCHAR(256) UNIQUE, title VARCHAR(256),',
+            '    ' + ', '.join(Threads.counters) + ')'])
+
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
 
     def __contains__(self, uri):
-        return self.db.execute("SELECT title FROM threads WHERE uri=?", (uri, )) \
-                      .fetchone() is not None
+        return self.lookup(uri, cached=False) is not None
 
     def __getitem__(self, uri):
-        return Thread(*self.db.execute("SELECT * FROM threads WHERE uri=?", (uri, )).fetchone())
+        rv = self.lookup(uri)
+        if rv is None:
+            raise KeyError(uri)
+        return Thread(rv[0], uri, rv[1])
+
+    def lookup(self, uri, cached=True):
+        """
+        Return id and title of thread :param:`uri` or None if there is no
+        such thread. Threads found are kept in an LRU cache, which is
+        invalidated by :meth:`discard` when comments (and possibly their
+        thread) are removed, and revalidated by :meth:`version`.
+
+        The cache is per process: another process may remove the thread and
+        its id may be reused by a new thread. Callers must not trust a
+        cached id unless they check the uri as well, as :meth:`Comments.add`
+        does. With :param:`cached` set to False, the thread is queried and
+        its cache entry refreshed, as for `uri in threads`.
+        """
+        if cached:
+            with self.lock:
+                rv = self.cache.get(uri)
+                if rv is not None:
+                    self.cache.move_to_end(uri)
+                    return rv
+
+        rv = self.db.execute("SELECT id, title FROM threads WHERE uri=?", (uri, )).fetchone()
+        with self.lock:
+            if rv is None:
+                self.cache.pop(uri, None)
+            else:
+                rv = self.cache[uri] = tuple(rv)
+                self.cache.move_to_end(uri)
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return rv
+
+    def discard(self, id=None):
+        """
+        Drop thread :param:`id`, or all threads, from the cache of
+        :meth:`lookup`.
+        """
+        with self.lock:
+            if id is None:
+                self.cache.clear()
+            else:
+                for uri in [uri for uri, rv in self.cache.items() if rv[0] == id]:
+                    del self.cache[uri]
 
     def get(self, id):
-        return Thread(*self.db.execute("SELECT * FROM threads WHERE id=?", (id, )).fetchone())
+        """
+        Return thread :param:`id` or None if there is no such thread.
+        """
+        rv = self.db.execute(
+            "SELECT id, uri, title FROM threads WHERE id=?", (id, )).fetchone()
+        return Thread(*rv) if rv is not None else None
+
+    def version(self, uri=None):
+        """
+        Return id, version and time of the last change of thread :param:`uri`
+        or None if there is no such thread. Without :param:`uri`, return the
+        number of threads, the sum of their versions and the time of the last
+        change of any thread.
+        """
+        if uri is None:
+            return self.db.execute(
+                "SELECT COUNT(*), TOTAL(version), MAX(changed) FROM threads").fetchone()
+        rv = self.db.execute(
+            "SELECT id, version, changed FROM threads WHERE uri=?", (uri, )).fetchone()
 
+        # the thread may have been removed (and its id reused) by another process
+        with self.lock:
+            if uri in self.cache and (rv is None or self.cache[uri][0] != rv[0]):
+                del self.cache[uri]
+        return rv
+
+    @write
     def new(self, uri, title):
         self.db.execute(
-            "INSERT INTO threads (uri, title) VALUES (?, ?)", (uri, title))
+            "INSERT OR IGNORE INTO threads (uri, title) VALUES (?, ?)", (uri, title))
         return self[uri]
+
+    def recount(self):
+        """
+        Recompute the comment counters of all threads.
+        """
+        self.db.execute([
+            'UPDATE threads SET',
+            '    published = (SELECT COUNT(*) FROM comments',
+            '                 WHERE tid = +threads.id AND mode = 1),',
+            '    pending = (SELECT COUNT(*) FROM comments',
+            '               WHERE tid = +threads.id AND mode = 2),',
+            '    last_activity = (SELECT MAX(MAX(created), IFNULL(MAX(modified), 0))',
+            '                     FROM comments WHERE tid = +threads.id)'])
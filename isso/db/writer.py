@@ -0,0 +1,106 @@
+# -*- encoding: utf-8 -*-
+
+import os
+import time
+import logging
+import functools
+import threading
+
+from concurrent.futures import Future
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+logger = logging.getLogger("isso")
+
+
+def write(func):
+    """Run the decorated method of a table class, e.g. :class:`Comments`,
+    through :meth:`isso.db.SQLite3.write`."""
+
+    @functools.wraps(func)
+    def dec(self, *args, **kwargs):
+        return self.db.write(func, self, *args, **kwargs)
+
+    return dec
+
+
+class Writer(object):
+    """A dedicated thread which runs the write operations of all request
+    threads and commits them in groups, so a burst of writes shares one
+    transaction (and one fsync) instead of contending for the database lock.
+
+    The writer takes up to :param:`size` operations from its queue, waiting
+    up to :param:`latency` seconds after the first one for further
+    operations. Each operation runs in a savepoint of the group's
+    transaction, a failing operation is rolled back on its own. Results are
+    handed back once the transaction has been committed.
+
+    The thread is started on first use, and again after a fork (e.g. by
+    uWSGI's pre-forking master).
+    """
+
+    def __init__(self, db, size=64, latency=0.002):
+        self.db = db
+        self.size = size
+        self.latency = latency
+
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def submit(self, func, *args, **kwargs):
+        """Queue :param:`func` and return a :class:`Future` of its result."""
+
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid, self.queue = os.getpid(), queue.Queue()
+                thread = threading.Thread(target=self.run, args=(self.queue, ),
+                                          name="isso-writer")
+                thread.daemon = True
+                thread.start()
+
+        future = Future()
+        self.queue.put((future, func, args, kwargs))
+        return future
+
+    def run(self, pending):
+
+        while True:
+            batch = [pending.get()]
+            deadline = time.time() + self.latency
+
+            while len(batch) < self.size:
+                try:
+                    batch.append(pending.get(timeout=max(0, deadline - time.time())))
+                except queue.Empty:
+                    break
+
+            self.commit(batch)
+
+    def commit(self, batch):
+
+        results = []
+        try:
+            with self.db.transaction() as con:
+                for future, func, args, kwargs in batch:
+                    con.execute("SAVEPOINT write")
+                    try:
+                        results.append((future, func(*args, **kwargs), None))
+                    except Exception as e:
+                        con.execute("ROLLBACK TO write")
+                        results.append((future, None, e))
+                    finally:
+                        con.execute("RELEASE write")
+        except Exception as e:
+            logger.exception("failed to commit %i writes", len(batch))
+            for future, func, args, kwargs in batch:
+                future.set_exception(e)
+            return
+
+        for future, rv, e in results:
+            if e is None:
+                future.set_result(rv)
+            else:
+                future.set_exception(e)
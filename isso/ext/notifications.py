@@ -164,9 +164,10 @@ class SMTP(object):
         if self.reply_notify and "parent" in comment and comment["parent"] is not None:
             # Notify interested authors that a new comment is posted
             notified = []
-            parent_comment = self.isso.db.comments.get(comment["parent"])
+            parent_comment = self.isso.db.comments.get(comment["parent"], projection="notification")
             comments_to_notify = [parent_comment] if parent_comment is not None else []
-            comments_to_notify += self.isso.db.comments.fetch(thread["uri"], mode=1, parent=comment["parent"])
+            comments_to_notify += self.isso.db.comments.fetch(
+                thread["uri"], mode=1, parent=comment["parent"], projection="notification")
             for comment_to_notify in comments_to_notify:
                 email = comment_to_notify["email"]
                 if "email" in comment_to_notify and comment_to_notify["notification"] and email not in notified \
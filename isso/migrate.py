@@ -2,7 +2,9 @@
 
 from __future__ import division, print_function, unicode_literals
 
+import codecs
 import functools
+import heapq
 import io
 import json
 import logging
@@ -45,26 +47,154 @@ class Progress(object):
 
         self.istty = sys.stdout.isatty()
         self.last = 0
+        self.start = time()
 
-    def update(self, i, message):
+    def update(self, i, message, count=None):
 
         if not self.istty or message is None:
             return
 
+        if time() - self.last <= 0.2:
+            return
+
+        if count is not None:
+            message = "{0}/s  {1}".format(self.rate(count), message)
+
         cols = int((os.popen('stty size', 'r').read()).split()[1])
         message = message[:cols - 7]
 
-        if time() - self.last > 0.2:
-            sys.stdout.write("\r{0}".format(" " * cols))
-            sys.stdout.write("\r[{0:.0%}]  {1}".format(i / self.end, message))
-            sys.stdout.flush()
-            self.last = time()
+        sys.stdout.write("\r{0}".format(" " * cols))
+        sys.stdout.write("\r[{0:.0%}]  {1}".format(i / self.end, message))
+        sys.stdout.flush()
+        self.last = time()
+
+    def rate(self, count):
+        """Return the number of items per second for :param:`count` items
+        processed since start."""
+        return int(count / max(time() - self.start, 1e-3))
 
-    def finish(self, message):
+    def finish(self, message, count=None):
+        if count is not None:
+            message += " in {0:.1f}s ({1}/s)".format(time() - self.start, self.rate(count))
         self.last = 0
         self.update(self.end, message + "\n")
 
 
+class Batch(object):
+    """Insert comments with :meth:`Comments.add_many`, :param:`size` comments
+    per transaction.
+
+    Comment ids are assigned on :meth:`add` rather than by the database, so
+    replies can be queued right after their parent before it is inserted.
+    """
+
+    def __init__(self, db, size=10000):
+        self.db = db
+        self.size = size
+        self.rows = []
+        self.count = 0
+
+        self.id = db.execute("SELECT MAX(id) FROM comments").fetchone()[0] or 0
+
+    def add(self, uri, item):
+        """Queue :param:`item` for thread :param:`uri` and return its id."""
+        self.id += 1
+        item["id"] = self.id
+
+        self.rows.append((uri, item))
+        if len(self.rows) >= self.size:
+            self.flush()
+
+        return self.id
+
+    def flush(self):
+        if self.rows:
+            self.count += self.db.comments.add_many(self.rows)
+            self.rows = []
+
+
+def iterparse(source, depth):
+    """Incrementally parse the XML file :param:`source` and yield each element
+    at :param:`depth` (the root being at depth zero) once it is complete.
+    Yielded elements are removed from the tree afterwards, so memory usage
+    does not grow with the size of the document."""
+
+    stack = []
+    for event, elem in ElementTree.iterparse(source, events=("start", "end")):
+        if event == "start":
+            stack.append(elem)
+            continue
+
+        stack.pop()
+        if len(stack) == depth:
+            yield elem
+            if stack:
+                stack[-1].remove(elem)
+
+
+def iterjson(fh, size=io.DEFAULT_BUFFER_SIZE):
+    """Incrementally parse a JSON array from the binary file :param:`fh` and
+    yield its items one at a time."""
+
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+
+    buf, pos, eof = "", 0, False
+
+    def more(buf, pos, size):
+        chunk = fh.read(size)
+        return buf[pos:] + utf8.decode(chunk, final=not chunk), not chunk
+
+    while not eof and not buf.lstrip():
+        buf, eof = more(buf, pos, size)
+
+    pos = len(buf) - len(buf.lstrip())
+    if buf[pos:pos + 1] != "[":
+        raise ValueError("Expecting JSON array")
+    pos += 1
+
+    expect = None
+    while True:
+        while pos < len(buf) and buf[pos] in " \t\r\n":
+            pos += 1
+
+        if pos == len(buf):
+            if eof:
+                raise ValueError("Unterminated JSON array")
+            buf, eof = more(buf, pos, size)
+            pos = 0
+            continue
+
+        if buf[pos] == "]" and expect != "item":
+            return
+
+        if expect == ",":
+            if buf[pos] != ",":
+                raise ValueError("Expecting ',' delimiter: char {0}".format(pos))
+            pos, expect = pos + 1, "item"
+            continue
+
+        try:
+            item, end = decoder.raw_decode(buf, pos)
+        except ValueError:
+            if eof:
+                raise
+            # read as much again as buffered, incomplete items are
+            # decoded O(log n) times instead of O(n) times
+            buf, eof = more(buf, pos, max(size, len(buf) - pos))
+            pos = 0
+            continue
+
+        # a number might continue in the next chunk
+        if end == len(buf) and not eof:
+            buf, eof = more(buf, pos, size)
+            pos = 0
+            continue
+
+        yield item
+        pos, expect = end, ","
+
+
 class Disqus(object):
 
     ns = '{http://disqus.com}'
@@ -78,89 +208,142 @@ class Disqus(object):
         self.xmlfile = xmlfile
         self.empty_id = empty_id
 
-    def insert(self, thread, posts):
-
-        path = urlparse(thread.find('%slink' % Disqus.ns).text).path
-        remap = dict()
-
-        if path not in self.db.threads:
-            self.db.threads.new(path, thread.find(
-                Disqus.ns + 'title').text.strip())
-
-        for item in sorted(posts, key=lambda k: k['created']):
+    def insert(self, batch, path, item, remap, replies):
+        """Queue :param:`item` and its replies waiting in :param:`replies`.
+        :param:`remap` maps Disqus ids to the Isso id to use as parent, which
+        is the id of the top-level comment for replies."""
 
+        stack = [(path, item)]
+        while stack:
+            path, item = stack.pop()
             dsq_id = item.pop('dsq:id')
             item['parent'] = remap.get(item.pop('dsq:parent', None))
-            rv = self.db.comments.add(path, item)
-            remap[dsq_id] = rv["id"]
+            id = batch.add(path, item)
 
-        self.comments.update(set(remap.keys()))
+            remap[dsq_id] = item['parent'] or id
+            self.comments.add(dsq_id)
+            stack.extend(reversed(replies.pop(dsq_id, [])))
 
     def migrate(self):
 
-        tree = ElementTree.parse(self.xmlfile)
-        res = defaultdict(list)
-
-        for post in tree.findall(Disqus.ns + 'post'):
-            email = post.find('{0}author/{0}email'.format(Disqus.ns))
-            ip = post.find(Disqus.ns + 'ipAddress')
-
-            item = {
-                'dsq:id': post.attrib.get(Disqus.internals + 'id'),
-                'text': post.find(Disqus.ns + 'message').text,
-                'author': post.find('{0}author/{0}name'.format(Disqus.ns)).text,
-                'email': email.text if email is not None else '',
-                'created': mktime(strptime(
-                    post.find(Disqus.ns + 'createdAt').text, '%Y-%m-%dT%H:%M:%SZ')),
-                'remote_addr': anonymize(ip.text if ip is not None else '0.0.0.0'),
-                'mode': 1 if post.find(Disqus.ns + "isDeleted").text == "false" else 4
-            }
-
-            if post.find(Disqus.ns + 'parent') is not None:
-                item['dsq:parent'] = post.find(
-                    Disqus.ns + 'parent').attrib.get(Disqus.internals + 'id')
-
-            res[post.find('%sthread' % Disqus.ns).attrib.get(
-                Disqus.internals + 'id')].append(item)
-
-        progress = Progress(len(tree.findall(Disqus.ns + 'thread')))
-        for i, thread in enumerate(tree.findall(Disqus.ns + 'thread')):
-            progress.update(i, thread.find(Disqus.ns + 'id').text)
-
-            # skip (possibly?) duplicate, but empty thread elements
-            if thread.find(Disqus.ns + 'id').text is None and not self.empty_id:
-                continue
-
-            id = thread.attrib.get(Disqus.internals + 'id')
-            if id in res:
-                self.threads.add(id)
-                self.insert(thread, res[id])
+        batch = Batch(self.db)
+        threads, skipped, pending = {}, set(), defaultdict(list)
+        remap, replies, orphans = {}, defaultdict(list), []
+
+        # posts are numbered by creation date per thread, which requires
+        # to buffer them. To bound memory, buffered posts are queued once
+        # there are as many as fit into a batch.
+        posts = []
+
+        def insert(thread, item):
+            posts.append((thread, item))
+            if len(posts) >= batch.size:
+                drain()
+
+        def drain():
+            order = {}
+            for thread, item in posts:
+                order.setdefault(thread, len(order))
+            posts.sort(key=lambda p: (order[p[0]], p[1]['created']))
+
+            for thread, item in posts:
+                path, title = threads[thread]
+                if thread not in self.threads:
+                    self.threads.add(thread)
+                    if path not in self.db.threads:
+                        self.db.threads.new(path, title)
+
+                parent = item.get('dsq:parent')
+                if parent is not None and parent not in remap:
+                    replies[parent].append((path, item))
+                else:
+                    self.insert(batch, path, item, remap, replies)
+            del posts[:]
+
+        with io.open(self.xmlfile, 'rb') as fh:
+            progress = Progress(os.fstat(fh.fileno()).st_size)
+
+            message = None
+            for el in iterparse(fh, 1):
+                progress.update(fh.tell(), message, len(self.comments))
+
+                if el.tag == Disqus.ns + 'thread':
+                    id = el.attrib.get(Disqus.internals + 'id')
+                    message = el.find(Disqus.ns + 'id').text
+
+                    # skip (possibly?) duplicate, but empty thread elements
+                    if el.find(Disqus.ns + 'id').text is None and not self.empty_id:
+                        skipped.add(id)
+                        continue
+
+                    threads[id] = (urlparse(el.find('%slink' % Disqus.ns).text).path,
+                                   el.find(Disqus.ns + 'title').text.strip())
+
+                    for item in pending.pop(id, []):
+                        insert(id, item)
+
+                elif el.tag == Disqus.ns + 'post':
+                    thread, item = self.Comment(el)
+                    if thread in threads:
+                        insert(thread, item)
+                    elif thread in skipped:
+                        orphans.append(item)
+                    else:
+                        # thread might follow later in the dump
+                        pending[thread].append(item)
+
+        drain()
+
+        # replies whose parent is missing become top-level comments
+        for parent in list(replies):
+            for path, item in replies.pop(parent, []):
+                item.pop('dsq:parent')
+                self.insert(batch, path, item, remap, replies)
+
+        batch.flush()
+
+        for items in pending.values():
+            orphans.extend(items)
 
         # in case a comment has been deleted (and no further childs)
         self.db.comments._remove_stale()
 
         progress.finish("{0} threads, {1} comments".format(
-            len(self.threads), len(self.comments)))
+            len(self.threads), len(self.comments)), len(self.comments))
 
-        orphans = set(map(lambda e: e.attrib.get(Disqus.internals + "id"),
-                          tree.findall(Disqus.ns + "post"))) - self.comments
         if orphans and not self.threads:
             print("Isso couldn't import any thread, try again with --empty-id")
         elif orphans:
             print("Found %i orphans:" % len(orphans))
-            for post in tree.findall(Disqus.ns + "post"):
-                if post.attrib.get(Disqus.internals + "id") not in orphans:
-                    continue
-
-                email = post.find("{0}author/{0}email".format(Disqus.ns))
+            for item in orphans:
                 print(" * {0} by {1} <{2}>".format(
-                    post.attrib.get(Disqus.internals + "id"),
-                    post.find("{0}author/{0}name".format(Disqus.ns)).text,
-                    email.text if email is not None else ""))
-                print(textwrap.fill(post.find(Disqus.ns + "message").text,
+                    item['dsq:id'], item['author'], item['email']))
+                print(textwrap.fill(item['text'],
                                     initial_indent="  ", subsequent_indent="  "))
                 print("")
 
+    def Comment(self, post):
+        """Return the Disqus thread id and the comment of :param:`post`."""
+        email = post.find('{0}author/{0}email'.format(Disqus.ns))
+        ip = post.find(Disqus.ns + 'ipAddress')
+
+        item = {
+            'dsq:id': post.attrib.get(Disqus.internals + 'id'),
+            'text': post.find(Disqus.ns + 'message').text,
+            'author': post.find('{0}author/{0}name'.format(Disqus.ns)).text,
+            'email': email.text if email is not None else '',
+            'created': mktime(strptime(
+                post.find(Disqus.ns + 'createdAt').text, '%Y-%m-%dT%H:%M:%SZ')),
+            'remote_addr': anonymize(ip.text if ip is not None else '0.0.0.0'),
+            'mode': 1 if post.find(Disqus.ns + "isDeleted").text == "false" else 4
+        }
+
+        if post.find(Disqus.ns + 'parent') is not None:
+            item['dsq:parent'] = post.find(
+                Disqus.ns + 'parent').attrib.get(Disqus.internals + 'id')
+
+        return post.find('%sthread' % Disqus.ns).attrib.get(Disqus.internals + 'id'), item
+
 
 class WordPress(object):
 
@@ -179,7 +362,7 @@ class WordPress(object):
         else:
             logger.warn("No WXR namespace found, assuming 1.0")
 
-    def insert(self, thread):
+    def insert(self, thread, batch):
 
         url = urlparse(thread.find("link").text)
         path = url.path
@@ -197,41 +380,56 @@ class WordPress(object):
 
         self.count += len(ids)
 
-        while comments:
-            for i, item in enumerate(comments):
-                if item["parent"] in ids:
-                    continue
+        # insert replies after their parent, otherwise by id: a heap of
+        # comments whose parent has been inserted (or isn't part of this
+        # thread) and an index of replies waiting for their parent
+        queue, replies = [], defaultdict(list)
+        for i, item in enumerate(comments):
+            if item["parent"] in ids:
+                replies[item["parent"]].append((item["id"], i, item))
+            else:
+                queue.append((item["id"], i, item))
 
-                item["parent"] = remap.get(item["parent"], None)
-                rv = self.db.comments.add(path, item)
-                remap[item["id"]] = rv["id"]
+        heapq.heapify(queue)
 
-                ids.remove(item["id"])
-                comments.pop(i)
+        while queue:
+            wp_id, _, item = heapq.heappop(queue)
 
-                break
-            else:
-                # should never happen, but... it's WordPress.
-                return
+            item["parent"] = remap.get(item["parent"], None)
+            id = batch.add(path, item)
+
+            # replies to replies refer to the top-level comment
+            remap[wp_id] = item["parent"] or id
+
+            for reply in replies.pop(wp_id, []):
+                heapq.heappush(queue, reply)
+
+        # replies left over are part of a cycle, which should never
+        # happen, but... it's WordPress.
 
     def migrate(self):
 
-        tree = ElementTree.parse(self.xmlfile)
+        batch = Batch(self.db)
+        threads = 0
+
+        with io.open(self.xmlfile, "rb") as fh:
+            progress = Progress(os.fstat(fh.fileno()).st_size)
 
-        skip = 0
-        items = tree.findall("channel/item")
+            for thread in iterparse(fh, 2):
+                if thread.tag != "item":
+                    continue
 
-        progress = Progress(len(items))
-        for i, thread in enumerate(items):
-            if thread.find("title").text is None or thread.find(self.ns + "comment") is None:
-                skip += 1
-                continue
+                if thread.find("title").text is None or thread.find(self.ns + "comment") is None:
+                    continue
 
-            progress.update(i, thread.find("title").text)
-            self.insert(thread)
+                progress.update(fh.tell(), thread.find("title").text, self.count)
+                self.insert(thread, batch)
+                threads += 1
+
+        batch.flush()
 
         progress.finish("{0} threads, {1} comments".format(
-            len(items) - skip, self.count))
+            threads, self.count), self.count)
 
     def Comment(self, el):
         return {
@@ -281,8 +479,8 @@ class Generic(object):
         self.json_file = json_file
         self.count = 0
 
-    def insert(self, thread):
-        """Process a thread and insert its comments in the DB."""
+    def insert(self, thread, batch):
+        """Process a thread and queue its comments for insertion."""
         thread_id = thread['id']
         title = thread['title']
         self.db.threads.new(thread_id, title)
@@ -291,19 +489,24 @@ class Generic(object):
         comments.sort(key=lambda comment: comment['id'])
         self.count += len(comments)
         for comment in comments:
-            self.db.comments.add(thread_id, comment)
+            batch.add(thread_id, comment)
 
     def migrate(self):
         """Process the input file and fill the DB."""
-        with io.open(self.json_file, 'rt', encoding='utf8') as fh:
-            threads = json.load(fh)
-        progress = Progress(len(threads))
+        batch = Batch(self.db)
+        threads = 0
+
+        with io.open(self.json_file, 'rb') as fh:
+            progress = Progress(os.fstat(fh.fileno()).st_size)
+
+            for i, thread in enumerate(iterjson(fh)):
+                progress.update(fh.tell(), str(i), self.count)
+                self.insert(thread, batch)
+                threads += 1
 
-        for i, thread in enumerate(threads):
-            progress.update(i, str(i))
-            self.insert(thread)
+        batch.flush()
 
-        progress.finish("{0} threads, {1} comments".format(len(threads), self.count))
+        progress.finish("{0} threads, {1} comments".format(threads, self.count), self.count)
 
     def _build_comment(self, raw_comment):
         return {
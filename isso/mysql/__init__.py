@@ -5,6 +5,7 @@ from mysql.connector import Error
 import logging
 import operator
 import os.path
+import re
 
 from collections import defaultdict
 
@@ -37,11 +38,20 @@ class MySQL:
         self.__initConnection()
         logger.info("Successfully connected to mysql server %s", self.mysql_host)
 
+        # window functions are available since MySQL 8.0 and MariaDB 10.2
+        version = self.version
+        match = re.match(r'(\d+)\.(\d+)', version)
+        self.window_functions = match is not None and tuple(map(int, match.groups())) >= (
+            (10, 2) if 'mariadb' in version.lower() else (8, 0))
+
         self.preferences = Preferences(self)
         self.threads = Threads(self)
         self.comments = Comments(self)
         self.guard = Guard(self)
 
+        self.threads.migrate()
+        self.comments.migrate()
+
     def __initConnection(self):
         try:
             self.connection = mysql.connector.connect(host=self.mysql_host,
@@ -83,6 +93,37 @@ class MySQL:
         finally:
             cursor.close()
 
+    def commit_many(self, query, seq_of_parameters):
+        """Commit :param:`query` once per parameter tuple of
+        :param:`seq_of_parameters` in a single transaction and return the
+        number of affected rows."""
+        if isinstance(query, (list, tuple)):
+            query = ' '.join(query)
+
+        if self.connection is None:
+            self.__initConnection()
+        cursor = self.connection.cursor()
+        try:
+            cursor.executemany(query, seq_of_parameters)
+            self.connection.commit()
+            return cursor.rowcount
+        except Error as e:
+            self.connection.rollback()
+            logger.error("MySQL Execution error {}".format(e))
+            raise
+        finally:
+            cursor.close()
+
+    def insert(self, query, parameters=[]):
+        """Commit INSERT :param:`query` and return the id of the inserted row
+        or None if no row has been inserted."""
+        cursor = self.__execute(query, parameters)
+        try:
+            self.connection.commit()
+            return cursor.lastrowid if cursor.rowcount > 0 else None
+        finally:
+            cursor.close()
+
     def execute(self, query, parameters=[]):
         try:
             cursor = self.__execute(query, parameters)
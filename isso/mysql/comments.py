@@ -5,10 +5,10 @@ import pickle
 import logging
 
 from isso.utils import Bloomfilter
-from isso.compat import buffer
 
 logger = logging.getLogger("isso")
 
+
 class Comments:
     """Hopefully DB-independend SQL to store, modify and retrieve all
     comment-related actions.  Here's a short scheme overview:
@@ -26,7 +26,31 @@ class Comments:
               'mode',  # status of the comment 1 = valid, 2 = pending,
                        # 4 = soft-deleted (cannot hard delete because of replies)
               'remote_addr', 'text', 'author', 'email', 'website',
-              'likes', 'dislikes', 'voters', 'notification']
+              'likes', 'dislikes', 'voters', 'notification',
+              'html',  # rendered text, see :meth:`render`
+              'hash']  # commenter identicon hash, see :meth:`rehash`
+
+    # columns read per use case, the voters blob is only read by :meth:`votes`.
+    # The public projection (threads, feeds) returns the remote address only
+    # of comments without hash, to hash them on the fly, and the email for
+    # those and gravatar images.
+    projections = {
+        'full': [f for f in fields if f != 'voters'],
+        'public': ['tid', 'id', 'parent', 'created', 'modified', 'mode',
+                   'text', 'author', 'website', 'likes', 'dislikes',
+                   'notification', 'html', 'hash', 'email', 'remote_addr'],
+        'admin': ['tid', 'id', 'parent', 'created', 'modified', 'mode',
+                  'remote_addr', 'text', 'author', 'email', 'website',
+                  'likes', 'dislikes', 'html'],
+        'notification': ['tid', 'id', 'parent', 'mode', 'email', 'notification']}
+
+    # secondary indexes, see :meth:`migrate`
+    indexes = [
+        ('comments_tid', '(tid, parent, created)'),
+        ('comments_parent', '(parent)'),
+        ('comments_remote_addr', '(remote_addr, created)'),
+        ('comments_email', '(email, mode, created)'),
+        ('comments_mode', '(mode, created)')]
 
     def __init__(self, db):
 
@@ -46,8 +70,10 @@ class Comments:
                 website VARCHAR(250),
                 likes INT NOT NULL DEFAULT 0,
                 dislikes INT NOT NULL DEFAULT 0,
-                voters BLOB NOT NULL,
+                voters MEDIUMBLOB NOT NULL,
                 notification INT,
+                html TEXT,
+                hash TEXT,
                 PRIMARY KEY (id),
                 FOREIGN KEY (tid)
                     REFERENCES threads(id)
@@ -57,6 +83,38 @@ class Comments:
             );
             """)
 
+    def migrate(self):
+        """Add the html and hash columns, widen the voters column and create
+        secondary indexes missing from the comments table, either because the
+        table is new or because it predates them."""
+
+        rv = self.db.fetchall("""
+            SELECT COLUMN_NAME, DATA_TYPE FROM information_schema.COLUMNS
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'comments'
+            """)
+        existing = dict((row[0], row[1].lower()) for row in rv)
+
+        for name in ('html', 'hash'):
+            if name not in existing:
+                self.db.commit("ALTER TABLE comments ADD COLUMN %s TEXT" % name)
+
+        # the growing voters Bloomfilter exceeds 64 KiB (BLOB) at about 22800
+        # voters
+        if existing.get('voters') in ('tinyblob', 'blob'):
+            logger.info("widen comments.voters to MEDIUMBLOB")
+            self.db.commit("ALTER TABLE comments MODIFY voters MEDIUMBLOB NOT NULL")
+
+        rv = self.db.fetchall("""
+            SELECT DISTINCT INDEX_NAME FROM information_schema.STATISTICS
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'comments'
+            """)
+        existing = set(row[0] for row in rv)
+
+        for name, columns in Comments.indexes:
+            if name not in existing:
+                logger.info("create index %s on comments%s", name, columns)
+                self.db.commit("CREATE INDEX %s ON comments %s" % (name, columns))
+
     def add(self, uri, c):
         """
         Add new comment to DB and return a mapping of :attribute:`fields` and
@@ -68,52 +126,97 @@ class Comments:
             if ref.get("parent") is not None:
                 c["parent"] = ref["parent"]
 
-        self.db.commit("""
+        id = self.db.insert("""
             INSERT INTO comments (
                 tid, parent,
                 created, modified, mode, remote_addr,
-                text, author, email, website, 
+                text, author, email, website,
                 voters,
-                notification
+                notification,
+                html,
+                hash
             )
             SELECT
                 threads.id, %s,
                 %s, %s, %s, %s,
                 %s, %s, %s, %s,
                 %s,
-                %s
+                %s,
+                %s, %s
             FROM threads WHERE threads.uri = %s;
             """, (
-                c.get('parent'),
-                c.get('created') or time.time(), None, c["mode"], c['remote_addr'],
-                c['text'], c.get('author'), c.get('email'), c.get('website'), 
-                pickle.dumps(Bloomfilter(iterable=[c['remote_addr']])),
-                c.get('notification'),
-                uri
-            )
-        )
+            c.get('parent'),
+            c.get('created') or time.time(), None, c["mode"], c['remote_addr'],
+            c['text'], c.get('author'), c.get('email'), c.get('website'),
+            pickle.dumps(Bloomfilter(iterable=[c['remote_addr']])),
+            c.get('notification'),
+            c.get('html'), c.get('hash'),
+            uri))
+
+        if id is None:
+            return None
 
         logger.info("Added comment for uri %s", uri)
 
-        return dict(zip(Comments.fields, self.db.fetchone("""
-            SELECT * FROM comments AS c 
-                INNER JOIN threads 
-                    ON threads.uri = %s
-            ORDER BY c.id DESC
-                LIMIT 1
-            """,
-            (uri, )
+        rv = self.get(id)
+
+        self.db.threads.recount(rv['tid'])
+        return rv
+
+    def add_many(self, rows):
+        """
+        Add comments from :param:`rows`, pairs of an uri and a comment, in a
+        single transaction and return the number of added comments.
+
+        Unlike :meth:`add`, comments are inserted as-is: the comment id is
+        taken from the mapping (if any) and parents are neither looked up nor
+        flattened, that is up to the caller (see :mod:`isso.migrate`).
+        """
+        rows = list(rows)
+
+        count = self.db.commit_many("""
+            INSERT INTO comments (
+                tid, id, parent,
+                created, modified, mode, remote_addr,
+                text, author, email, website,
+                voters,
+                notification,
+                html,
+                hash
             )
-        ))
+            SELECT
+                threads.id, %s, %s,
+                %s, %s, %s, %s,
+                %s, %s, %s, %s,
+                %s,
+                %s,
+                %s, %s
+            FROM threads WHERE threads.uri = %s;
+            """, [(
+            c.get('id'), c.get('parent'),
+            c.get('created') or time.time(), c.get('modified'), c["mode"], c['remote_addr'],
+            c['text'], c.get('author'), c.get('email'), c.get('website'),
+            pickle.dumps(Bloomfilter(iterable=[c['remote_addr']])),
+            c.get('notification'),
+            c.get('html'), c.get('hash'),
+            uri) for uri, c in rows])
+
+        for uri in set(uri for uri, c in rows):
+            thread = self.db.threads.lookup(uri, cached=False)
+            if thread is not None:
+                self.db.threads.recount(thread[0])
+
+        return count
 
     def activate(self, id):
         """
         Activate comment id if pending.
         """
-        self.db.commit([
-            'UPDATE comments SET',
-            '    mode=1',
-            'WHERE id=%s AND mode=2'], (id, ))
+        if self.db.commit([
+                'UPDATE comments SET',
+                '    mode=1',
+                'WHERE id=%s AND mode=2'], (id, )):
+            self._recount(id)
 
     def is_previously_approved_author(self, email):
         """
@@ -154,21 +257,117 @@ class Comments:
             'WHERE id=%s;'],
             list(data.values()) + [id])
 
-        return self.get(id)
+        rv = self.get(id)
+        if rv is not None:
+            self.db.threads.recount(rv['tid'])
+        return rv
+
+    def render(self, render, force=False):
+        """
+        Store the HTML returned by :param:`render` for the text of comments
+        without HTML or, if :param:`force` is set, of all comments. Returns
+        the number of rendered comments.
+        """
+        return self._derive('html', 'text', render, force)
+
+    def unrender(self):
+        """
+        Forget the HTML of all comments, see :meth:`render`.
+        """
+        self.db.commit('UPDATE comments SET html=NULL')
+
+    def unrendered(self):
+        """
+        Return the number of comments without HTML.
+        """
+        return self.db.fetchone(
+            'SELECT COUNT(*) FROM comments WHERE html IS NULL')[0]
+
+    def rehash(self, hash):
+        """
+        Store the commenter hash, :param:`hash` of the email address or else
+        the remote address, of comments without. Returns the number of hashed
+        comments.
+        """
+        cache = {}
 
-    def get(self, id):
+        def memoized(key):
+            if key not in cache:
+                cache[key] = hash(key)
+            return cache[key]
+
+        return self._derive(
+            'hash', "COALESCE(NULLIF(email, ''), remote_addr)", memoized)
+
+    def unhash(self):
+        """
+        Forget the commenter hash of all comments, see :meth:`rehash`.
+        """
+        self.db.commit('UPDATE comments SET hash=NULL')
+
+    def unhashed(self):
+        """
+        Return the number of comments without commenter hash.
+        """
+        return self.db.fetchone(
+            'SELECT COUNT(*) FROM comments WHERE hash IS NULL')[0]
+
+    def _derive(self, column, source, func, force=False):
+        """
+        Set :param:`column` to :param:`func` of the :param:`source` expression
+        in batches, for rows where it is NULL or for all rows if :param:`force`
+        is set. Returns the number of updated rows.
+
+        Rows are only updated if their source is unchanged, an edit between
+        reading and updating a batch has stored the derived value itself.
+        """
+        sql = ['SELECT id, ' + source + ' FROM comments WHERE id > %s']
+        update = ['UPDATE comments SET ' + column + '=%s',
+                  'WHERE id=%s AND ' + source + ' <=> %s']
+        if not force:
+            sql.append('AND ' + column + ' IS NULL')
+            update.append('AND ' + column + ' IS NULL')
+        sql.append('ORDER BY id LIMIT 1000')
+
+        last, count = 0, 0
+        while True:
+            rv = self.db.fetchall(sql, (last, ))
+            if not rv:
+                return count
+
+            count += self.db.commit_many(
+                ' '.join(update), [(func(value), id, value) for (id, value) in rv])
+
+            last = rv[-1][0]
+
+    @classmethod
+    def select(cls, projection, table='comments'):
+        """
+        Return the fields of :param:`projection` (see :attr:`projections`)
+        and the corresponding SELECT list for the comments :param:`table`.
+        """
+        fields = cls.projections[projection]
+        columns = [table + '.' + f for f in fields]
+        if projection == 'public':
+            columns = ['CASE WHEN {0}.hash IS NULL THEN {1} END AS {2}'.format(table, c, f)
+                       if f == 'remote_addr' else c
+                       for f, c in zip(fields, columns)]
+        return fields, ', '.join(columns)
+
+    def get(self, id, projection='full'):
         """`
-        Search for comment :param:`id` and return a mapping of :attr:`fields`
-        and values.
+        Search for comment :param:`id` and return a mapping of the fields of
+        :param:`projection` and values.
         """
+        fields, columns = self.select(projection)
         rv = self.db.fetchone(
-            'SELECT * FROM comments WHERE id=%s', (id, ))
+            'SELECT ' + columns + ' FROM comments WHERE id=%s', (id, ))
         # for some reason, the row doesn't always come back first time
         rv = self.db.fetchone(
-            'SELECT * FROM comments WHERE id=%s', (id, ))
+            'SELECT ' + columns + ' FROM comments WHERE id=%s', (id, ))
         if rv:
             logger.info("Found comment with id %s", id)
-            return dict(zip(Comments.fields, rv))
+            return dict(zip(fields, rv))
 
         return None
 
@@ -188,12 +387,8 @@ class Comments:
         """
         Return comments for admin with :param:`mode`.
         """
-        fields_comments = ['tid', 'id', 'parent', 'created', 'modified',
-                           'mode', 'remote_addr', 'text', 'author',
-                           'email', 'website', 'likes', 'dislikes']
+        fields_comments, sql_comments_fields = self.select('admin')
         fields_threads = ['uri', 'title']
-        sql_comments_fields = ', '.join(['comments.' + f
-                                         for f in fields_comments])
         sql_threads_fields = ', '.join(['threads.' + f
                                         for f in fields_threads])
         sql = ['SELECT ' + sql_comments_fields + ', ' + sql_threads_fields + ' '
@@ -232,12 +427,14 @@ class Comments:
             yield dict(zip(fields_comments + fields_threads, item))
 
     def fetch(self, uri, mode=5, after=0, parent='any',
-              order_by='id', asc=1, limit=None):
+              order_by='id', asc=1, limit=None, projection='public'):
         """
-        Return comments for :param:`uri` with :param:`mode`.
+        Return comments for :param:`uri` with :param:`mode`, mappings of the
+        fields of :param:`projection` and values.
         """
-        sql = ['SELECT comments.* FROM comments INNER JOIN threads ON',
-               '    threads.uri=%s AND comments.tid=threads.id AND (%s | comments.mode) = %s',
+        fields, columns = self.select(projection)
+        sql = ['SELECT ' + columns + ' FROM comments WHERE',
+               '    comments.tid=(SELECT id FROM threads WHERE uri=%s) AND (%s | comments.mode) = %s',
                '    AND comments.created > %s']
 
         sql_args = [uri, mode, mode, after]
@@ -253,7 +450,7 @@ class Comments:
         if order_by not in ['id', 'created', 'modified', 'likes', 'dislikes']:
             order_by = 'id'
         sql.append('ORDER BY ')
-        sql.append(order_by)
+        sql.append('comments.' + order_by)
         if not asc:
             sql.append(' DESC')
 
@@ -265,26 +462,100 @@ class Comments:
         logger.info("Found %s comments for uri %s", len(rv), uri)
 
         for item in rv:
-            yield dict(zip(Comments.fields, item))
+            yield dict(zip(fields, item))
+
+    def fetch_tree(self, uri, limit=None, nested_limit=None, after=0,
+                   order_by='id', asc=1, mode=5, projection='public'):
+        """
+        Return top-level comments for :param:`uri` and their replies as a
+        tuple of a list and a mapping of parent ids to lists of replies, see
+        :meth:`fetch` for :param:`projection`.
+
+        At most :param:`limit` top-level comments and :param:`nested_limit`
+        replies per top-level comment are returned, both are fetched in one
+        query each instead of one query per top-level comment if the server
+        supports window functions (MySQL 8.0, MariaDB 10.2).
+        """
+
+        # custom sanitization
+        if order_by not in ['id', 'created', 'modified', 'likes', 'dislikes']:
+            order_by = 'id'
+        order = 'c.' + order_by + ('' if asc else ' DESC')
+
+        fields, columns = self.select(projection, 'c')
+        sql = ['FROM comments AS c WHERE',
+               '    c.tid=(SELECT id FROM threads WHERE uri=%s) AND (%s | c.mode) = %s',
+               '    AND c.created > %s AND c.parent IS NULL',
+               'ORDER BY ' + order]
+        sql_args = [uri, mode, mode, after]
+
+        if limit is not None:
+            sql.append('LIMIT %s')
+            sql_args.append(limit)
+
+        roots = [dict(zip(fields, item)) for item in self.db.fetchall(
+            ['SELECT ' + columns] + sql, sql_args)]
+        replies = {}
+
+        if not roots or nested_limit is not None and nested_limit <= 0:
+            return roots, replies
+
+        if not self.db.window_functions:
+            for root in roots:
+                replies[root['id']] = list(self.fetch(
+                    uri, mode, after, root['id'], order_by, asc, nested_limit, projection))
+            return roots, replies
+
+        sql = ['SELECT * FROM (',
+               '    SELECT ' + columns + ', ROW_NUMBER() OVER (',
+               '        PARTITION BY c.parent ORDER BY ' + order + ') AS n',
+               '    FROM comments AS c INNER JOIN (SELECT c.id ' + ' '.join(sql),
+               '    ) AS roots ON c.parent=roots.id',
+               '    WHERE c.tid=(SELECT id FROM threads WHERE uri=%s) AND (%s | c.mode) = %s',
+               '        AND c.created > %s',
+               ') AS r']
+        sql_args = sql_args + [uri, mode, mode, after]
+
+        if nested_limit is not None:
+            sql.append('WHERE n <= %s')
+            sql_args.append(nested_limit)
+
+        sql.append('ORDER BY parent, n')
+
+        for item in self.db.fetchall(sql, sql_args):
+            item = dict(zip(fields, item[:-1]))
+            replies.setdefault(item['parent'], []).append(item)
+
+        return roots, replies
 
     def _remove_stale(self):
+        """
+        Remove soft-deleted comments without replies, and soft-deleted
+        top-level comments whose replies are all removed along with them.
+        Comments are nested one level deep at most (see :meth:`add`), hence
+        a single pass suffices. Returns the number of removed comments.
+        """
 
-        sql = """
-            DELETE FROM comments
-            WHERE
-                mode=4 AND id NOT IN (
-                    SELECT parent FROM (
-                        SELECT
-                            parent
-                        FROM
-                            comments
-                        WHERE parent IS NOT NULL
-                    ) as p
-                )
-            """
-
-        while self.db.commit(sql):
-            continue
+        # MySQL can't select from the table a DELETE is operating on. Replies
+        # come first, so no chunk deletes a parent of a later chunk's reply
+        # (see FOREIGN KEY (parent)).
+        ids = [id for (id, ) in self.db.fetchall("""
+            SELECT id FROM comments AS c WHERE mode = 4 AND NOT EXISTS (
+                SELECT 1 FROM comments AS reply WHERE reply.parent = c.id
+                AND (reply.mode != 4 OR EXISTS (
+                    SELECT 1 FROM comments AS r WHERE r.parent = reply.id)))
+            ORDER BY c.parent IS NULL
+            """)]
+
+        count = 0
+        for i in range(0, len(ids), 1000):
+            chunk = ids[i:i + 1000]
+            # delete replies before their parent, see FOREIGN KEY (parent)
+            count += self.db.commit(
+                'DELETE FROM comments WHERE id IN (' + ', '.join(['%s'] * len(chunk)) + ')'
+                ' ORDER BY parent IS NULL', chunk)
+
+        return count
 
     def delete(self, id):
         """
@@ -298,11 +569,15 @@ class Comments:
         effects."""
 
         refs = self.db.fetchone(
-            'SELECT * FROM comments WHERE parent=%s', (id, ))
+            'SELECT 1 FROM comments WHERE parent=%s', (id, ))
+        tid = self.db.fetchone(
+            'SELECT tid FROM comments WHERE id=%s', (id, ))
 
         if refs is None:
             self.db.commit('DELETE FROM comments WHERE id=%s', (id, ))
             self._remove_stale()
+            if tid is not None:
+                self.db.threads.recount(tid[0])
             return None
 
         self.db.commit('UPDATE comments SET text=%s WHERE id=%s', ('', id))
@@ -311,39 +586,91 @@ class Comments:
             self.db.commit('UPDATE comments SET %s=%s WHERE id=%s', (field, None, id))
 
         self._remove_stale()
+        self.db.threads.recount(tid[0])
         return self.get(id)
 
-    def vote(self, upvote, id, remote_addr):
-        """+1 a given comment. Returns the new like count (may not change because
-        the creater can't vote on his/her own comment and multiple votes from the
-        same ip address are ignored as well)."""
+    def _recount(self, id):
+        rv = self.db.fetchone('SELECT tid FROM comments WHERE id=%s', (id, ))
+        if rv is not None:
+            self.db.threads.recount(rv[0])
 
+    def votes(self, id):
+        """
+        Return the thread id, likes, dislikes and the voters
+        :class:`Bloomfilter` of comment :param:`id`, or None.
+        """
         rv = self.db.fetchone(
-            'SELECT likes, dislikes, voters FROM comments WHERE id=%s', (id, ))
+            'SELECT tid, likes, dislikes, voters FROM comments WHERE id=%s', (id, ))
 
         if rv is None:
             return None
 
-        likes, dislikes, votersPickle = rv
+        tid, likes, dislikes, votersPickle = rv
+
+        # new comments store a pickled Bloomfilter, votes the bare array
         voters = pickle.loads(votersPickle)
-        if likes + dislikes >= 142:
-            return {'likes': likes, 'dislikes': dislikes}
+        return tid, likes, dislikes, Bloomfilter(
+            bytearray(getattr(voters, 'array', voters)), likes + dislikes)
 
-        bf = Bloomfilter(voters.array, likes + dislikes)
-        if remote_addr in bf:
-            return {'likes': likes, 'dislikes': dislikes}
+    def vote(self, upvote, id, remote_addr):
+        """+1 a given comment. Returns the new like count (may not change because
+        the creater can't vote on his/her own comment and multiple votes from the
+        same ip address are ignored as well).
 
-        bf.add(remote_addr)
-        self.db.commit([
-            'UPDATE comments SET',
-            '    likes = likes + 1,' if upvote else 'dislikes = dislikes + 1,',
-            '    voters = %s'
-            'WHERE id=%s;'], (pickle.dumps(bf.array), id))
+        The vote is a compare-and-swap: the update only applies if the vote
+        counts are still the ones the voters blob has been read with, else
+        the vote is retried with the updated blob. Every retry implies another
+        successful vote, so this terminates."""
+
+        while True:
+            rv = self.votes(id)
+            if rv is None:
+                return None
+
+            tid, likes, dislikes, bf = rv
+            if remote_addr in bf:
+                return {'likes': likes, 'dislikes': dislikes}
+
+            bf.add(remote_addr)
+            if self.db.commit([
+                    'UPDATE comments SET',
+                    '    likes = likes + 1,' if upvote else 'dislikes = dislikes + 1,',
+                    '    voters = %s',
+                    'WHERE id=%s AND likes=%s AND dislikes=%s;'],
+                    (pickle.dumps(bf.array), id, likes, dislikes)):
+                break
+
+        self.db.threads.touch(tid)
 
         if upvote:
             return {'likes': likes + 1, 'dislikes': dislikes}
         return {'likes': likes, 'dislikes': dislikes + 1}
 
+    def add_votes(self, id, likes, dislikes, voters):
+        """
+        Add :param:`likes`, :param:`dislikes` and the :param:`voters`
+        Bloomfilter (merged with the stored one) to comment :param:`id`, see
+        :class:`isso.core.VoteBuffer`. Returns the new vote counts.
+        """
+
+        while True:
+            rv = self.votes(id)
+            if rv is None:
+                return None
+
+            tid, l, d, bf = rv
+            bf.update(voters)
+
+            if self.db.commit([
+                    'UPDATE comments SET',
+                    '    likes = likes + %s, dislikes = dislikes + %s, voters = %s',
+                    'WHERE id=%s AND likes=%s AND dislikes=%s;'],
+                    (likes, dislikes, pickle.dumps(bf.array), id, l, d)):
+                break
+
+        self.db.threads.touch(tid)
+        return {'likes': l + likes, 'dislikes': d + dislikes}
+
     def reply_count(self, url, mode=5, after=0):
         """
         Return comment count for main thread and all reply threads for one url.
@@ -353,8 +680,7 @@ class Comments:
                 SELECT
                     c.parent, count(*)
                 FROM comments AS c
-                    INNER JOIN threads AS t
-                    ON t.uri=%s AND c.tid = t.id AND
+                WHERE c.tid = (SELECT id FROM threads WHERE uri=%s) AND
                     (%s | c.mode = %s) AND
                   c.created > %s
                GROUP BY c.parent
@@ -367,23 +693,44 @@ class Comments:
         Return comment count for one ore more urls..
         """
 
-        threads = dict(self.db.fetchall("""
-            SELECT 
-                t.uri, COUNT(c.id)
-            FROM comments AS c
-                LEFT OUTER JOIN threads AS t
-                ON t.id = c.tid AND c.mode = 1
-            GROUP BY t.uri
-            """
-        ))
+        if not urls:
+            return []
+
+        placeholders = ', '.join(['%s'] * len(urls))
+        threads = dict(self.db.fetchall(
+            'SELECT uri, published FROM threads WHERE uri IN (%s)' % placeholders, urls))
 
         return [threads.get(url, 0) for url in urls]
 
-    def purge(self, delta):
+    def purge(self, delta, chunk=1000):
         """
-        Remove comments older than :param:`delta`.
+        Remove pending comments older than :param:`delta` and soft-deleted
+        comments no longer referenced. Pending comments are removed at most
+        :param:`chunk` at a time, each chunk in its own (short) transaction
+        so other requests are not locked out for the whole purge.
+
+        Returns a mapping with the number of removed `pending` and `stale`
+        comments as well as the `time` spent in seconds.
         """
-        self.db.commit([
-            'DELETE FROM comments WHERE mode = 2 AND DATEDIFF(%s, created) > %s;'
-        ], (time.time(), delta))
-        self._remove_stale()
+        start = time.time()
+        cutoff, pending = start - delta, 0
+
+        tids = self.db.fetchall(
+            'SELECT DISTINCT tid FROM comments WHERE mode = 2 AND created < %s', (cutoff, ))
+
+        while True:
+            rv = self.db.commit(
+                'DELETE FROM comments WHERE mode = 2 AND created < %s LIMIT %s', (cutoff, chunk))
+            pending += rv
+            if rv < chunk:
+                break
+
+        stale = self._remove_stale()
+
+        for (tid, ) in tids:
+            self.db.threads.recount(tid)
+
+        rv = {'pending': pending, 'stale': stale, 'time': time.time() - start}
+        logger.info("purged %(pending)i pending and %(stale)i stale comments "
+                    "in %(time).3f s", rv)
+        return rv
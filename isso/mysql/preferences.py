@@ -36,4 +36,4 @@ class Preferences:
 
     def set(self, key, value):
         self.db.commit(
-            'INSERT INTO preferences (`key`, value) VALUES (%s, %s)', (key, value))
+            'REPLACE INTO preferences (`key`, value) VALUES (%s, %s)', (key, value))
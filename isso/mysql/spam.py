@@ -2,6 +2,8 @@
 
 import time
 
+from isso.utils import ratelimit
+
 
 class Guard:
 
@@ -10,6 +12,7 @@ class Guard:
         self.db = db
         self.conf = db.conf.section("guard")
         self.max_age = db.conf.getint("general", "max-age")
+        self._limiter = None
 
     def validate(self, uri, comment):
 
@@ -20,8 +23,23 @@ class Guard:
             valid, reason = func(uri, comment)
             if not valid:
                 return False, reason
+
         return True, ""
 
+    def accept(self, comment):
+        """Count :param:`comment` towards the ratelimit of its remote
+        address, once it has been saved."""
+
+        if self.conf.getboolean("enabled"):
+            self.limiter.add(comment["remote_addr"])
+
+    @property
+    def limiter(self):
+        """The rate limiter, created on first use."""
+        if self._limiter is None:
+            self._limiter = ratelimit.new(self.db.conf)
+        return self._limiter
+
     @classmethod
     def ids(cls, rv):
         return [str(col[0]) for col in rv]
@@ -29,13 +47,9 @@ class Guard:
     def _limit(self, uri, comment):
 
         # block more than :param:`ratelimit` comments per minute
-        rv = self.db.fetchall([
-            'SELECT id FROM comments WHERE remote_addr = %s AND DATEDIFF(%s, created) < 60;'
-        ], (comment["remote_addr"], time.time()))
-
-        if len(rv) >= self.conf.getint("ratelimit"):
-            return False, "{0}: ratelimit exceeded ({1})".format(
-                comment["remote_addr"], ', '.join(Guard.ids(rv)))
+        if not self.limiter.allow(comment["remote_addr"]):
+            return False, "{0}: ratelimit exceeded ({1} per minute)".format(
+                comment["remote_addr"], self.limiter.limit)
 
         # block more than three comments as direct response to the post
         if comment["parent"] is None:
@@ -55,9 +69,9 @@ class Guard:
                 'SELECT id FROM comments WHERE'
                 '    remote_addr = %s',
                 'AND id = %s',
-                'AND DATEDIFF(%s, created) < %s'
+                'AND created > %s'
             ], (comment["remote_addr"], comment["parent"],
-                time.time(), self.max_age))
+                time.time() - self.max_age))
 
             if len(rv) > 0:
                 return False, "edit time frame is still open"
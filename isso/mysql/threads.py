@@ -1,5 +1,9 @@
 # -*- encoding: utf-8 -*-
 
+import threading
+
+from collections import OrderedDict
+
 
 def Thread(id, uri, title):
     return {
@@ -10,6 +14,17 @@ def Thread(id, uri, title):
 
 
 class Threads(object):
+    """Threads and their comment counters. The counters `published` (mode 1)
+    and `pending` (mode 2) as well as the timestamp of the latest comment or
+    edit are recomputed by :class:`isso.mysql.comments.Comments` after each
+    write, which also increments `version` and sets the time of the change.
+
+    Id and title of the most recently used threads are cached per process,
+    see :meth:`lookup`.
+    """
+
+    # number of threads cached by :meth:`lookup`
+    cache_size = 1024
 
     def __init__(self, db):
 
@@ -19,20 +34,161 @@ class Threads(object):
                 id INT NOT NULL AUTO_INCREMENT, 
                 uri VARCHAR(256) UNIQUE, 
                 title VARCHAR(256),
+                published INT NOT NULL DEFAULT 0,
+                pending INT NOT NULL DEFAULT 0,
+                last_activity FLOAT,
+                version INT NOT NULL DEFAULT 0,
+                changed DOUBLE,
                 PRIMARY KEY (id)
             )
         """)
 
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def migrate(self):
+        """Add comment counters to threads created before they were
+        introduced. Must run after the comments table has been created."""
+
+        rv = self.db.fetchone("""
+            SELECT COUNT(*) FROM information_schema.COLUMNS
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'threads'
+                AND COLUMN_NAME = 'published'
+            """)
+
+        if rv[0] == 0:
+            self.db.commit("""
+                ALTER TABLE threads
+                    ADD COLUMN published INT NOT NULL DEFAULT 0,
+                    ADD COLUMN pending INT NOT NULL DEFAULT 0,
+                    ADD COLUMN last_activity FLOAT
+                """)
+            self.recount()
+
+        rv = self.db.fetchone("""
+            SELECT COUNT(*) FROM information_schema.COLUMNS
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'threads'
+                AND COLUMN_NAME = 'version'
+            """)
+
+        if rv[0] == 0:
+            self.db.commit("""
+                ALTER TABLE threads
+                    ADD COLUMN version INT NOT NULL DEFAULT 0,
+                    ADD COLUMN changed DOUBLE
+                """)
+
     def __contains__(self, uri):
-        return self.db.fetchone("SELECT uri FROM threads WHERE uri=%s", (uri, )) is not None
+        return self.lookup(uri, cached=False) is not None
 
     def __getitem__(self, uri):
-        return Thread(*self.db.fetchone("SELECT * FROM threads WHERE uri=%s", (uri, )))
+        rv = self.lookup(uri)
+        if rv is None:
+            raise KeyError(uri)
+        return Thread(rv[0], uri, rv[1])
+
+    def lookup(self, uri, cached=True):
+        """
+        Return id and title of thread :param:`uri` or None if there is no
+        such thread. Threads found are kept in an LRU cache, which is
+        revalidated by :meth:`version`.
+
+        The cache is per process: another process may remove the thread and
+        its id may be reused by a new thread. Callers must not trust a
+        cached id unless they check the uri as well, as :meth:`Comments.add`
+        does. With :param:`cached` set to False, the thread is queried and
+        its cache entry refreshed, as for `uri in threads`.
+        """
+        if cached:
+            with self.lock:
+                rv = self.cache.get(uri)
+                if rv is not None:
+                    self.cache.move_to_end(uri)
+                    return rv
+
+        rv = self.db.fetchone("SELECT id, title FROM threads WHERE uri=%s", (uri, ))
+        with self.lock:
+            if rv is None:
+                self.cache.pop(uri, None)
+            else:
+                rv = self.cache[uri] = tuple(rv)
+                self.cache.move_to_end(uri)
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return rv
+
+    def discard(self, id=None):
+        """
+        Drop thread :param:`id`, or all threads, from the cache of
+        :meth:`lookup`.
+        """
+        with self.lock:
+            if id is None:
+                self.cache.clear()
+            else:
+                for uri in [uri for uri, rv in self.cache.items() if rv[0] == id]:
+                    del self.cache[uri]
 
     def get(self, id):
-        return Thread(*self.db.fetchone("SELECT * FROM threads WHERE id=%s", (id, )))
+        """
+        Return thread :param:`id` or None if there is no such thread.
+        """
+        rv = self.db.fetchone(
+            "SELECT id, uri, title FROM threads WHERE id=%s", (id, ))
+        return Thread(*rv) if rv is not None else None
+
+    def version(self, uri=None):
+        """
+        Return id, version and time of the last change of thread :param:`uri`
+        or None if there is no such thread. Without :param:`uri`, return the
+        number of threads, the sum of their versions and the time of the last
+        change of any thread.
+        """
+        if uri is None:
+            return self.db.fetchone(
+                "SELECT COUNT(*), COALESCE(SUM(version), 0), MAX(changed) FROM threads")
+        rv = self.db.fetchone(
+            "SELECT id, version, changed FROM threads WHERE uri=%s", (uri, ))
+
+        # the thread may have been removed by another process
+        with self.lock:
+            if uri in self.cache and (rv is None or self.cache[uri][0] != rv[0]):
+                del self.cache[uri]
+        return rv
+
+    def touch(self, id):
+        """
+        Increment the version of thread :param:`id`.
+        """
+        self.db.commit("""
+            UPDATE threads SET version = version + 1, changed = UNIX_TIMESTAMP(NOW(6))
+            WHERE id = %s
+            """, (id, ))
 
     def new(self, uri, title):
         self.db.commit(
             "INSERT IGNORE INTO threads (uri, title) VALUES (%s, %s)", (uri, title))
         return self[uri]
+
+    def recount(self, id=None):
+        """
+        Recompute the comment counters of thread :param:`id`, and increment its
+        version, or of all threads.
+        """
+        sql = ["""
+            UPDATE threads AS t SET
+                published = (SELECT COUNT(*) FROM comments AS c
+                             WHERE c.tid = t.id AND c.mode = 1),
+                pending = (SELECT COUNT(*) FROM comments AS c
+                           WHERE c.tid = t.id AND c.mode = 2),
+                last_activity = (SELECT GREATEST(MAX(c.created), COALESCE(MAX(c.modified), 0))
+                                 FROM comments AS c WHERE c.tid = t.id)
+            """]
+        args = []
+
+        if id is not None:
+            sql.append(', version = version + 1, changed = UNIX_TIMESTAMP(NOW(6))')
+            sql.append('WHERE t.id = %s')
+            args.append(id)
+
+        self.db.commit(sql, args)
@@ -6,6 +6,7 @@ import os
 import json
 import re
 import tempfile
+import time
 import unittest
 
 try:
@@ -17,6 +18,7 @@ from werkzeug.wrappers import Response
 
 from isso import Isso, core, config, dist
 from isso.utils import http
+from isso.utils.hash import md5
 from isso.views import comments
 
 from isso.compat import iteritems
@@ -108,6 +110,15 @@ class TestComments(unittest.TestCase):
         rv = loads(r.data)
         self.assertEqual(len(rv['replies']), 20)
 
+    def testCreateRemovedThread(self):
+
+        self.post('/new?uri=%2Fpath%2F', data=json.dumps({'text': 'Lorem ipsum ...'}))
+
+        # the thread is removed between its lookup and the insert, twice
+        self.app.db.comments.add = lambda uri, data: None
+        rv = self.post('/new?uri=%2Fpath%2F', data=json.dumps({'text': 'Lorem ipsum ...'}))
+        self.assertEqual(rv.status_code, 409)
+
     def testCreateInvalidParent(self):
 
         self.post('/new?uri=test', data=json.dumps({'text': '...'}))
@@ -209,6 +220,75 @@ class TestComments(unittest.TestCase):
         rv = loads(r.data)
         self.assertEqual(len(rv['replies']), 10)
 
+    def testProjections(self):
+
+        self.post('/new?uri=test', data=json.dumps({'text': '...', 'email': 'a@example.org'}))
+        self.post('/new?uri=test', data=json.dumps({'text': '...', 'parent': 1}))
+        self.app.db.execute('UPDATE comments SET hash = NULL WHERE id = 2')
+
+        db = self.app.db.comments
+        self.assertNotIn('voters', db.get(1))
+        self.assertEqual(db.get(1)['email'], 'a@example.org')
+
+        # remote address only to hash comments without hash
+        rv = list(db.fetch('test'))
+        self.assertEqual([(c['email'], c['remote_addr']) for c in rv],
+                         [('a@example.org', None), (None, '192.168.1.0')])
+        roots, replies = db.fetch_tree('test')
+        self.assertEqual((roots[0]['remote_addr'], replies[1][0]['remote_addr']),
+                         (None, '192.168.1.0'))
+        self.assertEqual(set(roots[0]), set(db.projections['public']))
+
+        rv = db.fetch('test', parent=1, projection='notification')
+        self.assertEqual(set(next(rv)), set(db.projections['notification']))
+
+        # the hash is computed on the fly
+        r = self.get('/?uri=test')
+        self.assertEqual(loads(r.data)['replies'][0]['replies'][0]['hash'],
+                         self.app.hasher.uhash('192.168.1.0'))
+
+    def testGravatar(self):
+
+        self.conf.set("general", "gravatar", "true")
+
+        class App(Isso, core.Mixin):
+            pass
+
+        client = JSONClient(App(self.conf), Response)
+        client.post('/new?uri=test', data=json.dumps({'text': '...', 'email': 'a@example.org'}))
+
+        rv = loads(client.get('/?uri=test').data)
+        self.assertEqual(rv['replies'][0]['gravatar_image'],
+                         self.conf.get("general", "gravatar-url").format(md5('a@example.org')))
+
+    def testGetNestedLimitedTree(self):
+
+        for i in range(3):
+            self.post('/new?uri=test', data=json.dumps({'text': '...'}))
+        for i in range(5):
+            self.post('/new?uri=test',
+                      data=json.dumps({'text': '...', 'parent': 1}))
+            self.post('/new?uri=test',
+                      data=json.dumps({'text': '...', 'parent': 3}))
+
+        r = self.get('/?uri=test&limit=2&nested_limit=3')
+        self.assertEqual(r.status_code, 200)
+
+        rv = loads(r.data)
+        self.assertEqual(len(rv['replies']), 2)
+        self.assertEqual(rv['hidden_replies'], 1)
+
+        first, second = rv['replies']
+        self.assertEqual([c['id'] for c in first['replies']], [4, 6, 8])
+        self.assertEqual(first['total_replies'], 5)
+        self.assertEqual(first['hidden_replies'], 2)
+        self.assertEqual(second['replies'], [])
+        self.assertEqual(second['total_replies'], 0)
+
+        rv = loads(self.get('/?uri=test&nested_limit=0').data)
+        self.assertEqual(rv['replies'][2]['replies'], [])
+        self.assertEqual(rv['replies'][2]['hidden_replies'], 5)
+
     def testUpdate(self):
 
         self.post('/new?uri=%2Fpath%2F',
@@ -225,6 +305,50 @@ class TestComments(unittest.TestCase):
         self.assertEqual(rv['website'], 'http://example.com/')
         self.assertIn('modified', rv)
 
+    def testRenderedHTML(self):
+
+        self.post('/new?uri=%2Fpath%2F',
+                  data=json.dumps({'text': '*Lorem* ipsum ...'}))
+        self.assertEqual(self.app.db.comments.get(1)['html'],
+                         '<p><em>Lorem</em> ipsum ...</p>')
+
+        self.put('/id/1', data=json.dumps({'text': '~~Hello~~ World'}))
+        self.assertEqual(self.app.db.comments.get(1)['html'],
+                         '<p><del>Hello</del> World</p>')
+
+        # comments stored without HTML are rendered on read and at startup
+        self.app.db.comments.update(1, {'html': None})
+        rv = loads(self.get('/?uri=%2Fpath%2F').data)
+        self.assertEqual(rv['replies'][0]['text'], '<p><del>Hello</del> World</p>')
+
+        class App(Isso, core.Mixin):
+            pass
+
+        def rendered(app):
+            for _ in range(100):
+                if app.db.comments.unrendered() == 0:
+                    break
+                time.sleep(0.01)
+            return app.db.comments.get(1)['html']
+
+        self.assertEqual(rendered(App(self.conf)), '<p><del>Hello</del> World</p>')
+
+        # re-render all comments in the background when the [markup]
+        # configuration changes
+        self.conf.set("markup", "options", "autolink")
+        self.assertEqual(rendered(App(self.conf)), '<p>~~Hello~~ World</p>')
+
+        # edits while rendering are not overwritten with the HTML of the old text
+        def render(text):
+            self.put('/id/1', data=json.dumps({'text': text + '!'}))
+            return self.app.render(text)
+
+        self.app.db.comments.update(1, {'html': None})
+        self.assertEqual(self.app.db.comments.render(render), 0)
+        self.assertEqual(self.app.db.comments.get(1)['html'], '<p><del>Hello</del> World!</p>')
+        self.assertEqual(self.app.db.comments.render(render, force=True), 0)
+        self.assertEqual(self.app.db.comments.get(1)['html'], '<p><del>Hello</del> World!!</p>')
+
     def testDelete(self):
 
         self.post('/new?uri=%2Fpath%2F',
@@ -329,6 +453,119 @@ class TestComments(unittest.TestCase):
         self.assertEqual(a['hash'], b['hash'])
         self.assertNotEqual(a['hash'], c['hash'])
 
+    def testStoredHash(self):
+
+        self.post('/new?uri=%2Fpath%2F',
+                  data=json.dumps({"text": "Aaa", "email": "a@example.org"}))
+        self.assertEqual(self.app.db.comments.get(1)['hash'],
+                         self.app.hasher.uhash("a@example.org"))
+
+        # rehash all commenters when the [hash] configuration changes
+        self.conf.set("hash", "algorithm", "sha1")
+
+        class App(Isso, core.Mixin):
+            pass
+
+        app = App(self.conf)
+
+        for _ in range(100):
+            if app.db.comments.unhashed() == 0:
+                break
+            time.sleep(0.01)
+
+        self.assertEqual(app.db.comments.get(1)['hash'],
+                         app.hasher.uhash("a@example.org"))
+
+        # reads hash commenters themselves until they are rehashed
+        self.app.db.comments.unhash()
+        rv = loads(self.get('/?uri=%2Fpath%2F').data)
+        self.assertEqual(rv['replies'][0]['hash'],
+                         self.app.hasher.uhash("a@example.org"))
+
+        # moderation changing the email while rehashing wins
+        def uhash(key):
+            self.app.db.comments.update(1, {
+                'email': 'b@example.org',
+                'hash': self.app.hasher.uhash('b@example.org')})
+            return self.app.hasher.uhash(key)
+
+        self.assertEqual(self.app.db.comments.rehash(uhash), 0)
+        self.assertEqual(self.app.db.comments.get(1)['hash'],
+                         self.app.hasher.uhash("b@example.org"))
+
+    def testResponseCache(self):
+
+        class App(Isso, core.ThreadedMixin):
+            pass
+
+        app = App(self.conf)
+        app.wsgi_app = FakeIP(app.wsgi_app, "192.168.1.1")
+        client = JSONClient(app, Response)
+
+        client.post('/new?uri=%2Fpath%2F', data=json.dumps({'text': 'Lorem ipsum ...'}))
+        a = client.get('/?uri=%2Fpath%2F')
+        b = client.get('/?uri=%2Fpath%2F')
+        self.assertEqual(a.data, b.data)
+        self.assertEqual((app.responses.hits, app.responses.misses), (1, 1))
+
+        # different arguments are cached separately
+        client.get('/?uri=%2Fpath%2F&plain=1')
+        self.assertEqual(app.responses.misses, 2)
+
+        # writes expire all responses of the thread
+        client.put('/id/1', data=json.dumps({'text': 'Hello World'}))
+        rv = loads(client.get('/?uri=%2Fpath%2F').data)
+        self.assertEqual(rv['replies'][0]['text'], '<p>Hello World</p>')
+
+        client.post('/id/1/like')
+        rv = loads(client.get('/?uri=%2Fpath%2F&plain=1').data)
+        self.assertEqual(rv['replies'][0]['text'], 'Hello World')
+        self.assertEqual((app.responses.hits, app.responses.misses), (1, 4))
+
+        rv = loads(client.get('/info').data)
+        self.assertEqual(rv['cache'], {'hits': 1, 'misses': 4})
+
+        # so do writes bypassing the API, e.g. purging pending comments
+        client.post('/new?uri=%2Fpath%2F', data=json.dumps({'text': 'Spam'}))
+        app.db.comments.update(2, {'mode': 4})
+        self.assertEqual(len(loads(client.get('/?uri=%2Fpath%2F').data)['replies']), 2)
+        app.db.comments.purge(3600)
+        self.assertEqual(len(loads(client.get('/?uri=%2Fpath%2F').data)['replies']), 1)
+
+    def testConditionalGet(self):
+
+        self.post('/new?uri=%2Fpath%2F', data=json.dumps({'text': 'Lorem ipsum ...'}))
+
+        for url in ('/?uri=%2Fpath%2F', '/count?uri=%2Fpath%2F', '/latest?limit=5'):
+            rv = self.get(url)
+            self.assertEqual(rv.status_code, 200)
+
+            etag = rv.headers['ETag']
+            rv = self.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(rv.status_code, 304)
+            self.assertEqual(rv.headers['ETag'], etag)
+
+        etag = self.get('/?uri=%2Fpath%2F').headers['ETag']
+        self.put('/id/1', data=json.dumps({'text': 'Hello World'}))
+        rv = self.get('/?uri=%2Fpath%2F', headers={'If-None-Match': etag})
+        self.assertEqual(rv.status_code, 200)
+        self.assertNotEqual(rv.headers['ETag'], etag)
+
+        # ETags depend on settings changing responses only, not on secrets
+        class App(Isso, core.Mixin):
+            pass
+
+        def etag():
+            app = App(self.conf)
+            app.wsgi_app = FakeIP(app.wsgi_app, "192.168.1.1")
+            return JSONClient(app, Response).get('/?uri=%2Fpath%2F').headers['ETag']
+
+        before = etag()
+        self.conf.set("smtp", "password", "secret")
+        self.assertEqual(etag(), before)
+        self.conf.set("general", "gravatar", "true")
+        self.assertNotEqual(etag(), before)
+
     def testVisibleFields(self):
 
         rv = self.post('/new?uri=%2Fpath%2F',
@@ -565,3 +802,23 @@ class TestPurgeComments(unittest.TestCase):
         self.client.post('/new?uri=test', data=json.dumps({"text": "..."}))
         self.app.db.comments.purge(3600)
         self.assertEqual(self.client.get('/id/1').status_code, 200)
+
+    def testPurgeChunks(self):
+        for i in range(5):
+            self.client.post('/new?uri=test', data=json.dumps({"text": "..."}))
+
+        # a soft-deleted comment whose only reply is soft-deleted, too
+        self.client.post('/new?uri=test', data=json.dumps({"text": "..."}))
+        self.client.post('/new?uri=test', data=json.dumps({"text": "...", "parent": 6}))
+        self.app.db.comments.activate(6)
+        self.app.db.comments.activate(7)
+        self.app.db.comments.update(6, {"mode": 4})
+        self.app.db.comments.update(7, {"mode": 4})
+
+        rv = self.app.db.comments.purge(0, chunk=2)
+        self.assertEqual(rv["pending"], 5)
+        self.assertEqual(rv["stale"], 2)
+        self.assertGreaterEqual(rv["time"], 0)
+
+        self.assertEqual(self.app.db.execute("SELECT COUNT(*) FROM comments").fetchone()[0], 0)
+        self.assertNotIn("test", self.app.db.threads)
@@ -4,6 +4,7 @@ import unittest
 import os
 import sqlite3
 import tempfile
+import threading
 
 from isso import config
 from isso.db import SQLite3
@@ -120,3 +121,384 @@ class TestDBMigration(unittest.TestCase):
             rv = con.execute(
                 "SELECT id, parent FROM comments ORDER BY created").fetchall()
             self.assertEqual(flattened, rv)
+
+    def test_thread_counters(self):
+        """Add and compute comment counters for existing threads"""
+
+        with sqlite3.connect(self.path) as con:
+            con.execute("PRAGMA user_version = 3")
+            con.execute("CREATE TABLE threads ("
+                        "    id INTEGER PRIMARY KEY,"
+                        "    uri VARCHAR UNIQUE,"
+                        "    title VARCHAR)")
+            con.execute("CREATE TABLE comments ("
+                        "    tid REFERENCES threads(id),"
+                        "    id INTEGER PRIMARY KEY,"
+                        "    parent INTEGER,"
+                        "    created FLOAT NOT NULL, modified FLOAT,"
+                        "    mode INTEGER, remote_addr VARCHAR, text VARCHAR,"
+                        "    author VARCHAR, email VARCHAR, website VARCHAR,"
+                        "    likes INTEGER DEFAULT 0, dislikes INTEGER DEFAULT 0,"
+                        "    voters BLOB)")
+
+            con.execute(
+                "INSERT INTO threads (uri, title) VALUES (?, ?)", ("/", "Test"))
+            for (mode, created) in ((1, 10), (1, 20), (2, 30), (4, 40)):
+                con.execute("INSERT INTO comments (tid, mode, created) "
+                            "VALUES (1, ?, ?)", (mode, created))
+
+        conf = config.new({
+            "general": {
+                "dbpath": "/dev/null",
+                "max-age": "1h"
+            }
+        })
+        db = SQLite3(self.path, conf)
+
+        def counters():
+            return db.execute("SELECT published, pending, last_activity "
+                              "FROM threads WHERE id=1").fetchone()
+
+        self.assertEqual(counters(), (2, 1, 40))
+        self.assertEqual(db.comments.count("/", "/other"), [2, 0])
+
+        db.comments.activate(3)
+        self.assertEqual(counters(), (3, 0, 40))
+
+        db.comments.delete(1)
+        db.comments.update(2, {"modified": 50})
+        self.assertEqual(counters(), (2, 0, 50))
+
+    def test_indexes(self):
+        """Create secondary indexes on upgrade and for new databases"""
+
+        with sqlite3.connect(self.path) as con:
+            con.execute("PRAGMA user_version = 3")
+            con.execute("CREATE TABLE comments ("
+                        "    tid REFERENCES threads(id),"
+                        "    id INTEGER PRIMARY KEY,"
+                        "    parent INTEGER,"
+                        "    created FLOAT NOT NULL, modified FLOAT,"
+                        "    mode INTEGER, remote_addr VARCHAR, email VARCHAR)")
+
+        conf = config.new({
+            "general": {
+                "dbpath": "/dev/null",
+                "max-age": "1h"
+            }
+        })
+
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.unlink, path)
+
+        for path in (self.path, path):
+            db = SQLite3(path, conf)
+            self.assertEqual(db.version, SQLite3.MAX_VERSION)
+
+            rv = db.execute("SELECT name FROM sqlite_master "
+                            "WHERE type='index' AND tbl_name='comments'")
+            self.assertEqual(set(name for (name, ) in rv), set([
+                "comments_tid", "comments_parent",
+                "comments_remote_addr", "comments_email", "comments_mode"]))
+
+            plan = ' '.join(row[-1] for row in db.execute(
+                "EXPLAIN QUERY PLAN SELECT id FROM comments "
+                "WHERE remote_addr = ? AND created > ?", ("127.0.0.1", 0)))
+            self.assertIn("USING COVERING INDEX comments_remote_addr", plan)
+
+    def test_remove_stale_threads(self):
+        """Replace the trigger removing threads without comments on upgrade"""
+
+        conf = config.new({
+            "general": {
+                "dbpath": "/dev/null",
+                "max-age": "1h"
+            }
+        })
+
+        SQLite3(self.path, conf).dispose()
+        with sqlite3.connect(self.path) as con:
+            con.execute("PRAGMA user_version = 4")
+            con.execute("DROP TRIGGER remove_stale_threads")
+            con.execute("CREATE TRIGGER remove_stale_threads "
+                        "AFTER DELETE ON comments BEGIN "
+                        "    DELETE FROM threads WHERE id NOT IN (SELECT tid FROM comments); "
+                        "END")
+
+        db = SQLite3(self.path, conf)
+        self.assertEqual(db.version, SQLite3.MAX_VERSION)
+
+        sql = db.execute("SELECT sql FROM sqlite_master WHERE type='trigger' "
+                         "AND name='remove_stale_threads'").fetchone()[0]
+        self.assertIn("OLD.tid", sql)
+
+        for uri in ("/a", "/b"):
+            db.threads.new(uri, None)
+            for i in range(2):
+                db.comments.add(uri, {"text": "...", "mode": 1, "remote_addr": "127.0.0.1"})
+
+        db.execute("DELETE FROM comments WHERE id = 1")
+        self.assertIn("/a", db.threads)
+
+        db.execute("DELETE FROM comments WHERE id = 2")
+        self.assertNotIn("/a", db.threads)
+        self.assertIn("/b", db.threads)
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        self.conf = config.new({
+            "general": {
+                "dbpath": "/dev/null",
+                "max-age": "1h"
+            },
+            "sqlite": {
+                "pool-size": "2"
+            }
+        })
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def test_reuse(self):
+
+        db = SQLite3(self.path, self.conf)
+
+        with db.pool.connection() as a:
+            pass
+        with db.pool.connection() as b:
+            pass
+
+        self.assertIs(a, b)
+
+    def test_size(self):
+
+        db = SQLite3(self.path, self.conf)
+        db.dispose()
+
+        with db.pool.connection():
+            with db.pool.connection():
+                with db.pool.connection():
+                    pass
+
+        self.assertEqual(db.pool.idle.qsize(), 2)
+
+        db.dispose()
+        self.assertEqual(db.pool.idle.qsize(), 0)
+
+    def test_pragmas(self):
+
+        db = SQLite3(self.path, self.conf)
+        with db.pool.connection() as con:
+            self.assertEqual(con.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+            self.assertEqual(con.execute("PRAGMA synchronous").fetchone()[0], 1)
+            self.assertEqual(con.execute("PRAGMA cache_size").fetchone()[0], -16000)
+            self.assertEqual(con.execute("PRAGMA temp_store").fetchone()[0], 2)
+            self.assertEqual(con.execute("PRAGMA busy_timeout").fetchone()[0], 5000)
+
+        db.dispose()
+        self.conf.read_dict({"sqlite": {
+            "journal-mode": "delete", "synchronous": "full", "cache-size": "1024"}})
+
+        db = SQLite3(self.path, self.conf)
+        with db.pool.connection() as con:
+            self.assertEqual(con.execute("PRAGMA journal_mode").fetchone()[0], "delete")
+            self.assertEqual(con.execute("PRAGMA synchronous").fetchone()[0], 2)
+            self.assertEqual(con.execute("PRAGMA cache_size").fetchone()[0], -1024)
+
+        self.conf.set("sqlite", "synchronous", "off; DROP TABLE comments")
+        self.assertRaises(ValueError, SQLite3, self.path, self.conf)
+
+    def test_transaction(self):
+
+        db = SQLite3(self.path, self.conf)
+        db.threads.new("/", "Test")
+
+        try:
+            with db.transaction():
+                db.execute("DELETE FROM threads")
+                self.assertNotIn("/", db.threads)
+                raise ValueError
+        except ValueError:
+            pass
+
+        self.assertIn("/", db.threads)
+
+    def test_concurrent_add(self):
+
+        db = SQLite3(self.path, self.conf)
+        for uri in ("/a", "/b"):
+            db.threads.new(uri, None)
+
+        errors = []
+
+        def add(n):
+            try:
+                for i in range(10):
+                    text = "%i-%i" % (n, i)
+                    rv = db.comments.add("/a" if n % 2 else "/b", {
+                        "text": text, "mode": 1, "remote_addr": "127.0.0.1"})
+                    if rv["text"] != text:
+                        errors.append((text, rv["text"]))
+            except Exception as e:
+                errors.append(e)
+
+        workers = [threading.Thread(target=add, args=(n, )) for n in range(8)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(db.comments.count("/a", "/b"), [40, 40])
+
+    def test_concurrent_vote(self):
+
+        db = SQLite3(self.path, self.conf)
+        db.threads.new("/", None)
+        db.comments.add("/", {"text": "...", "mode": 1, "remote_addr": "127.0.0.1"})
+
+        results, errors = [], []
+
+        def vote(n):
+            try:
+                for i in range(10):
+                    results.append(db.comments.vote(
+                        bool(i % 2), 1, "10.0.%i.%i" % (n, i))["likes"])
+            except Exception as e:
+                errors.append(e)
+
+        workers = [threading.Thread(target=vote, args=(n, )) for n in range(8)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(errors, [])
+
+        rv = db.comments.get(1)
+        self.assertEqual((rv["likes"], rv["dislikes"]), (40, 40))
+        self.assertEqual(sorted(set(results))[-1], 40)
+
+        # every vote has been recorded in the voters bloomfilter
+        self.assertEqual(db.comments.vote(True, 1, "10.0.3.7")["likes"], 40)
+
+    def test_write_queue(self):
+
+        self.conf.read_dict({"sqlite": {
+            "write-queue": "on", "write-batch-size": "16", "write-latency": "5"}})
+
+        db = SQLite3(self.path, self.conf)
+        self.assertIsNotNone(db.writer)
+        self.assertEqual(db.writer.latency, 0.005)
+
+        db.threads.new("/", None)
+
+        def add(n):
+            rv = db.comments.add("/", {"text": str(n), "mode": 1, "remote_addr": "127.0.0.1"})
+            self.assertEqual(rv["text"], str(n))
+
+        workers = [threading.Thread(target=add, args=(n, )) for n in range(32)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(db.comments.count("/"), [32])
+        self.assertEqual(db.write(lambda: threading.current_thread().name), "isso-writer")
+
+        # a failing write is rolled back without affecting the others
+        self.assertRaises(sqlite3.OperationalError,
+                          db.comments.update, 1, {"nosuchcolumn": 1})
+        self.assertEqual(db.comments.update(1, {"text": "Hi"})["text"], "Hi")
+
+        # writes within a transaction don't wait for the writer
+        with db.transaction():
+            db.threads.new("/new", None)
+            self.assertIn("/new", db.threads)
+
+
+class TestThreadCache(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        self.db = SQLite3(self.path, config.new({
+            "general": {
+                "dbpath": "/dev/null",
+                "max-age": "1h"
+            }
+        }))
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def test_lookup(self):
+
+        db = self.db
+        thread = db.threads.new("/a", "A")
+        self.assertEqual(db.threads.lookup("/a"), (thread["id"], "A"))
+        self.assertIsNone(db.threads.lookup("/b"))
+        self.assertNotIn("/b", db.threads.cache)
+
+        # served from the cache, revalidated by version
+        db.execute("UPDATE threads SET title = 'B', uri = '/b'")
+        self.assertEqual(db.threads["/a"], {"id": thread["id"], "uri": "/a", "title": "A"})
+        self.assertIsNone(db.threads.version("/a"))
+        self.assertNotIn("/a", db.threads)
+        self.assertRaises(KeyError, lambda: db.threads["/a"])
+
+    def test_remove_stale_threads(self):
+
+        db = self.db
+        for uri in ("/a", "/b"):
+            db.threads.new(uri, None)
+            db.comments.add(uri, {"text": "...", "mode": 1, "remote_addr": "127.0.0.1"})
+        self.assertIn("/a", db.threads)
+
+        db.comments.delete(1)
+        self.assertNotIn("/a", db.threads)
+        self.assertEqual(list(db.comments.fetch("/a")), [])
+        self.assertEqual(db.comments.reply_count("/a"), {})
+        self.assertEqual(len(list(db.comments.fetch("/b"))), 1)
+
+        # the id of /b is reused
+        db.comments.delete(2)
+        db.threads.new("/c", None)
+        db.comments.add("/c", {"text": "...", "mode": 1, "remote_addr": "127.0.0.1"})
+        self.assertEqual(list(db.comments.fetch("/b")), [])
+
+    def test_processes(self):
+
+        # another process removes /x, whose id is reused by /y
+        other = SQLite3(self.path, self.db.conf)
+        db = self.db
+        db.threads.new("/x", None)
+        db.comments.add("/x", {"text": "x", "mode": 1, "remote_addr": "127.0.0.1"})
+        self.assertIn("/x", db.threads)
+
+        other.comments.delete(1)
+        other.threads.new("/y", None)
+        other.comments.add("/y", {"text": "y", "mode": 1, "remote_addr": "127.0.0.1"})
+        self.assertEqual(other.threads["/y"]["id"], db.threads["/x"]["id"])
+
+        self.assertEqual(list(db.comments.fetch("/x")), [])
+        self.assertEqual(db.comments.fetch_tree("/x"), ([], {}))
+        self.assertEqual(db.comments.reply_count("/x"), {})
+        self.assertNotIn("/x", db.threads)
+        self.assertRaises(KeyError, lambda: db.threads["/x"])
+        self.assertEqual([c["text"] for c in db.comments.fetch("/y")], ["y"])
+
+    def test_size(self):
+
+        db = self.db
+        db.threads.cache_size = 2
+        for uri in ("/a", "/b", "/c"):
+            db.threads.new(uri, None)
+        self.assertEqual(list(db.threads.cache), ["/b", "/c"])
+
+        db.threads.lookup("/b")
+        db.threads.lookup("/a")
+        self.assertEqual(list(db.threads.cache), ["/b", "/a"])
@@ -6,6 +6,7 @@ import unittest
 import os
 import json
 import tempfile
+import time
 
 from werkzeug import __version__
 from werkzeug.test import Client
@@ -32,13 +33,14 @@ class TestGuard(unittest.TestCase):
         self.path = tempfile.NamedTemporaryFile().name
 
     def makeClient(self, ip, ratelimit=2, direct_reply=3, self_reply=False,
-                   require_email=False, require_author=False):
+                   require_email=False, require_author=False, engine="memory"):
 
         conf = config.load(os.path.join(dist.location, "share", "isso.conf"))
         conf.set("general", "dbpath", self.path)
         conf.set("hash", "algorithm", "none")
         conf.set("guard", "enabled", "true")
         conf.set("guard", "ratelimit", str(ratelimit))
+        conf.set("guard", "ratelimit-engine", engine)
         conf.set("guard", "direct-reply", str(direct_reply))
         conf.set("guard", "reply-to-self", "1" if self_reply else "0")
         conf.set("guard", "require-email", "1" if require_email else "0")
@@ -71,12 +73,41 @@ class TestGuard(unittest.TestCase):
             self.assertEqual(alice.post(
                 "/new?uri=test", data=self.data).status_code, 201)
 
-        bob.application.db.execute([
-            "UPDATE comments SET",
-            "    created = created - 60",
-            "WHERE remote_addr = '127.0.0.0'"
-        ])
+        limiter = bob.application.db.guard.limiter
+        self.assertEqual(limiter.rejected, 1)
+        limiter.clock = lambda: time.time() + 60
+
+        self.assertEqual(
+            bob.post("/new?uri=test", data=self.data).status_code, 201)
+
+    def testRateLimitConflict(self):
+
+        # comments that could not be saved don't count
+        bob = self.makeClient("127.0.0.1", 2)
+        comments = bob.application.db.comments
+        add, comments.add = comments.add, lambda uri, data: None
+        self.assertEqual(bob.post('/new?uri=test', data=self.data).status_code, 409)
+
+        comments.add = add
+        for i in range(2):
+            rv = bob.post('/new?uri=test', data=self.data)
+            self.assertEqual(rv.status_code, 201)
+
+    def testRateLimitSQLite(self):
+
+        bob = self.makeClient("127.0.0.1", 2, engine="sqlite")
+        for i in range(2):
+            rv = bob.post('/new?uri=test', data=self.data)
+            self.assertEqual(rv.status_code, 201)
+
+        # another process sharing the database
+        bob = self.makeClient("127.0.0.1", 2, engine="sqlite")
+        rv = bob.post('/new?uri=test', data=self.data)
+        self.assertEqual(rv.status_code, 403)
+        self.assertIn("ratelimit exceeded", rv.get_data(as_text=True))
+        self.assertEqual(bob.application.db.guard.limiter.rejected, 1)
 
+        bob.application.db.guard.limiter.clock = lambda: time.time() + 60
         self.assertEqual(
             bob.post("/new?uri=test", data=self.data).status_code, 201)
 
@@ -2,6 +2,8 @@
 
 from __future__ import unicode_literals
 
+import io
+import json
 import unittest
 import tempfile
 from os.path import join, dirname
@@ -9,7 +11,7 @@ from os.path import join, dirname
 from isso import config
 
 from isso.db import SQLite3
-from isso.migrate import Disqus, WordPress, autodetect, Generic
+from isso.migrate import Disqus, WordPress, autodetect, Generic, iterjson
 
 conf = config.new({
     "general": {
@@ -79,6 +81,41 @@ class TestMigration(unittest.TestCase):
         self.assertEqual(last["author"], "Letzter :/")
         self.assertEqual(last["parent"], None)
 
+    def test_wordpress_order(self):
+
+        comments = b"".join(
+            b"""
+                <wp:comment>
+                    <wp:comment_id>%i</wp:comment_id>
+                    <wp:comment_author>Tester</wp:comment_author>
+                    <wp:comment_author_email></wp:comment_author_email>
+                    <wp:comment_author_url></wp:comment_author_url>
+                    <wp:comment_author_IP>127.0.0.1</wp:comment_author_IP>
+                    <wp:comment_date_gmt>2014-04-29 15:21:35</wp:comment_date_gmt>
+                    <wp:comment_content>%i</wp:comment_content>
+                    <wp:comment_approved>1</wp:comment_approved>
+                    <wp:comment_parent>%i</wp:comment_parent>
+                </wp:comment>""" % (id, id, parent)
+            for (id, parent) in [(3, 5), (4, 3), (5, 0), (6, 0), (7, 8), (8, 7)])
+
+        xml = tempfile.NamedTemporaryFile(suffix=".xml")
+        xml.write(b"""<?xml version="1.0" encoding="UTF-8"?>
+            <rss version="2.0" xmlns:wp="http://wordpress.org/export/1.2/">
+            <channel><item>
+                <title>Hello</title>
+                <link>http://example.tld/hello/</link>""" + comments + b"""
+            </item></channel></rss>""")
+        xml.flush()
+
+        xxx = tempfile.NamedTemporaryFile()
+        db = SQLite3(xxx.name, conf)
+        WordPress(db, xml.name).migrate()
+
+        # replies follow their parent, otherwise comments are ordered by id,
+        # the cycle of 7 and 8 is skipped
+        rv = db.execute("SELECT id, text, parent FROM comments ORDER BY id").fetchall()
+        self.assertEqual(rv, [(1, "5", None), (2, "3", 1), (3, "4", 1), (4, "6", None)])
+
     def test_generic(self):
         filepath = join(dirname(__file__), "generic.json")
         tempf = tempfile.NamedTemporaryFile()
@@ -111,6 +148,87 @@ class TestMigration(unittest.TestCase):
         self.assertEqual(comment["website"], "")
         self.assertEqual(comment["remote_addr"], "0.0.0.0")
 
+    def test_disqus_order(self):
+
+        posts = b"".join(
+            b"""
+                <post dsq:id="%i">
+                    <message>%i</message>
+                    <createdAt>2013-10-10T19:20:29Z</createdAt>
+                    <isDeleted>false</isDeleted>
+                    <author><name>peter</name></author>
+                    <thread dsq:id="1" />%s
+                </post>""" % (id, id, parent and b'<parent dsq:id="%i" />' % parent or b"")
+            for (id, parent) in [(12, 11), (11, 10), (10, None), (13, 99)])
+
+        xml = tempfile.NamedTemporaryFile(suffix=".xml")
+        xml.write(b"""<?xml version="1.0"?>
+            <disqus xmlns="http://disqus.com" xmlns:dsq="http://disqus.com/disqus-internals">
+            """ + posts + b"""
+                <thread dsq:id="1">
+                    <id>1</id>
+                    <link>http://example.org/</link>
+                    <title>Hello, World!</title>
+                </thread>
+            </disqus>""")
+        xml.flush()
+
+        xxx = tempfile.NamedTemporaryFile()
+        db = SQLite3(xxx.name, conf)
+        Disqus(db, xml.name).migrate()
+
+        rv = dict((c["text"], c["parent"]) for c in db.comments.fetch("/"))
+        top = db.execute("SELECT id FROM comments WHERE text='10'").fetchone()[0]
+
+        # replies precede their parents, the missing parent 99 is dropped
+        self.assertEqual(rv, {"10": None, "11": top, "12": top, "13": None})
+        self.assertEqual(db.threads["/"]["title"], "Hello, World!")
+
+    def test_disqus_created(self):
+
+        posts = b"".join(
+            b"""
+                <post dsq:id="%i">
+                    <message>%i</message>
+                    <createdAt>2013-10-%iT19:20:29Z</createdAt>
+                    <isDeleted>false</isDeleted>
+                    <author><name>peter</name></author>
+                    <thread dsq:id="1" />
+                </post>""" % (id, id, day)
+            for (id, day) in [(30, 12), (31, 10), (32, 11)])
+
+        xml = tempfile.NamedTemporaryFile(suffix=".xml")
+        xml.write(b"""<?xml version="1.0"?>
+            <disqus xmlns="http://disqus.com" xmlns:dsq="http://disqus.com/disqus-internals">
+                <thread dsq:id="1">
+                    <id>1</id>
+                    <link>http://example.org/</link>
+                    <title>Hello, World!</title>
+                </thread>
+            """ + posts + b"""
+            </disqus>""")
+        xml.flush()
+
+        xxx = tempfile.NamedTemporaryFile()
+        db = SQLite3(xxx.name, conf)
+        Disqus(db, xml.name).migrate()
+
+        # comments are numbered by creation date, not in dump order
+        self.assertEqual([c["text"] for c in db.comments.fetch("/")], ["31", "32", "30"])
+
+    def test_iterjson(self):
+
+        data = [{"id": i, "text": "\u00fc" * i, "values": [1.5, None, True]}
+                for i in range(32)] + [12345, "]", []]
+        raw = json.dumps(data, ensure_ascii=False).encode("utf-8")
+
+        for size in (1, 7, 4096):
+            self.assertEqual(list(iterjson(io.BytesIO(raw), size)), data)
+
+        self.assertEqual(list(iterjson(io.BytesIO(b" [ ] "))), [])
+        self.assertRaises(ValueError, list, iterjson(io.BytesIO(b'[{"id": 1}')))
+        self.assertRaises(ValueError, list, iterjson(io.BytesIO(b'{"id": 1}')))
+
     def test_detection(self):
 
         wp = """\
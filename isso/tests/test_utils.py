@@ -1,5 +1,6 @@
 # -*- encoding: utf-8 -*-
 
+import hashlib
 import unittest
 
 from isso import utils
@@ -31,6 +32,39 @@ class TestUtils(unittest.TestCase):
         for (addr, anonymized) in examples:
             self.assertEqual(utils.anonymize(addr), anonymized)
 
+    def test_bloomfilter(self):
+        # arrays of the fixed size Bloomfilter are the first slice
+        def legacy(key):
+            array, h = bytearray(256), int(hashlib.sha256(key.encode()).hexdigest(), 16)
+            for _ in range(11):
+                i, h = h & 2047, h >> 11
+                array[i // 8] |= 2 ** (i % 8)
+            return array
+
+        bf = utils.Bloomfilter(iterable=["127.0.0.1"])
+        self.assertEqual(bf.array, legacy("127.0.0.1"))
+        self.assertIn("127.0.0.1", utils.Bloomfilter(legacy("127.0.0.1"), 1))
+
+        bf = utils.Bloomfilter(legacy("127.0.0.1"), 1)
+        for i in range(1, 1000):
+            bf.add("1.2.%i.%i" % divmod(i, 256))
+        self.assertEqual(len(bf.array), 256 + 512 + 1024 + 2048)
+        self.assertIn("127.0.0.1", bf)
+        self.assertTrue(all("1.2.%i.%i" % divmod(i, 256) in bf for i in range(1, 1000)))
+        self.assertLess(sum("1.3.%i.%i" % divmod(i, 256) in bf for i in range(10000)), 40)
+
+        keys = ["1.2.%i.%i" % divmod(i, 256) for i in range(1, 1000)]
+        many = utils.Bloomfilter(legacy("127.0.0.1"), 1)
+        many.add_many(keys)
+        self.assertEqual((many.array, len(many)), (bf.array, len(bf)))
+        self.assertEqual(bf.contains_many(["127.0.0.1", "127.0.0.2"] + keys),
+                         [True, False] + [True] * len(keys))
+
+        other = utils.Bloomfilter(iterable=["127.0.0.2"])
+        other.update(bf)
+        self.assertEqual(len(other.array), len(bf.array))
+        self.assertTrue(all(key in other for key in ("127.0.0.1", "127.0.0.2", "1.2.3.231")))
+
 
 class TestParse(unittest.TestCase):
 
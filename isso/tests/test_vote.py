@@ -74,7 +74,7 @@ class TestVote(unittest.TestCase):
         self.assertEqual(rv.status_code, 200)
         self.assertEqual(loads(rv.data), None)
 
-    def testTooManyLikes(self):
+    def testManyLikes(self):
 
         self.makeClient("127.0.0.1").post(
             "/new?uri=test", data=json.dumps({"text": "..."}))
@@ -82,10 +82,11 @@ class TestVote(unittest.TestCase):
             rv = self.makeClient("1.2.%i.0" % num).post('/id/1/like')
             self.assertEqual(rv.status_code, 200)
 
-            if num >= 142:
-                self.assertEqual(loads(rv.data)["likes"], 142)
-            else:
-                self.assertEqual(loads(rv.data)["likes"], num + 1)
+            self.assertEqual(loads(rv.data)["likes"], num + 1)
+
+        # and each of them only once
+        rv = self.makeClient("1.2.142.0").post('/id/1/like')
+        self.assertEqual(loads(rv.data)["likes"], 256)
 
     def testDislike(self):
         self.makeClient("127.0.0.1").post(
@@ -95,3 +96,57 @@ class TestVote(unittest.TestCase):
         self.assertEqual(rv.status_code, 200)
         self.assertEqual(loads(rv.data)['likes'], 0)
         self.assertEqual(loads(rv.data)['dislikes'], 1)
+
+    def testBufferedVotes(self):
+
+        conf = config.load(os.path.join(dist.location, "share", "isso.conf"))
+        conf.set("general", "dbpath", self.path)
+        conf.set("guard", "enabled", "off")
+        conf.set("hash", "algorithm", "none")
+        conf.set("votes", "buffer", "true")
+        conf.set("votes", "flush-interval", "3600000")
+
+        class App(Isso, core.Mixin):
+            pass
+
+        app = App(conf)
+        invalidate, flushed = app.votes.flushed, []
+        app.votes.flushed = flushed.append
+
+        def client(ip):
+            return JSONClient(FakeIP(app.wsgi_app, ip), Response)
+
+        client("127.0.0.1").post("/new?uri=test", data=json.dumps({"text": "..."}))
+        for num in range(3):
+            rv = client("1.2.%i.0" % num).post('/id/1/like')
+            self.assertEqual(loads(rv.data), {"likes": num + 1, "dislikes": 0})
+
+        # duplicate voters and the author are rejected in memory
+        rv = client("1.2.0.0").post('/id/1/dislike')
+        self.assertEqual(loads(rv.data), {"likes": 3, "dislikes": 0})
+        rv = client("127.0.0.1").post('/id/1/like')
+        self.assertEqual(loads(rv.data), {"likes": 3, "dislikes": 0})
+        rv = client("1.2.3.0").post('/id/1/dislike')
+        self.assertEqual(loads(rv.data), {"likes": 3, "dislikes": 1})
+
+        self.assertEqual(app.db.comments.get(1)["likes"], 0)
+        self.assertEqual(app.votes.flush(), 4)
+        self.assertEqual(flushed, [1])
+
+        rv = client("1.2.3.4").get('/id/1')
+        self.assertEqual((loads(rv.data)["likes"], loads(rv.data)["dislikes"]), (3, 1))
+
+        # the voters have been written as well
+        rv = client("1.2.1.0").post('/id/1/like')
+        self.assertEqual(loads(rv.data), {"likes": 3, "dislikes": 1})
+        rv = client("1.2.4.0").post('/id/1/like')
+        self.assertEqual(loads(rv.data), {"likes": 4, "dislikes": 1})
+        self.assertEqual(app.votes.flush(), 1)
+        self.assertEqual(app.db.comments.get(1)["likes"], 4)
+
+        # threads removed before the votes have been written are skipped
+        client("1.2.5.0").post('/id/1/like')
+        app.db.comments.delete(1)
+        invalidate(1)
+        app.votes.flush()
+        self.assertIsNone(app.db.threads.get(1))
@@ -2,6 +2,9 @@
 
 import unittest
 
+from werkzeug.test import Client
+from werkzeug.wrappers import Response
+
 from isso import wsgi
 
 
@@ -43,3 +46,33 @@ class TestWSGIUtilities(unittest.TestCase):
         self.assertEqual(origin({"HTTP_ORIGIN": "http://spam.baz"}),
                          "http://foo.bar")
         self.assertEqual(origin({}), "http://foo.bar")
+
+    def test_token_bucket(self):
+
+        def hello_world(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return [b"Hello, World."]
+
+        app = wsgi.TokenBucketMiddleware(
+            hello_world, {("GET", "/"): ("fetch", 1.0, 2), ("POST", "/count"): ("counts", 0.5, 1)},
+            key=lambda environ: environ["REMOTE_ADDR"], size=2)
+        now = [1000.0]
+        app.clock = lambda: now[0]
+
+        def status(method="GET", path="/", addr="127.0.0.1"):
+            rv = Client(app, Response).open(path, method=method, environ_base={"REMOTE_ADDR": addr})
+            return rv.status_code, rv.headers.get("Retry-After")
+
+        self.assertEqual([status(), status(), status("HEAD")], [(200, None), (200, None), (429, "1")])
+        self.assertEqual(status("POST", "/count"), (200, None))
+        self.assertEqual(status("POST", "/count"), (429, "2"))
+        self.assertEqual(status(path="/feed"), (200, None))
+        self.assertEqual(app.rejected, 2)
+
+        now[0] += 1
+        self.assertEqual([status(), status()], [(200, None), (429, "1")])
+
+        # the least recently used bucket (127.0.0.1 on /count) is dropped
+        self.assertEqual(status(addr="127.0.0.2"), (200, None))
+        self.assertEqual(len(app.buckets), 2)
+        self.assertEqual(status("POST", "/count"), (200, None))
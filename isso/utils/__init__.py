@@ -7,6 +7,7 @@ werkzeug = pkg_resources.get_distribution("werkzeug")
 
 import hashlib
 import json
+import math
 import os
 
 from datetime import datetime
@@ -44,16 +45,60 @@ def anonymize(remote_addr):
             return u'0.0.0.0'
 
 
+def remote_addr(request, trusted_proxies=()):
+    """Return the anonymized IP address of the requester.
+
+    Takes into consideration a potential X-Forwarded-For HTTP header
+    if the request passed through one of :param:`trusted_proxies`.
+
+    Recipe source: https://stackoverflow.com/a/22936947/636849
+    """
+    addr = request.remote_addr
+    if trusted_proxies:
+        route = request.access_route + [addr]
+        addr = next((a for a in reversed(route) if a not in trusted_proxies), addr)
+    return anonymize(str(addr))
+
+
+def _slices(count=12, size=256, p=1e-3):
+    """Layout of the slices of a scalable :class:`Bloomfilter`: offset and
+    size in bytes, number of hash functions and number of elements stored
+    up to and including each slice.
+
+    Each slice is twice the size of the previous one, with half its
+    false-positive rate :param:`p` and one more hash function, so the overall
+    false-positive rate stays below 2 * :param:`p` (and the first slice
+    matches the original 256 byte, 11 hash functions Bloomfilter).
+    """
+    rv, offset, total = [], 0, 0
+    for i in range(count):
+        m, k = size * 8 << i, 11 + i
+        total += int(-m / k * math.log(1 - (p / 2 ** i) ** (1 / k)))
+        rv.append((offset, size << i, k, total))
+        offset += size << i
+    return rv
+
+
 class Bloomfilter:
-    """A space-efficient probabilistic data structure. False-positive rate:
+    """A space-efficient probabilistic data structure, which grows with the
+    number of elements. False-positive rate:
 
         * 1e-05 for  <80 elements
         * 1e-04 for <105 elements
         * 1e-03 for <142 elements
+        * <2e-03 for any number of elements
+
+    Starts with a 256 byte array (2048 bits) and 11 hash functions. 256 byte
+    because of space efficiency (array is saved for each comment) and 11 hash
+    functions because of best overall false-positive rate in that range.
 
-    Uses a 256 byte array (2048 bits) and 11 hash functions. 256 byte because
-    of space efficiency (array is saved for each comment) and 11 hash functions
-    because of best overall false-positive rate in that range.
+    Once a slice is full, a slice of twice the size with one more hash
+    function is appended to the array (see :func:`_slices`), up to 12 slices
+    (about 1 MiB for 290000 elements). Elements are looked up in all slices.
+    As the array of a single slice is the array of the original fixed size
+    Bloomfilter, existing arrays stay valid. :param:`elements` must be the
+    number of elements already added to :param:`array` to continue filling
+    the right slice.
 
     >>> bf = Bloomfilter()
     >>> bf.add("127.0.0.1")
@@ -64,8 +109,8 @@ class Bloomfilter:
     >>> for i in range(256):
     ...     bf.add("1.2.%i.4" % i)
     ...
-    >>> len(bf)
-    256
+    >>> len(bf), len(bf.array)
+    (256, 768)
     >>> "1.2.3.4" in bf
     True
     >>> "127.0.0.1" in bf
@@ -75,28 +120,104 @@ class Bloomfilter:
        http://code.activestate.com/recipes/577684-bloom-filter/
     """
 
+    slices = _slices()
+
+    # bit masks and probe shifts, precomputed per slice
+    masks = tuple(1 << i for i in range(8))
+    shifts = tuple(tuple(range(0, k * (11 + i), 11 + i))
+                   for i, (_, _, k, _) in enumerate(slices))
+    layouts = {}
+
     def __init__(self, array=None, elements=0, iterable=()):
         self.array = array or bytearray(256)
         self.elements = elements
-        self.k = 11
-        self.m = len(self.array) * 8
+        self.add_many(iterable)
+
+    @staticmethod
+    def digest(key, i=0):
+        """Hash of :param:`key` for slice :param:`i` as integer, the probes
+        are its consecutive groups of 11 + :param:`i` bits."""
+        if i == 0:
+            digest = hashlib.sha256(key.encode()).digest()
+        else:
+            digest = hashlib.sha512(("%i:%s" % (i, key)).encode()).digest()
+        return int.from_bytes(digest, "big")
+
+    def get_probes(self, key, i=0):
+        """Bit positions of :param:`key` within slice :param:`i`."""
+        h, m = self.digest(key, i), self.slices[i][1] * 8 - 1
+        return [h >> shift & m for shift in self.shifts[i]]
 
-        for item in iterable:
-            self.add(item)
+    def add(self, key):
+        self.add_many((key, ))
+
+    def add_many(self, keys):
+        """Add all of :param:`keys`."""
+        array, slices, masks, digest = self.array, self.slices, self.masks, self.digest
+        elements, limit = self.elements, -1
+
+        for key in keys:
+            if elements >= limit:
+                # the first slice with room left, or the last one
+                i = 0
+                while i < len(slices) - 1 and elements >= slices[i][3]:
+                    i += 1
+
+                offset, size, _, limit = slices[i]
+                if i == len(slices) - 1:
+                    limit = float("inf")
+                if len(array) < offset + size:
+                    array.extend(bytearray(offset + size - len(array)))
+                m, shifts = size * 8 - 1, self.shifts[i]
+
+            h = digest(key, i)
+            for shift in shifts:
+                p = h >> shift & m
+                array[offset + (p >> 3)] |= masks[p & 7]
+            elements += 1
 
-    def get_probes(self, key):
-        h = int(hashlib.sha256(key.encode()).hexdigest(), 16)
-        for _ in range(self.k):
-            yield h & self.m - 1
-            h >>= self.k
+        self.elements = elements
 
-    def add(self, key):
-        for i in self.get_probes(key):
-            self.array[i // 8] |= 2 ** (i % 8)
-        self.elements += 1
+    def update(self, other):
+        """Add the elements of Bloomfilter :param:`other`."""
+        if len(self.array) < len(other.array):
+            self.array.extend(bytearray(len(other.array) - len(self.array)))
+        for i, byte in enumerate(other.array):
+            self.array[i] |= byte
+
+    def layout(self):
+        """Slice index, offset, bit mask and probe shifts of the slices
+        within the array."""
+        try:
+            return self.layouts[len(self.array)]
+        except KeyError:
+            rv = self.layouts[len(self.array)] = tuple(
+                (i, offset, size * 8 - 1, self.shifts[i])
+                for i, (offset, size, _, _) in enumerate(self.slices)
+                if len(self.array) >= offset + size)
+            return rv
 
     def __contains__(self, key):
-        return all(self.array[i // 8] & (2 ** (i % 8)) for i in self.get_probes(key))
+        return self.contains_many((key, ))[0]
+
+    def contains_many(self, keys):
+        """Return whether each of :param:`keys` is in the filter."""
+        array, masks, digest, layout = self.array, self.masks, self.digest, self.layout()
+
+        rv = []
+        for key in keys:
+            for i, offset, m, shifts in layout:
+                h = digest(key, i)
+                for shift in shifts:
+                    p = h >> shift & m
+                    if not array[offset + (p >> 3)] & masks[p & 7]:
+                        break
+                else:
+                    rv.append(True)
+                    break
+            else:
+                rv.append(False)
+        return rv
 
     def __len__(self):
         return self.elements
@@ -94,7 +94,7 @@ def new(conf):
     salt = conf.get("salt").encode("utf-8")
 
     if algorithm == "none":
-        return Hash(salt, None)
+        rv = Hash(salt, None)
     elif algorithm.startswith("pbkdf2"):
         kwargs = {}
         tail = algorithm.partition(":")[2]
@@ -104,9 +104,13 @@ def new(conf):
                 break
             kwargs[key] = func(head)
 
-        return PBKDF2(salt, **kwargs)
+        rv = PBKDF2(salt, **kwargs)
     else:
-        return Hash(salt, algorithm)
+        rv = Hash(salt, algorithm)
+
+    # changes whenever the same value hashes differently
+    rv.fingerprint = sha1(algorithm + ":" + conf.get("salt"))
+    return rv
 
 
 sha1 = Hash(func="sha1").uhash
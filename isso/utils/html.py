@@ -2,6 +2,9 @@
 
 from __future__ import unicode_literals
 
+import json
+import hashlib
+
 import bleach
 import misaka
 
@@ -89,12 +92,18 @@ class Markup(object):
             conf_flags = conf.getlist("flags")
         except NoOptionError:
             conf_flags = []
-        parser = Markdown(extensions=conf.getlist("options"), flags=conf_flags)
-        sanitizer = Sanitizer(
-            conf.getlist("allowed-elements"),
-            conf.getlist("allowed-attributes"))
+        options = [conf.getlist("options"), conf_flags,
+                   conf.getlist("allowed-elements"),
+                   conf.getlist("allowed-attributes")]
+
+        parser = Markdown(extensions=options[0], flags=options[1])
+        sanitizer = Sanitizer(options[2], options[3])
 
         self._render = lambda text: sanitizer.sanitize(parser(text))
 
+        # changes whenever the same text renders differently
+        self.fingerprint = hashlib.sha1(
+            json.dumps(options).encode('utf-8')).hexdigest()
+
     def render(self, text):
         return self._render(text)
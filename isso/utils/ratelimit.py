@@ -0,0 +1,153 @@
+# -*- encoding: utf-8 -*-
+"""
+Sliding-window rate limiters for the spam guard: allow at most `limit`
+hits per key (the anonymized remote address) within `window` seconds.
+
+The in-memory limiter is per process. Deployments that fork several
+workers should use the SQLite limiter, which shares its window through a
+table in a SQLite database.
+"""
+
+from __future__ import unicode_literals
+
+import os
+import sqlite3
+import threading
+import time
+
+from collections import deque
+
+
+class Limiter(object):
+    """Base class of the rate limiters, which does not limit at all.
+    :attr:`rejected` counts the rejected hits since the limiter has been
+    created (per process)."""
+
+    def __init__(self, limit, window=60):
+
+        self.limit = limit
+        self.window = window
+        self.clock = time.time
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def allow(self, key):
+        """Return whether :param:`key` is below the limit. Does not count
+        as hit, call :meth:`add` once the hit has been accepted."""
+
+        if self.count(key) < self.limit:
+            return True
+
+        with self.lock:
+            self.rejected += 1
+        return False
+
+    def count(self, key):
+        """Return the number of hits of :param:`key` within the window."""
+        return 0
+
+    def add(self, key):
+        """Record a hit of :param:`key`."""
+        pass
+
+
+class MemoryLimiter(Limiter):
+    """Keep the timestamps of the last `limit` hits per key in a deque.
+    Keys without hits within the window are dropped at most once per
+    window."""
+
+    def __init__(self, limit, window=60):
+        super(MemoryLimiter, self).__init__(limit, window)
+        self.hits = {}
+        self.sweep = 0
+
+    def count(self, key):
+
+        with self.lock:
+            hits = self.hits.get(key)
+            if not hits:
+                return 0
+
+            expired = self.clock() - self.window
+            while hits and hits[0] <= expired:
+                hits.popleft()
+            return len(hits)
+
+    def add(self, key):
+
+        now = self.clock()
+        with self.lock:
+            if now >= self.sweep:
+                expired = now - self.window
+                for k in [k for k, hits in self.hits.items() if not hits or hits[-1] <= expired]:
+                    del self.hits[k]
+                self.sweep = now + self.window
+
+            hits = self.hits.get(key)
+            if hits is None:
+                hits = self.hits[key] = deque(maxlen=self.limit)
+            hits.append(now)
+
+
+class SQLiteLimiter(Limiter):
+    """Keep the hits in the `ratelimit` table of the SQLite database at
+    :param:`path`, shared by all processes using the same file. Expired
+    hits are removed at most once per window and process."""
+
+    def __init__(self, path, limit, window=60):
+        super(SQLiteLimiter, self).__init__(limit, window)
+        self.path = path
+        self.sweep = 0
+        self.local = threading.local()
+
+        self.execute([
+            'CREATE TABLE IF NOT EXISTS ratelimit (',
+            '    key VARCHAR NOT NULL, created FLOAT NOT NULL);'])
+        self.execute('CREATE INDEX IF NOT EXISTS ratelimit_key ON ratelimit(key, created)')
+
+    def execute(self, sql, args=()):
+
+        if isinstance(sql, (list, tuple)):
+            sql = ' '.join(sql)
+
+        # one connection per thread and process, hits need not be durable
+        con, pid = getattr(self.local, "con", (None, None))
+        if con is None or pid != os.getpid():
+            con = sqlite3.connect(self.path, timeout=10)
+            con.execute("PRAGMA synchronous = OFF")
+            self.local.con = con, os.getpid()
+
+        with con:
+            return con.execute(sql, args).fetchall()
+
+    def count(self, key):
+        return self.execute('SELECT COUNT(*) FROM ratelimit WHERE key = ? AND created > ?',
+                            (key, self.clock() - self.window))[0][0]
+
+    def add(self, key):
+
+        now = self.clock()
+        with self.lock:
+            sweep = now >= self.sweep
+            if sweep:
+                self.sweep = now + self.window
+
+        if sweep:
+            self.execute('DELETE FROM ratelimit WHERE created <= ?', (now - self.window, ))
+        self.execute('INSERT INTO ratelimit (key, created) VALUES (?, ?)', (key, now))
+
+
+def new(conf):
+    """Factory to create the rate limiter of the [guard] section, the
+    :param:`conf` is the whole configuration."""
+
+    engine = conf.get("guard", "ratelimit-engine")
+    limit = conf.getint("guard", "ratelimit")
+
+    if engine == "memory":
+        return MemoryLimiter(limit)
+    elif engine == "sqlite":
+        path = conf.get("guard", "ratelimit-dbpath") or conf.get("general", "dbpath")
+        return SQLiteLimiter(path, limit)
+
+    raise ValueError("unknown ratelimit engine: {0}".format(engine))
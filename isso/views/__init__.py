@@ -52,6 +52,7 @@ class Info(object):
 
     def __init__(self, isso):
         self.moderation = isso.conf.getboolean("moderation", "enabled")
+        self.responses = isso.responses
         isso.urls.add(Rule('/info', endpoint=self.show))
 
     def show(self, environ, request):
@@ -61,6 +62,10 @@ class Info(object):
             "host": str(local("host")),
             "origin": str(local("origin")),
             "moderation": self.moderation,
+            "cache": {
+                "hits": self.responses.hits,
+                "misses": self.responses.misses,
+            },
         }
 
         return Response(json.dumps(rv), 200, content_type="application/json")
@@ -12,12 +12,12 @@ from datetime import datetime, timedelta
 from itsdangerous import SignatureExpired, BadSignature
 from xml.etree import ElementTree as ET
 
-from werkzeug.http import dump_cookie
+from werkzeug.http import dump_cookie, is_resource_modified
 from werkzeug.wsgi import get_current_url
 from werkzeug.utils import redirect
 from werkzeug.routing import Rule
 from werkzeug.wrappers import Response
-from werkzeug.exceptions import BadRequest, Forbidden, NotFound
+from werkzeug.exceptions import BadRequest, Conflict, Forbidden, NotFound
 
 from isso.compat import text_type as str
 
@@ -25,7 +25,7 @@ from isso import utils, local
 from isso.utils import (http, parse,
                         JSONResponse as JSON, XMLResponse as XML,
                         render_template)
-from isso.views import requires
+from isso.views import requires, dist
 from isso.utils.hash import sha1
 from isso.utils.hash import md5
 
@@ -134,6 +134,7 @@ class API(object):
         self.isso = isso
         self.hash = hasher.uhash
         self.cache = isso.cache
+        self.responses = isso.responses
         self.signal = isso.signal
 
         self.conf = isso.conf.section("general")
@@ -146,6 +147,20 @@ class API(object):
         self.threads = isso.db.threads
         self.comments = isso.db.comments
 
+        # buffered votes expire the cached responses once written
+        self.votes = isso.votes
+        if self.votes is not None:
+            self.votes.flushed = self._invalidate
+
+        # part of each ETag, responses differ with these settings. ETags are
+        # public, hence secrets such as passwords and the salt are left out.
+        self.revision = sha1(json.dumps([
+            dist.version,
+            isso.conf.get("general", "gravatar"),
+            isso.conf.get("general", "gravatar-url"),
+            sorted(isso.conf.items("markup")),
+            isso.conf.get("hash", "algorithm")]))[:8]
+
         for (view, (method, path)) in self.VIEWS:
             isso.urls.add(
                 Rule(path, methods=[method], endpoint=getattr(self, view)))
@@ -278,21 +293,25 @@ class API(object):
         data['mode'] = 2 if self.moderated else 1
         data['remote_addr'] = self._remote_addr(request)
 
-        with self.isso.lock:
-            if uri not in self.threads:
-                if 'title' not in data:
-                    with http.curl('GET', local("origin"), uri) as resp:
-                        if resp and resp.status == 200:
-                            uri, title = parse.thread(resp.read(), id=uri)
-                        else:
-                            return NotFound('URI does not exist %s')
-                else:
-                    title = data['title']
-
-                thread = self.threads.new(uri, title)
-                self.signal("comments.new:new-thread", thread)
+        if uri not in self.threads:
+            # don't block other submissions while waiting for the origin
+            if 'title' not in data:
+                with http.curl('GET', local("origin"), uri) as resp:
+                    if resp and resp.status == 200:
+                        uri, title = parse.thread(resp.read(), id=uri)
+                    else:
+                        return NotFound('URI does not exist %s')
             else:
-                thread = self.threads[uri]
+                title = data['title']
+
+            with self.isso.locks[uri]:
+                if uri not in self.threads:
+                    thread = self.threads.new(uri, title)
+                    self.signal("comments.new:new-thread", thread)
+                else:
+                    thread = self.threads[uri]
+        else:
+            thread = self.threads[uri]
 
         # notify extensions that the new comment is about to save
         self.signal("comments.new:before-save", thread, data)
@@ -302,13 +321,25 @@ class API(object):
             self.signal("comments.new:guard", reason)
             raise Forbidden(reason)
 
-        with self.isso.lock:
-            # if email-based auto-moderation enabled, check for previously approved author
-            # right before approval.
-            if self.approve_if_email_previously_approved and self.comments.is_previously_approved_author(data['email']):
-                data['mode'] = 1
+        data['html'] = self.isso.render(data['text'])
+        data['hash'] = self.hash(data.get('email') or data['remote_addr'])
+
+        # if email-based auto-moderation enabled, check for previously approved author
+        # right before approval.
+        if self.approve_if_email_previously_approved and self.comments.is_previously_approved_author(data['email']):
+            data['mode'] = 1
 
+        rv = self.comments.add(uri, data)
+        if rv is None:
+            # the thread has been removed meanwhile, e.g. by another process
+            self.threads.discard(thread['id'])
+            thread = self.threads.new(uri, thread['title'])
             rv = self.comments.add(uri, data)
+            if rv is None:
+                raise Conflict("thread %s has been removed meanwhile" % uri)
+
+        self.guard.accept(data)
+        self.responses.invalidate(uri)
 
         # notify extension, that the new comment has been successfully saved
         self.signal("comments.new:after-save", thread, rv)
@@ -318,11 +349,7 @@ class API(object):
                                        [rv["id"], sha1(rv["text"])]),
                                    max_age=self.conf.getint('max-age'))
 
-        rv["text"] = self.isso.render(rv["text"])
-        rv["hash"] = self.hash(rv['email'] or rv['remote_addr'])
-
-        self.cache.set(
-            'hash', (rv['email'] or rv['remote_addr']).encode('utf-8'), rv['hash'])
+        rv["text"] = self._render(rv)
 
         rv = self._add_gravatar_image(rv)
 
@@ -338,19 +365,9 @@ class API(object):
         return resp
 
     def _remote_addr(self, request):
-        """Return the anonymized IP address of the requester.
-
-        Takes into consideration a potential X-Forwarded-For HTTP header
-        if a necessary server.trusted-proxies configuration entry is set.
-
-        Recipe source: https://stackoverflow.com/a/22936947/636849
-        """
-        remote_addr = request.remote_addr
-        if self.trusted_proxies:
-            route = request.access_route + [remote_addr]
-            remote_addr = next((addr for addr in reversed(route)
-                                if addr not in self.trusted_proxies), remote_addr)
-        return utils.anonymize(str(remote_addr))
+        """Return the anonymized IP address of the requester, see
+        :func:`isso.utils.remote_addr`."""
+        return utils.remote_addr(request, self.trusted_proxies)
 
     """
     @api {get} /id/:id view
@@ -386,12 +403,12 @@ class API(object):
         if rv is None:
             raise NotFound
 
+        if request.args.get('plain', '0') == '0':
+            rv['text'] = self._render(rv)
+
         for key in set(rv.keys()) - API.FIELDS:
             rv.pop(key)
 
-        if request.args.get('plain', '0') == '0':
-            rv['text'] = self.isso.render(rv['text'])
-
         return JSON(rv, 200)
 
     """
@@ -453,10 +470,14 @@ class API(object):
             data.pop(key)
 
         data['modified'] = time.time()
+        data['html'] = self.isso.render(data['text'])
 
         with self.isso.lock:
             rv = self.comments.update(id, data)
 
+        self._invalidate(rv['tid'])
+        html = self._render(rv)
+
         for key in set(rv.keys()) - API.FIELDS:
             rv.pop(key)
 
@@ -467,7 +488,7 @@ class API(object):
                                        [rv["id"], sha1(rv["text"])]),
                                    max_age=self.conf.getint('max-age'))
 
-        rv["text"] = self.isso.render(rv["text"])
+        rv["text"] = html
 
         resp = JSON(rv, 200)
         resp.headers.add("Set-Cookie", cookie(str(rv["id"])))
@@ -512,9 +533,13 @@ class API(object):
         self.cache.delete(
             'hash', (item['email'] or item['remote_addr']).encode('utf-8'))
 
+        thread = self.threads.get(item['tid'])
+
         with self.isso.lock:
             rv = self.comments.delete(id)
 
+        self.responses.invalidate(thread['uri'])
+
         if rv:
             for key in set(rv.keys()) - API.FIELDS:
                 rv.pop(key)
@@ -665,12 +690,18 @@ class API(object):
                 return Response("Already activated", 200)
             with self.isso.lock:
                 self.comments.activate(id)
+            self.responses.invalidate(thread['uri'])
             self.signal("comments.activate", thread, item)
             return Response("Yo", 200)
         elif action == "edit":
             data = request.get_json()
+            if data.get('text') is not None:
+                data['html'] = self.isso.render(data['text'])
+            if 'email' in data:
+                data['hash'] = self.hash(data['email'] or item['remote_addr'])
             with self.isso.lock:
                 rv = self.comments.update(id, data)
+            self.responses.invalidate(thread['uri'])
             for key in set(rv.keys()) - API.FIELDS:
                 rv.pop(key)
             self.signal("comments.edit", rv)
@@ -678,6 +709,7 @@ class API(object):
         else:
             with self.isso.lock:
                 self.comments.delete(id)
+            self.responses.invalidate(thread['uri'])
             self.cache.delete(
                 'hash', (item['email'] or item['remote_addr']).encode('utf-8'))
             self.signal("comments.delete", id)
@@ -792,23 +824,41 @@ class API(object):
 
         plain = request.args.get('plain', '0') == '0'
 
+        try:
+            nested_limit = int(request.args.get('nested_limit'))
+        except TypeError:
+            nested_limit = None
+        except ValueError:
+            return BadRequest("nested_limit should be integer")
+
+        version = self.threads.version(uri)
+        if version is not None and not self._modified(environ, version):
+            return self._versioned(Response(status=304), version)
+
+        # responses expire with the version of the thread, which changes on
+        # every write to its comments, including those bypassing the API
+        key = repr((version, args['after'], args['limit'], root_id, plain,
+                    nested_limit)).encode('utf-8')
+        gen, cached = self.responses.get(uri, key)
+        if cached is not None:
+            return self._versioned(
+                Response(cached, 200, content_type="application/json"), version)
+
         reply_counts = self.comments.reply_count(uri, after=args['after'])
 
+        nested = {}
         if args['limit'] == 0:
             root_list = []
+        elif root_id is None:
+            root_list, nested = self.comments.fetch_tree(
+                uri, limit=args['limit'], nested_limit=nested_limit,
+                after=args['after'])
         else:
             root_list = list(self.comments.fetch(**args))
 
         if root_id not in reply_counts:
             reply_counts[root_id] = 0
 
-        try:
-            nested_limit = int(request.args.get('nested_limit'))
-        except TypeError:
-            nested_limit = None
-        except ValueError:
-            return BadRequest("nested_limit should be integer")
-
         rv = {
             'id': root_id,
             'total_replies': reply_counts[root_id],
@@ -818,27 +868,54 @@ class API(object):
         # We are only checking for one level deep comments
         if root_id is None:
             for comment in rv['replies']:
-                if comment['id'] in reply_counts:
-                    comment['total_replies'] = reply_counts[comment['id']]
-                    if nested_limit is not None:
-                        if nested_limit > 0:
-                            args['parent'] = comment['id']
-                            args['limit'] = nested_limit
-                            replies = list(self.comments.fetch(**args))
-                        else:
-                            replies = []
-                    else:
-                        args['parent'] = comment['id']
-                        replies = list(self.comments.fetch(**args))
-                else:
-                    comment['total_replies'] = 0
-                    replies = []
+                replies = nested.get(comment['id'], [])
 
+                comment['total_replies'] = reply_counts.get(comment['id'], 0)
                 comment['hidden_replies'] = comment['total_replies'] - \
                     len(replies)
                 comment['replies'] = self._process_fetched_list(replies, plain)
 
-        return JSON(rv, 200)
+        resp = JSON(rv, 200)
+        self.responses.set(gen, key, resp.get_data())
+        return self._versioned(resp, version)
+
+    def _modified(self, environ, version):
+        """Return False if the client's copy of a response for
+        :meth:`isso.db.threads.Threads.version` :param:`version` is current."""
+        return is_resource_modified(environ, self._etag(version),
+                                    last_modified=self._last_modified(version))
+
+    def _etag(self, version):
+        return '-'.join([self.revision] + [str(x) for x in version])
+
+    def _last_modified(self, version):
+        if version[-1] is not None:
+            return datetime.utcfromtimestamp(version[-1])
+
+    def _versioned(self, resp, version):
+        """Set ETag and Last-Modified of :param:`resp` from :param:`version`
+        unless it is None."""
+        if version is not None:
+            resp.set_etag(self._etag(version))
+            resp.last_modified = self._last_modified(version)
+        return resp
+
+    def _vote(self, upvote, id, request):
+        if self.votes is not None:
+            return self.votes.vote(upvote, id, self._remote_addr(request))
+
+        nv = self.comments.vote(upvote, id, self._remote_addr(request))
+        if nv is not None:
+            self._invalidate(self.comments.get(id)['tid'])
+        return nv
+
+    def _invalidate(self, tid):
+        """Expire the cached responses of thread :param:`tid`, unless the
+        thread has been removed meanwhile (e.g. before buffered votes on its
+        comments have been written)."""
+        thread = self.threads.get(tid)
+        if thread is not None:
+            self.responses.invalidate(thread['uri'])
 
     def _add_gravatar_image(self, item):
         if not self.conf.getboolean('gravatar'):
@@ -852,27 +929,35 @@ class API(object):
 
         return item
 
+    def _render(self, item):
+        """Return the HTML stored with comment :param:`item`, rendering it
+        if the comment has been stored without."""
+        if item.get('html') is None:
+            return self.isso.render(item['text'])
+        return item['html']
+
     def _process_fetched_list(self, fetched_list, plain=False):
         for item in fetched_list:
 
-            key = item['email'] or item['remote_addr']
-            val = self.cache.get('hash', key.encode('utf-8'))
+            if plain:
+                item['text'] = self._render(item)
+
+            # not yet hashed by :meth:`isso.Isso.rehash`
+            if item.get('hash') is None:
+                key = item['email'] or item['remote_addr']
+                val = self.cache.get('hash', key.encode('utf-8'))
 
-            if val is None:
-                val = self.hash(key)
-                self.cache.set('hash', key.encode('utf-8'), val)
+                if val is None:
+                    val = self.hash(key)
+                    self.cache.set('hash', key.encode('utf-8'), val)
 
-            item['hash'] = val
+                item['hash'] = val
 
             item = self._add_gravatar_image(item)
 
             for key in set(item.keys()) - API.FIELDS:
                 item.pop(key)
 
-        if plain:
-            for item in fetched_list:
-                item['text'] = self.isso.render(item['text'])
-
         return fetched_list
 
     """
@@ -906,8 +991,7 @@ class API(object):
     @xhr
     def like(self, environ, request, id):
 
-        nv = self.comments.vote(True, id, self._remote_addr(request))
-        return JSON(nv, 200)
+        return JSON(self._vote(True, id, request), 200)
 
     """
     @api {post} /id/:id/dislike dislike
@@ -932,8 +1016,7 @@ class API(object):
     @xhr
     def dislike(self, environ, request, id):
 
-        nv = self.comments.vote(False, id, self._remote_addr(request))
-        return JSON(nv, 200)
+        return JSON(self._vote(False, id, request), 200)
 
     # TODO: remove someday (replaced by :func:`counts`)
     @requires(str, 'uri')
@@ -944,7 +1027,9 @@ class API(object):
         if rv == 0:
             raise NotFound
 
-        return JSON(rv, 200)
+        resp = JSON(rv, 200)
+        resp.add_etag()
+        return resp.make_conditional(request)
 
     """
     @api {post} /count count comments
@@ -965,7 +1050,9 @@ class API(object):
         if not isinstance(data, list) and not all(isinstance(x, str) for x in data):
             raise BadRequest("JSON must be a list of URLs")
 
-        return JSON(self.comments.count(*data), 200)
+        resp = JSON(self.comments.count(*data), 200)
+        resp.add_etag()
+        return resp.make_conditional(request)
 
     """
     @api {get} /feed Atom feed for comments
@@ -1046,7 +1133,7 @@ class API(object):
             content = ET.SubElement(entry, 'content', {
                 'type': 'html',
             })
-            content.text = self.isso.render(comment['text'])
+            content.text = self._render(comment)
 
             if comment['parent']:
                 ET.SubElement(entry, 'thr:in-reply-to', {
@@ -1212,6 +1299,10 @@ class API(object):
         if limit <= 0:
             return BadRequest(bad_limit_msg)
 
+        version = self.threads.version()
+        if not self._modified(environ, version):
+            return self._versioned(Response(status=304), version)
+
         # retrieve the latest N comments from the DB
         all_comments_gen = self.comments.fetchall(limit=None, order_by='created', mode='1')
         comments = collections.deque(all_comments_gen, maxlen=limit)
@@ -1235,7 +1326,7 @@ class API(object):
         result = []
         for comment in comments:
             processed = {key: comment[key] for key in fields}
-            processed['text'] = self.isso.render(comment['text'])
+            processed['text'] = self._render(comment)
             result.append(processed)
 
-        return JSON(result, 200)
+        return self._versioned(JSON(result, 200), version)
@@ -3,7 +3,12 @@
 from __future__ import unicode_literals
 
 import sys
+import math
+import time
 import socket
+import threading
+
+from collections import OrderedDict
 
 try:
     from urllib.parse import quote, urlparse
@@ -155,6 +160,70 @@ class CORSMiddleware(object):
         return self.app(environ, add_cors_headers)
 
 
+class TokenBucketMiddleware(object):
+    """Throttle requests per endpoint and client with token buckets. Each
+    client, as identified by :param:`key` (a function of the environ), may
+    send `burst` requests at once to an endpoint and `rate` requests per
+    second afterwards. :param:`endpoints` maps a (method, path) tuple to the
+    endpoint's (name, rate, burst), all other requests pass through.
+
+    Throttled requests are answered with `429 Too Many Requests` and a
+    `Retry-After` header. Only the :param:`size` least recently used buckets
+    are kept in memory, a client whose bucket has been dropped starts with a
+    full bucket again.
+    """
+
+    def __init__(self, app, endpoints, key, size=10000):
+        self.app = app
+        self.endpoints = endpoints
+        self.key = key
+        self.size = size
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+        self.clock = time.time
+        self.rejected = 0
+
+    def take(self, bucket, rate, burst):
+        """Take a token from :param:`bucket`, return 0 on success or the
+        seconds until the next token is available."""
+
+        now = self.clock()
+        with self.lock:
+            try:
+                tokens, stamp = self.buckets[bucket]
+                self.buckets.move_to_end(bucket)
+            except KeyError:
+                tokens, stamp = burst, now
+                if len(self.buckets) >= self.size:
+                    self.buckets.popitem(last=False)
+
+            tokens = min(burst, tokens + (now - stamp) * rate)
+            if tokens >= 1:
+                self.buckets[bucket] = tokens - 1, now
+                return 0
+
+            self.buckets[bucket] = tokens, now
+            self.rejected += 1
+            return (1 - tokens) / rate
+
+    def __call__(self, environ, start_response):
+
+        method = environ.get("REQUEST_METHOD")
+        endpoint = self.endpoints.get(
+            ("GET" if method == "HEAD" else method, environ.get("PATH_INFO") or "/"))
+
+        if endpoint is not None:
+            name, rate, burst = endpoint
+            wait = self.take((name, self.key(environ)), rate, burst)
+            if wait:
+                start_response("429 Too Many Requests", [
+                    ("Content-Type", "text/plain"),
+                    ("Retry-After", str(int(math.ceil(wait))))])
+                return [b"Too many requests, retry later."]
+
+        return self.app(environ, start_response)
+
+
 class LegacyWerkzeugMiddleware(object):
     # Add compatibility with werkzeug 0.8
     # -- https://github.com/posativ/isso/pull/170